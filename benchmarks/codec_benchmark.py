@@ -0,0 +1,92 @@
+"""
+Codec Benchmark
+
+Measures encode and decode time of the websocket server codecs on
+Moonraker-shaped payloads: a full status snapshot as sent in response to a
+subscribe, and the small notify_status_update messages sent while printing.
+
+Usage:
+    python benchmarks/codec_benchmark.py [--iterations N] [--json report.json]
+"""
+
+import sys
+import os
+import json
+import time
+import random
+import argparse
+
+# Add the root directory of your project to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from websocket_server import codec
+from benchmarks.payloads import moonraker_status, moonraker_update
+
+
+def get_codecs():
+    """Return the codecs to compare, always including the stdlib json baseline."""
+    codecs = {'json (stdlib)': codec.JsonCodec(use_orjson=False)}
+    if codec.orjson is not None:
+        codecs['json (orjson)'] = codec.JsonCodec()
+    if codec.msgpack is not None:
+        codecs['msgpack'] = codec.MsgpackCodec()
+    return codecs
+
+
+def get_messages():
+    """Return the benchmark messages, keyed by name."""
+    status = moonraker_status()
+    rng = random.Random(1)
+    return {
+        'snapshot': {"jsonrpc": "2.0", "result": {"status": status, "eventtime": 12345.678}, "id": 2},
+        'notify': {"jsonrpc": "2.0", "method": "notify_status_update",
+                   "params": [moonraker_update(rng, status), 12345.678]},
+    }
+
+
+def time_call(func, arg, iterations):
+    """Return the mean time of func(arg) in microseconds."""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func(arg)
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def run(iterations):
+    results = {}
+    for message_name, message in get_messages().items():
+        for codec_name, message_codec in get_codecs().items():
+            encoded = message_codec.encode(message)
+            results[f"{message_name}/{codec_name}"] = {
+                'bytes': len(encoded if isinstance(encoded, bytes) else encoded.encode()),
+                'encode_us': time_call(message_codec.encode, message, iterations),
+                'decode_us': time_call(message_codec.decode, encoded, iterations),
+            }
+    return results
+
+
+def print_results(results):
+    baselines = {}
+    print(f"{'message/codec':28} {'bytes':>7} {'encode us':>10} {'decode us':>10} {'speedup':>8}")
+    for name, result in results.items():
+        message_name = name.split('/')[0]
+        baseline = baselines.setdefault(message_name, result)
+        total = result['encode_us'] + result['decode_us']
+        speedup = (baseline['encode_us'] + baseline['decode_us']) / total
+        print(f"{name:28} {result['bytes']:7d} {result['encode_us']:10.2f} {result['decode_us']:10.2f} {speedup:7.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the websocket server codecs.')
+    parser.add_argument('-n', '--iterations', type=int, default=5000, help='Iterations per measurement')
+    parser.add_argument('--json', type=str, help='Write the results to this JSON file')
+    args = parser.parse_args()
+
+    results = run(args.iterations)
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+"""
+Fake Moonraker
+
+A stand-in for a printer's Moonraker websocket server, so SkylightServer and
+BaseWebSocketClient can be run, load tested and profiled without a printer.
+It answers printer.objects.subscribe, printer.objects.query,
+printer.objects.list and server.info the way Moonraker does: results carry
+{"eventtime", "status"}, and notify_status_update sends only the subscribed
+fields that changed, nested by object, as params [status, eventtime].
+
+The printer state is driven either by a recorded trace or by a synthetic
+print profile:
+
+    python benchmarks/fake_moonraker.py --profile print --speed 20
+    python benchmarks/fake_moonraker.py --profile heatup:60,printing:300,pause:30,cooldown:120 --speed 0 --loop
+    python benchmarks/fake_moonraker.py --trace moonraker_trace.jsonl --speed 5
+
+A trace is a JSON lines file of Moonraker messages, one per line. The
+notify_status_update messages and subscribe or query results in it are
+replayed with the spacing of their eventtimes. --speed divides the time
+between events, --speed 0 replays as fast as the server can send.
+
+The default port is Moonraker's 7125, which config/localhost.conf points
+skylight at.
+"""
+
+import sys
+import os
+import json
+import time
+import random
+import asyncio
+import argparse
+import functools
+
+# Add the root directory of your project to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from websocket_server import rpc
+from websocket_server.base_websocket_server import BaseWebSocketServer
+from websocket_server.rpc import RpcError
+from websocket_server.session import Subscription
+from websocket_server.update_dispatcher import merge_updates
+from benchmarks.payloads import moonraker_status
+
+# Simulated seconds of each phase when the profile does not give one
+PHASE_DURATIONS = {'standby': 10, 'heatup': 90, 'printing': 600, 'pause': 60, 'cooldown': 180}
+PROFILES = {
+    'print': 'standby,heatup,printing,pause,printing,cooldown',
+    'idle': 'standby:600',
+}
+ROOM_TEMPERATURE = 25.0
+PRINT_TEMPERATURE = 210.0
+
+
+def nest_status(params):
+    """Turn {'extruder.temperature': 210.0} style params into Moonraker's {'extruder': {'temperature': 210.0}}."""
+    status = {}
+    for path, value in params.items():
+        keys = path.split('.')
+        node = status
+        for key in keys[:-1]:
+            node = node.setdefault(key, {})
+        if isinstance(value, dict) and isinstance(node.get(keys[-1]), dict):
+            merge_updates(node[keys[-1]], value)
+        else:
+            node[keys[-1]] = value
+    return status
+
+
+def parse_profile(spec):
+    """Return [(phase, seconds)] for a profile name or a 'phase:seconds,phase' list."""
+    phases = []
+    for item in PROFILES.get(spec, spec).split(','):
+        name, _, seconds = item.strip().partition(':')
+        if name not in PHASE_DURATIONS:
+            raise ValueError(f"Unknown phase '{name}', expected one of {', '.join(PHASE_DURATIONS)}")
+        phases.append((name, float(seconds) if seconds else PHASE_DURATIONS[name]))
+    return phases
+
+
+class PrintSimulation:
+    """Generates the status changes of a printer going through print phases.
+
+    Each phase sets the print state and heater target, the extruder and bed
+    temperatures follow their targets with some noise, and progress grows
+    while printing. Only the fields that changed are put in an update.
+    """
+
+    def __init__(self, seed=0):
+        self.rng = random.Random(seed)
+        self.extruder = ROOM_TEMPERATURE
+        self.bed = ROOM_TEMPERATURE
+        self.progress = 0.0
+        self.print_duration = 0.0
+        self.last = {}
+
+    def initial_status(self):
+        """Return the full status of a cold, idle printer."""
+        status = moonraker_status()
+        merge_updates(status, self.phase_status('standby', 0.0))
+        self.last = {}
+        self.flatten(status, (), self.last)
+        return status
+
+    def events(self, phases, interval):
+        """Yield (eventtime, update) every interval simulated seconds through the phases."""
+        eventtime = 0.0
+        for phase, seconds in phases:
+            steps = max(1, int(seconds / interval))
+            for _ in range(steps):
+                eventtime += interval
+                self.step(phase, interval, seconds)
+                update = self.changed(self.phase_status(phase, eventtime))
+                if update:
+                    yield eventtime, update
+
+    def step(self, phase, interval, seconds):
+        extruder_target, bed_target = self.targets(phase)
+        self.extruder = self.approach(self.extruder, extruder_target, interval, 0.04 if extruder_target else 0.01)
+        self.bed = self.approach(self.bed, bed_target, interval, 0.02 if bed_target else 0.005)
+        if phase == 'printing':
+            self.print_duration += interval
+            self.progress = min(1.0, self.progress + interval / seconds / 2)
+        elif phase == 'standby':
+            self.progress = 0.0
+        elif phase == 'cooldown':
+            self.progress = 1.0
+
+    def approach(self, temperature, target, interval, rate):
+        """Move a temperature toward its target, with sensor noise once it is there."""
+        target = target or ROOM_TEMPERATURE
+        temperature += (target - temperature) * min(1.0, rate * interval * 4)
+        return temperature + self.rng.uniform(-0.3, 0.3)
+
+    def targets(self, phase):
+        if phase in ('heatup', 'printing', 'pause'):
+            return PRINT_TEMPERATURE, 60.0
+        return 0.0, 0.0
+
+    def phase_status(self, phase, eventtime):
+        extruder_target, bed_target = self.targets(phase)
+        printing = phase in ('heatup', 'printing')
+        status = {
+            "extruder": {"temperature": round(self.extruder, 2), "target": extruder_target,
+                         "power": round(self.rng.random(), 2) if extruder_target else 0.0},
+            "heater_bed": {"temperature": round(self.bed, 2), "target": bed_target},
+            "display_status": {"progress": round(self.progress, 3)},
+            "virtual_sdcard": {"progress": round(self.progress, 3), "is_active": printing},
+            "idle_timeout": {"state": "Printing" if printing else "Ready" if phase == 'pause' else "Idle"},
+            "pause_resume": {"is_paused": phase == 'pause'},
+            "print_stats": {"state": {'standby': 'standby', 'pause': 'paused', 'cooldown': 'complete'}.get(
+                phase, 'printing'), "print_duration": round(self.print_duration, 1)},
+        }
+        if phase == 'printing':
+            status["motion_report"] = {
+                "live_position": [round(self.rng.uniform(-100, 100), 3) for _ in range(3)] + [0.0],
+                "live_velocity": round(self.rng.uniform(0, 300), 2),
+            }
+        return status
+
+    def changed(self, status):
+        """Return the parts of status that differ from what was last reported, and remember them."""
+        leaves = {}
+        self.flatten(status, (), leaves)
+        update = {}
+        for key, value in leaves.items():
+            if self.last.get(key) != value:
+                self.last[key] = value
+                node = update
+                for sub_key in key[:-1]:
+                    node = node.setdefault(sub_key, {})
+                node[key[-1]] = value
+        return update
+
+    def flatten(self, value, key, leaves):
+        if isinstance(value, dict) and value:
+            for sub_key, sub_value in value.items():
+                self.flatten(sub_value, key + (sub_key,), leaves)
+        else:
+            leaves[key] = value
+
+
+def read_trace(path):
+    """Yield (eventtime, status) from a JSON lines trace of Moonraker messages."""
+    eventtime = 0.0
+    with open(path) as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            data = json.loads(line)
+            if data.get('method') == 'notify_status_update':
+                params = data.get('params', [])
+                status = params[0] if params else {}
+                eventtime = params[1] if len(params) > 1 else eventtime
+            elif isinstance(data.get('result'), dict) and 'status' in data['result']:
+                status = data['result']['status']
+                eventtime = data['result'].get('eventtime', eventtime)
+            else:
+                continue
+            yield eventtime, status
+
+
+class FakeMoonrakerServer(BaseWebSocketServer):
+    """BaseWebSocketServer speaking Moonraker's printer.objects protocol and replaying printer activity."""
+
+    def __init__(self, host='127.0.0.1', port=7125, speed=1.0, interval=0.25, profile='print', trace=None,
+                 loop=False, seed=0, debug=False, profiler=False):
+        BaseWebSocketServer.__init__(self, host, port, debug, profiler=profiler)
+        self.speed = speed
+        self.interval = interval
+        self.phases = parse_profile(profile) if trace is None else None
+        self.trace = trace
+        self.loop_playback = loop
+        self.seed = seed
+        self.playback = None
+        self.current_state = PrintSimulation(seed).initial_status()
+
+    def register_methods(self):
+        self.register_method('printer.objects.subscribe', self.handle_objects_subscribe)
+        self.register_method('printer.objects.query', self.handle_objects_query)
+        self.register_method('printer.objects.list', self.handle_objects_list)
+        self.register_method('server.info', self.handle_server_info)
+
+    async def handle_objects_subscribe(self, request, ws, batch):
+        """Subscribe the connection to objects, replacing its earlier subscription as Moonraker does."""
+        paths = self.get_object_paths(request)
+        session = self.sessions[ws]
+        for subscription in list(session.subscriptions.values()):
+            self.remove_subscription(subscription)
+        subscription = Subscription(session, request.get('id'), paths, delta=True)
+        self.add_subscription(subscription)
+        subscription.last_sent = self.get_leaf_snapshot(paths)
+        return {"eventtime": time.monotonic(), "status": nest_status(self.extract_state_params(paths))}
+
+    async def handle_objects_query(self, request, ws, batch):
+        return {"eventtime": time.monotonic(), "status": nest_status(self.extract_state_params(
+            self.get_object_paths(request)))}
+
+    async def handle_objects_list(self, request, ws, batch):
+        return {"objects": sorted(self.current_state)}
+
+    async def handle_server_info(self, request, ws, batch):
+        return {"klippy_connected": True, "klippy_state": "ready", "components": [], "failed_components": [],
+                "moonraker_version": "fake"}
+
+    def get_object_paths(self, request):
+        objects = self.get_params(request).get('objects', {})
+        if not isinstance(objects, dict):
+            raise RpcError(rpc.INVALID_PARAMS, 'Invalid params', 'objects must be an object')
+        return frozenset(self.get_all_paths(objects))
+
+    async def notify_subscriber(self, subscription, eventtime, encoded_params=None, full=False):
+        """Send the subscribed fields that changed since the last notification, in Moonraker's format.
+
+        Subscribers with the same changed fields share one encoded message.
+        Like Moonraker's, the eventtime is monotonic rather than wall clock.
+        """
+        snapshot = self.get_leaf_snapshot(subscription.paths)
+        last_sent = None if full else subscription.last_sent
+        changed = frozenset(snapshot) if last_sent is None else self.get_changed_leaves(last_sent, snapshot)
+        if not changed:
+            return
+        if encoded_params is None:
+            encoded_params = {}
+        message = encoded_params.get(changed)
+        if message is None:
+            status = nest_status(self.build_delta_params(changed, snapshot))
+            message = encoded_params[changed] = json.dumps(
+                {"jsonrpc": "2.0", "method": "notify_status_update", "params": [status, time.monotonic()]})
+        self.messages_out.inc(method='notify_status_update')
+        await self.send_message(subscription.session.ws, message, key=subscription,
+                                on_sent=functools.partial(self.update_last_sent_state, subscription, snapshot))
+
+    def events(self):
+        if self.trace is not None:
+            return read_trace(self.trace)
+        simulation = PrintSimulation(self.seed)
+        self.current_state = simulation.initial_status()
+        return simulation.events(self.phases, self.interval)
+
+    async def play(self):
+        """Apply the trace or profile events to the state, paced by speed."""
+        while True:
+            start = time.monotonic()
+            first = None
+            count = 0
+            for eventtime, update in self.events():
+                if first is None:
+                    first = eventtime
+                if self.speed > 0:
+                    delay = start + (eventtime - first) / self.speed - time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                else:
+                    await asyncio.sleep(0)
+                await self.schedule_broadcast(update)
+                count += 1
+            elapsed = time.monotonic() - start
+            print(f"Played {count} events covering {(eventtime - first) if count else 0:.0f} seconds "
+                  f"in {elapsed:.1f} seconds to {len(self.subscription_index)} subscribers")
+            if not self.loop_playback:
+                break
+
+    async def start_background_tasks(self, app):
+        await BaseWebSocketServer.start_background_tasks(self, app)
+        self.playback = asyncio.ensure_future(self.play())
+
+    async def cleanup_background_tasks(self, app):
+        if self.playback is not None:
+            self.playback.cancel()
+        await BaseWebSocketServer.cleanup_background_tasks(self, app)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a fake Moonraker that replays a trace or print profile.')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=7125, help='Port to listen on')
+    parser.add_argument('--trace', type=str, help='JSON lines file of Moonraker messages to replay')
+    parser.add_argument('--profile', type=str, default='print',
+                        help=f"Profile name ({', '.join(PROFILES)}) or phases like heatup:60,printing:300 "
+                             f"from {', '.join(PHASE_DURATIONS)}")
+    parser.add_argument('--speed', type=float, default=1.0, help='Playback speed, 0 for as fast as possible')
+    parser.add_argument('--interval', type=float, default=0.25, help='Simulated seconds between profile updates')
+    parser.add_argument('--loop', action='store_true', help='Start over when the playback ends')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the profile simulation')
+    parser.add_argument('--profiler', action='store_true', help='Serve /debug/profile')
+    parser.add_argument('--debug', action='store_true', help='Print every request and notification')
+    args = parser.parse_args()
+
+    try:
+        server = FakeMoonrakerServer(args.host, args.port, args.speed, args.interval, args.profile, args.trace,
+                                     args.loop, args.seed, args.debug, args.profiler)
+    except ValueError as e:
+        parser.error(str(e))
+    print(f"Fake Moonraker listening on ws://{args.host}:{args.port}/websocket")
+    server.start()
+
+
+if __name__ == "__main__":
+    main()
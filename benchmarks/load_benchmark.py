@@ -0,0 +1,230 @@
+"""
+Load Benchmark
+
+Starts a BaseWebSocketServer in a child process on localhost, attaches N
+synthetic subscribers with Mainsail-like path sets and drives M updates per
+second through printer.objects.update. Every update carries a timestamp,
+so each subscriber can measure the end-to-end notify latency.
+
+The report holds latency percentiles, notification throughput, and the
+server's CPU use and resident memory. It is written as JSON so that runs
+can be compared:
+
+    python benchmarks/load_benchmark.py -n 50 -r 50 -t 10 --report after.json --compare before.json
+
+No outside services are needed. CPU and RSS are read from /proc and are only
+reported on Linux.
+"""
+
+import sys
+import os
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import multiprocessing
+
+# Add the root directory of your project to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import aiohttp
+from websocket_server import codec
+from websocket_server.base_websocket_server import BaseWebSocketServer
+from benchmarks.payloads import moonraker_status, moonraker_update, moonraker_subscription
+
+# Metrics where a larger value is a regression, and those where a smaller one is
+LOWER_IS_BETTER = ('latency_p50_ms', 'latency_p99_ms', 'server_cpu_percent', 'server_rss_mb')
+HIGHER_IS_BETTER = ('notifications_per_second',)
+
+
+def run_server(port, coalesce_interval):
+    server = BaseWebSocketServer(host='127.0.0.1', port=port, coalesce_interval=coalesce_interval)
+    server.current_state = dict(moonraker_status(), bench={"sent": 0.0, "seq": 0})
+    server.running = True
+    server.start()
+
+
+def read_process_stats(pid):
+    """Return (cpu seconds, rss bytes) of a process from /proc, or (None, None)."""
+    try:
+        with open(f'/proc/{pid}/stat') as file:
+            fields = file.read().rsplit(')', 1)[1].split()
+        with open(f'/proc/{pid}/statm') as file:
+            rss_pages = int(file.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None, None
+    ticks = os.sysconf('SC_CLK_TCK')
+    cpu = (int(fields[11]) + int(fields[12])) / ticks
+    return cpu, rss_pages * os.sysconf('SC_PAGE_SIZE')
+
+
+def subscription_objects(rng):
+    """Return a random but realistic subset of a Mainsail subscription, always including the timestamp."""
+    objects = moonraker_subscription()
+    keep = rng.sample(sorted(objects), rng.randint(2, len(objects)))
+    selected = {name: objects[name] for name in keep}
+    selected["bench"] = ["sent"]
+    return selected
+
+
+async def wait_for_server(url, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(url):
+                    return
+            except aiohttp.ClientError:
+                await asyncio.sleep(0.1)
+    raise RuntimeError(f"Server at {url} did not start")
+
+
+async def subscriber(session, url, index, args, latencies, stop):
+    rng = random.Random(index)
+    protocols = (args.codec,) if args.codec != 'json' else ()
+    sub_codec = codec.get_codec(args.codec)
+    async with session.ws_connect(url, protocols=protocols, max_msg_size=0) as ws:
+        request = {"jsonrpc": "2.0", "method": "printer.objects.subscribe", "id": index,
+                   "params": {"objects": subscription_objects(rng), "delta": args.delta}}
+        if args.max_rate:
+            request["params"]["max_rate"] = args.max_rate
+        if sub_codec.binary:
+            await ws.send_bytes(sub_codec.encode(request))
+        else:
+            await ws.send_str(sub_codec.encode(request))
+        while not stop.is_set():
+            try:
+                msg = await ws.receive(timeout=0.5)
+            except asyncio.TimeoutError:
+                continue
+            if msg.type not in (aiohttp.WSMsgType.TEXT, aiohttp.WSMsgType.BINARY):
+                break
+            received = time.monotonic()
+            data = sub_codec.decode(msg.data)
+            if data.get('method') != 'notify_status_update':
+                continue
+            sent = data['params'][0].get('bench.sent')
+            if sent:
+                latencies.append(received - sent)
+
+
+async def driver(session, url, args, counts, stop):
+    rng = random.Random(0)
+    status = moonraker_status()
+    interval = 1.0 / args.rate
+    async with session.ws_connect(url) as ws:
+        next_time = time.monotonic()
+        seq = 0
+        while not stop.is_set():
+            seq += 1
+            update = moonraker_update(rng, status)
+            update["bench"] = {"sent": time.monotonic(), "seq": seq}
+            # Sent as a notification, without an id, so the server sends no response
+            await ws.send_str(json.dumps({"jsonrpc": "2.0", "method": "printer.objects.update", "params": update}))
+            counts['updates'] += 1
+            next_time += interval
+            await asyncio.sleep(max(0.0, next_time - time.monotonic()))
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+async def run_load(args, server_pid):
+    url = f'http://127.0.0.1:{args.port}/websocket'
+    await wait_for_server(f'http://127.0.0.1:{args.port}/metrics')
+    latencies = []
+    counts = {'updates': 0}
+    stop = asyncio.Event()
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        tasks = [asyncio.create_task(subscriber(session, url, i, args, latencies, stop))
+                 for i in range(args.subscribers)]
+        await asyncio.sleep(args.warmup)
+        latencies.clear()
+        cpu_start, _ = read_process_stats(server_pid)
+        start = time.monotonic()
+        driver_task = asyncio.create_task(driver(session, url, args, counts, stop))
+        await asyncio.sleep(args.duration)
+        stop.set()
+        elapsed = time.monotonic() - start
+        cpu_end, rss = read_process_stats(server_pid)
+        await asyncio.gather(driver_task, *tasks, return_exceptions=True)
+
+    def ms(value):
+        return round(value * 1000, 3) if value is not None else None
+
+    return {
+        'config': {key: value for key, value in vars(args).items() if key not in ('report', 'compare')},
+        'python': platform.python_version(),
+        'codec_backend': codec.get_codec(args.codec).backend,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'updates_sent': counts['updates'],
+        'notifications': len(latencies),
+        'notifications_per_second': round(len(latencies) / elapsed, 1),
+        'latency_p50_ms': ms(percentile(latencies, 0.50)),
+        'latency_p90_ms': ms(percentile(latencies, 0.90)),
+        'latency_p99_ms': ms(percentile(latencies, 0.99)),
+        'latency_max_ms': ms(max(latencies) if latencies else None),
+        'server_cpu_percent': round((cpu_end - cpu_start) / elapsed * 100, 1) if cpu_start is not None else None,
+        'server_rss_mb': round(rss / 2 ** 20, 1) if rss is not None else None,
+    }
+
+
+def compare(report, baseline, threshold):
+    """Print the change of each metric against a baseline report and return the regressions."""
+    regressions = []
+    print(f"{'metric':28} {'baseline':>10} {'current':>10} {'change':>8}")
+    for key in LOWER_IS_BETTER + HIGHER_IS_BETTER:
+        old, new = baseline.get(key), report.get(key)
+        if not old or new is None:
+            continue
+        change = (new - old) / old * 100
+        worse = change > threshold if key in LOWER_IS_BETTER else change < -threshold
+        if worse:
+            regressions.append(key)
+        print(f"{key:28} {old:10} {new:10} {change:+7.1f}%{'  REGRESSION' if worse else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load-test BaseWebSocketServer on localhost.')
+    parser.add_argument('-n', '--subscribers', type=int, default=50, help='Number of subscribers')
+    parser.add_argument('-r', '--rate', type=float, default=50, help='Updates per second')
+    parser.add_argument('-t', '--duration', type=float, default=10, help='Measurement duration in seconds')
+    parser.add_argument('--warmup', type=float, default=1.0, help='Seconds to wait after subscribing')
+    parser.add_argument('--port', type=int, default=7199, help='Port for the benchmark server')
+    parser.add_argument('--codec', choices=sorted(codec.codecs), default='json', help='Wire codec of the subscribers')
+    parser.add_argument('--delta', action='store_true', help='Subscribe in delta mode')
+    parser.add_argument('--max-rate', type=float, help='Per-subscriber max_rate')
+    parser.add_argument('--coalesce', type=float, default=0.0, help='Server coalesce_interval in seconds')
+    parser.add_argument('--report', type=str, help='Write the JSON report to this file')
+    parser.add_argument('--compare', type=str, help='Compare against this baseline JSON report')
+    parser.add_argument('--threshold', type=float, default=10.0, help='Allowed regression in percent')
+    args = parser.parse_args()
+
+    server = multiprocessing.Process(target=run_server, args=(args.port, args.coalesce), daemon=True)
+    server.start()
+    try:
+        report = asyncio.run(run_load(args, server.pid))
+    finally:
+        server.terminate()
+        server.join()
+
+    print(json.dumps(report, indent=2))
+    if args.report:
+        with open(args.report, 'w') as file:
+            json.dump(report, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(report, json.load(file), args.threshold)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Synthetic Moonraker-shaped status payloads used by the benchmarks.
+
+The shapes follow what printer.objects.subscribe returns for a typical
+Klipper printer: a handful of heaters and fans, toolhead and motion data,
+print statistics and a few nested configuration style objects.
+"""
+
+import random
+
+
+def moonraker_status(seed=0, fans=3, sensors=4):
+    """Return a full printer status dictionary as sent in a subscribe response."""
+    rng = random.Random(seed)
+    status = {
+        "webhooks": {"state": "ready", "state_message": "Printer is ready"},
+        "print_stats": {
+            "filename": "deltamaker_calibration_cube.gcode",
+            "total_duration": rng.uniform(0, 20000),
+            "print_duration": rng.uniform(0, 20000),
+            "filament_used": rng.uniform(0, 5000),
+            "state": "printing",
+            "message": "",
+            "info": {"total_layer": 240, "current_layer": rng.randint(0, 240)},
+        },
+        "display_status": {"progress": rng.random(), "message": None},
+        "idle_timeout": {"state": "Printing", "printing_time": rng.uniform(0, 20000)},
+        "pause_resume": {"is_paused": False},
+        "virtual_sdcard": {
+            "file_path": "/home/pi/printer_data/gcodes/deltamaker_calibration_cube.gcode",
+            "progress": rng.random(),
+            "is_active": True,
+            "file_position": rng.randint(0, 10 ** 7),
+            "file_size": 10 ** 7,
+        },
+        "extruder": {
+            "temperature": rng.uniform(200, 215),
+            "target": 210.0,
+            "power": rng.random(),
+            "can_extrude": True,
+            "pressure_advance": 0.04,
+            "smooth_time": 0.04,
+        },
+        "heater_bed": {"temperature": rng.uniform(55, 65), "target": 60.0, "power": rng.random()},
+        "toolhead": {
+            "homed_axes": "xyz",
+            "print_time": rng.uniform(0, 20000),
+            "estimated_print_time": rng.uniform(0, 20000),
+            "extruder": "extruder",
+            "position": [rng.uniform(-100, 100) for _ in range(4)],
+            "max_velocity": 300.0,
+            "max_accel": 3000.0,
+            "max_accel_to_decel": 1500.0,
+            "square_corner_velocity": 5.0,
+        },
+        "gcode_move": {
+            "speed_factor": 1.0,
+            "speed": 3000.0,
+            "extrude_factor": 1.0,
+            "absolute_coordinates": True,
+            "absolute_extrude": False,
+            "homing_origin": [0.0, 0.0, 0.0, 0.0],
+            "position": [rng.uniform(-100, 100) for _ in range(4)],
+            "gcode_position": [rng.uniform(-100, 100) for _ in range(4)],
+        },
+        "motion_report": {
+            "live_position": [rng.uniform(-100, 100) for _ in range(4)],
+            "live_velocity": rng.uniform(0, 300),
+            "live_extruder_velocity": rng.uniform(0, 10),
+        },
+        "system_stats": {"sysload": rng.uniform(0, 4), "cputime": rng.uniform(0, 10 ** 5), "memavail": 700000},
+    }
+    for i in range(fans):
+        status[f"heater_fan fan{i}"] = {"speed": rng.random(), "rpm": rng.uniform(0, 6000)}
+    for i in range(sensors):
+        status[f"temperature_sensor sensor{i}"] = {
+            "temperature": rng.uniform(20, 60), "measured_min_temp": 18.0, "measured_max_temp": 65.0}
+    return status
+
+
+def moonraker_update(rng, status):
+    """Return a small notify_status_update style change, as sent while printing."""
+    update = {
+        "extruder": {"temperature": round(status["extruder"]["target"] + rng.uniform(-0.5, 0.5), 2)},
+        "motion_report": {
+            "live_position": [rng.uniform(-100, 100) for _ in range(4)],
+            "live_velocity": rng.uniform(0, 300),
+        },
+    }
+    if rng.random() < 0.3:
+        update["heater_bed"] = {"temperature": round(rng.uniform(59.5, 60.5), 2)}
+    if rng.random() < 0.1:
+        update["display_status"] = {"progress": rng.random()}
+    return update
+
+
+def moonraker_subscription():
+    """Return the objects parameter of a Mainsail-like printer.objects.subscribe request."""
+    return {
+        "webhooks": None,
+        "print_stats": None,
+        "display_status": ["progress"],
+        "idle_timeout": ["state"],
+        "pause_resume": ["is_paused"],
+        "virtual_sdcard": ["progress", "is_active"],
+        "extruder": ["temperature", "target", "power"],
+        "heater_bed": ["temperature", "target", "power"],
+        "toolhead": ["homed_axes", "position"],
+        "motion_report": ["live_position", "live_velocity"],
+    }
@@ -0,0 +1,250 @@
+"""
+Replay Traffic
+
+Reads a websocket traffic log written by TrafficRecorder (the record_path
+option of skylight, or the recorder argument of BaseWebSocketServer and
+BaseWebSocketClient) and summarizes, dumps or replays it:
+
+    python benchmarks/replay_traffic.py skylight.rec
+    python benchmarks/replay_traffic.py skylight.rec --dump
+    python benchmarks/replay_traffic.py skylight.rec --server ws://127.0.0.1:7120/websocket --speed 10
+    python benchmarks/replay_traffic.py skylight.rec --client-port 7125 --connection moonraker
+
+A connection is one session between an OPEN record and the next OPEN of
+the same name, so a client that reconnected, or a server whose connection
+names repeat after a restart, gives several connections (name, session).
+
+--server opens one websocket per recorded connection, at the time the
+connection was opened, and sends the messages that went to the server on it.
+--client-port serves the messages that went to a client, one recorded
+connection per client that connects, in the order they were opened and
+timed from when the client connected, so a BaseWebSocketClient pointed at
+that port sees the recorded Moonraker traffic. Replay is open loop: what the
+peer sends back is counted but does not change what is sent.
+
+--speed divides the recorded time between messages, --speed 0 sends them as
+fast as possible. The lateness printed at the end is how far sends fell
+behind the recorded schedule.
+"""
+
+import sys
+import os
+import json
+import time
+import asyncio
+import argparse
+import itertools
+from collections import defaultdict
+
+# Add the root directory of your project to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import aiohttp
+from aiohttp import web
+from websocket_server import codec
+from websocket_server.traffic_recorder import read_records, START, INBOUND, OUTBOUND, OPEN, CLOSE, KIND_NAMES
+
+
+def load_connections(path, names=None):
+    """Return {(name, session): {'role', 'opened', 'to_server', 'to_client'}} with message lists of (time, payload).
+
+    Every OPEN record starts a new session of its connection name, and a
+    START record, written when a process began recording, ends them all.
+    """
+    connections = {}
+    current = {}
+    sessions = defaultdict(int)
+    for timestamp, kind, name, payload in read_records(path):
+        if kind == START:
+            current.clear()
+            continue
+        if names and name not in names:
+            continue
+        if kind == OPEN:
+            sessions[name] += 1
+            current[name] = (name, sessions[name])
+        key = current.get(name)
+        if key is None:
+            # Messages without an OPEN record before them
+            key = current[name] = (name, sessions[name])
+        connection = connections.get(key)
+        if connection is None:
+            connection = connections[key] = {'role': 'server', 'opened': timestamp, 'to_server': [],
+                                             'to_client': []}
+        if kind == OPEN:
+            connection['role'] = payload
+        elif kind == CLOSE:
+            current.pop(name, None)
+        elif kind in (INBOUND, OUTBOUND):
+            # A server receives what clients send, a client sends what servers receive
+            to_server = (kind == INBOUND) == (connection['role'] == 'server')
+            connection['to_server' if to_server else 'to_client'].append((timestamp, payload))
+    return connections
+
+
+def summarize(path):
+    """Print message counts, bytes, rates and the longest gaps per connection."""
+    stats = defaultdict(lambda: {'in': 0, 'out': 0, 'bytes': 0, 'first': None, 'last': None, 'max_gap': 0.0,
+                                 'opens': 0, 'per_second': defaultdict(int)})
+    starts = []
+    for timestamp, kind, name, payload in read_records(path):
+        if kind == START:
+            starts.append(json.loads(payload))
+            continue
+        entry = stats[name]
+        if kind == OPEN:
+            entry['opens'] += 1
+            continue
+        if kind == CLOSE:
+            continue
+        entry[KIND_NAMES[kind]] += 1
+        entry['bytes'] += len(payload)
+        if entry['last'] is not None:
+            entry['max_gap'] = max(entry['max_gap'], timestamp - entry['last'])
+        if entry['first'] is None:
+            entry['first'] = timestamp
+        entry['last'] = timestamp
+        entry['per_second'][int(timestamp)] += 1
+    for start in starts:
+        print(f"Recording started {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start['wall_time']))} "
+              f"by pid {start['pid']}")
+    print(f"{'connection':24} {'opens':>5} {'in':>8} {'out':>8} {'MB':>8} {'seconds':>9} {'peak/s':>7} "
+          f"{'max gap s':>9}")
+    for name, entry in sorted(stats.items()):
+        duration = (entry['last'] - entry['first']) if entry['first'] is not None else 0.0
+        peak = max(entry['per_second'].values(), default=0)
+        print(f"{name:24} {entry['opens']:5} {entry['in']:8} {entry['out']:8} {entry['bytes'] / 1e6:8.2f} "
+              f"{duration:9.1f} {peak:7} {entry['max_gap']:9.2f}")
+
+
+def dump(path):
+    """Print every record with its time relative to the first one."""
+    first = None
+    for timestamp, kind, name, payload in read_records(path):
+        if first is None:
+            first = timestamp
+        if isinstance(payload, bytes):
+            payload = f"<{len(payload)} bytes>"
+        print(f"{timestamp - first:12.6f} {KIND_NAMES.get(kind, kind):5} {name:24} {payload}")
+
+
+class Replayer:
+    """Sends recorded messages on the schedule they were recorded with, scaled by speed."""
+
+    def __init__(self, speed=1.0):
+        self.speed = speed
+        self.sent = 0
+        self.received = 0
+        self.max_late = 0.0
+
+    async def wait_until(self, start, offset):
+        """Sleep until offset recorded seconds after start."""
+        if self.speed <= 0:
+            await asyncio.sleep(0)
+            return
+        delay = start + offset / self.speed - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            self.max_late = max(self.max_late, -delay)
+
+    async def send(self, ws, messages, start, origin):
+        for timestamp, payload in messages:
+            await self.wait_until(start, timestamp - origin)
+            if isinstance(payload, bytes):
+                await ws.send_bytes(payload)
+            else:
+                await ws.send_str(payload)
+            self.sent += 1
+
+    async def drain(self, ws):
+        async for msg in ws:
+            if msg.type in (aiohttp.WSMsgType.TEXT, aiohttp.WSMsgType.BINARY):
+                self.received += 1
+
+    async def feed_server(self, uri, connections, linger=1.0):
+        """Replay every connection's messages to the server at uri."""
+        if not connections:
+            print("The log holds no connections")
+            return
+        origin = min(connection['opened'] for connection in connections.values())
+        start = time.monotonic()
+        async with aiohttp.ClientSession() as session:
+            await asyncio.gather(*[self.feed_connection(session, uri, connection, start, origin, linger)
+                                   for connection in connections.values() if connection['to_server']])
+
+    async def feed_connection(self, session, uri, connection, start, origin, linger):
+        messages = connection['to_server']
+        protocols = tuple(name for name, ws_codec in codec.codecs.items() if ws_codec.binary) \
+            if any(isinstance(payload, bytes) for _, payload in messages) else ()
+        await self.wait_until(start, connection['opened'] - origin)
+        async with session.ws_connect(uri, protocols=protocols) as ws:
+            reader = asyncio.ensure_future(self.drain(ws))
+            await self.send(ws, messages, start, origin)
+            await asyncio.sleep(linger)
+            reader.cancel()
+
+    async def serve_clients(self, host, port, connections):
+        """Serve the messages that went to clients on port, the next recorded connection to each new client."""
+        sessions = sorted(((key, connection) for key, connection in connections.items() if connection['to_client']),
+                          key=lambda item: item[1]['opened'])
+        if not sessions:
+            print("The log holds no messages sent to a client")
+            return
+        served = itertools.count()
+
+        async def handle(request):
+            ws = web.WebSocketResponse()
+            await ws.prepare(request)
+            (name, session), connection = sessions[next(served) % len(sessions)]
+            messages = connection['to_client']
+            print(f"Replaying {len(messages)} messages of {name} session {session} to {request.remote}")
+            reader = asyncio.ensure_future(self.drain(ws))
+            await self.send(ws, messages, time.monotonic(), connection['opened'])
+            self.report()
+            await reader
+            return ws
+
+        app = web.Application()
+        app.router.add_get('/websocket', handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host=host, port=port).start()
+        print(f"Waiting for clients on ws://{host}:{port}/websocket")
+        while True:
+            await asyncio.sleep(3600)
+
+    def report(self):
+        print(f"Sent {self.sent} messages, received {self.received}, at most {self.max_late * 1000:.1f} ms late")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarize, dump or replay a websocket traffic log.')
+    parser.add_argument('log', type=str, help='Traffic log written by TrafficRecorder')
+    parser.add_argument('--dump', action='store_true', help='Print every record')
+    parser.add_argument('--server', type=str, help='Replay the messages sent to servers to this websocket URI')
+    parser.add_argument('--client-port', type=int, help='Replay the messages sent to clients on this port')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to serve clients on')
+    parser.add_argument('--connection', action='append', help='Only replay this connection name, repeatable')
+    parser.add_argument('--speed', type=float, default=1.0, help='Playback speed, 0 for as fast as possible')
+    args = parser.parse_args()
+
+    if args.dump:
+        dump(args.log)
+        return
+    if not args.server and args.client_port is None:
+        summarize(args.log)
+        return
+    connections = load_connections(args.log, args.connection)
+    replayer = Replayer(args.speed)
+    try:
+        if args.server:
+            asyncio.run(replayer.feed_server(args.server, connections))
+            replayer.report()
+        else:
+            asyncio.run(replayer.serve_clients(args.host, args.client_port, connections))
+    except KeyboardInterrupt:
+        replayer.report()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+"""
+State Benchmark
+
+Micro-benchmarks for the state layer shared by BaseWebSocketServer and
+BaseWebSocketClient. The deep_compare/deep_update pair these started from is
+now StateStore.update, so that is what the update cases measure.
+
+Every primitive runs against synthetic state trees of several depths and
+widths, and against the Moonraker status payload from benchmarks/payloads.py:
+  - update       StateStore.update with a few changed leaves
+  - update_noop  StateStore.update with values that are already current
+  - get          StateStore.get of a dotted leaf path
+  - get_state    BaseWebSocketServer.get_state and BaseWebSocketClient.get_state
+  - nested_value BaseWebSocketServer.get_nested_value with a key tuple
+  - all_paths    BaseWebSocketServer.get_all_paths of a subscription
+  - snapshot     get_leaf_snapshot and get_changed_leaves of a delta subscriber
+  - match        SubscriptionIndex.match with 50 subscribers
+
+Results can be saved as a baseline and later runs compared against it:
+
+    python benchmarks/state_benchmark.py --save-baseline benchmarks/baselines/state_benchmark.json
+    python benchmarks/state_benchmark.py --compare benchmarks/baselines/state_benchmark.json --threshold 25
+
+The comparison exits non-zero when a case got slower by more than the
+threshold. Each run times a fixed calibration workload before every tree
+and cases are compared relative to the median of those timings. Cases
+that look slower are timed --reruns more times, and a case regresses when
+the median of its changes over all runs is above the threshold. A saved
+baseline holds the median of as many runs. Baselines are still best
+compared on the machine that recorded them.
+"""
+
+import sys
+import os
+import json
+import time
+import random
+import timeit
+import argparse
+import platform
+import statistics
+
+# Add the root directory of your project to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from websocket_server.state_store import StateStore
+from websocket_server.subscription_index import SubscriptionIndex
+from websocket_server.base_websocket_server import BaseWebSocketServer
+from websocket_server.base_websocket_client import BaseWebSocketClient
+from benchmarks.payloads import moonraker_status, moonraker_update, moonraker_subscription
+
+# (depth, width) of the synthetic trees
+TREE_SHAPES = ((2, 8), (3, 16), (4, 4), (6, 3))
+
+
+def synthetic_tree(depth, width, rng):
+    """Return a nested dict with width keys per level and numeric leaves at depth."""
+    if depth == 0:
+        return rng.random()
+    return {f"k{i}": synthetic_tree(depth - 1, width, rng) for i in range(width)}
+
+
+def leaf_paths(tree, parent=()):
+    """Return the key tuples of all leaves of a tree."""
+    paths = []
+    for key, value in tree.items():
+        if isinstance(value, dict):
+            paths.extend(leaf_paths(value, parent + (key,)))
+        else:
+            paths.append(parent + (key,))
+    return paths
+
+
+def nested_update(paths, value):
+    """Return an update dict setting every key tuple in paths to value."""
+    update = {}
+    for path in paths:
+        node = update
+        for key in path[:-1]:
+            node = node.setdefault(key, {})
+        node[path[-1]] = value
+    return update
+
+
+def get_trees():
+    """Return the state trees to benchmark, with the updates and subscription to use on each."""
+    rng = random.Random(0)
+    trees = {}
+    for depth, width in TREE_SHAPES:
+        state = synthetic_tree(depth, width, rng)
+        paths = leaf_paths(state)
+        changed = rng.sample(paths, min(4, len(paths)))
+        objects = {key: None for key in list(state)[:max(1, width // 2)]}
+        trees[f"tree {depth}x{width}"] = (state, [nested_update(changed, 1.0), nested_update(changed, 2.0)],
+                                         changed[0], objects)
+    status = moonraker_status()
+    update_rng = random.Random(1)
+    updates = [moonraker_update(update_rng, status) for _ in range(2)]
+    trees["moonraker"] = (status, updates, ("extruder", "temperature"), moonraker_subscription())
+    return trees
+
+
+def time_case(func, number, repeat):
+    """Return the best mean time of func() in microseconds."""
+    return min(timeit.Timer(func).repeat(repeat, number)) / number * 1e6
+
+
+def calibration():
+    """Plain dict and tuple work used to normalize results between runs."""
+    data = {i: (i, str(i)) for i in range(64)}
+    return sum(len(value[1]) for key, value in data.items() if key in data)
+
+
+def run(number, repeat, only=None):
+    """Time every case, or only the case names in only, and the calibration before each tree."""
+    server = BaseWebSocketServer()
+    client = BaseWebSocketClient([], {}, debug=False)
+    results = {}
+    calibrations = []
+    for name, (state, updates, leaf, objects) in get_trees().items():
+        if only is not None and not any(case.startswith(name + '/') for case in only):
+            continue
+        calibrations.append(time_case(calibration, number, repeat))
+        dotted = '.'.join(leaf)
+        store = StateStore(json.loads(json.dumps(state)))
+        noop_store = StateStore(json.loads(json.dumps(state)))
+        noop_store.update(updates[0])
+        server.current_state = json.loads(json.dumps(state))
+        client.current_state = json.loads(json.dumps(state))
+        store.update(updates[0])
+        calls = iter(range(sys.maxsize))
+
+        requested_paths = frozenset(server.get_all_paths(objects))
+        last_sent = server.get_leaf_snapshot(requested_paths)
+        index = SubscriptionIndex()
+        for i in range(50):
+            index.add(i, requested_paths)
+
+        cases = {
+            'update': lambda: store.update(updates[next(calls) % 2]),
+            'update_noop': lambda: noop_store.update(updates[0]),
+            'get': lambda: store.get(dotted),
+            'get_state/server': lambda: server.get_state(dotted),
+            'get_state/client': lambda: client.get_state(dotted),
+            'nested_value': lambda: server.get_nested_value(server.current_state, leaf),
+            'all_paths': lambda: server.get_all_paths(objects),
+            'snapshot': lambda: server.get_changed_leaves(last_sent, server.get_leaf_snapshot(requested_paths)),
+            'match': lambda: index.match([leaf]),
+        }
+        for case_name, func in cases.items():
+            if only is None or f"{name}/{case_name}" in only:
+                results[f"{name}/{case_name}"] = round(time_case(func, number, repeat), 3)
+    results['calibration'] = round(statistics.median(calibrations), 3) if calibrations else 0.0
+    return results
+
+
+def changes(results, baseline):
+    """Return {case: change in percent} against the baseline, relative to the calibration time of each run."""
+    scale = baseline['calibration'] / results['calibration']
+    return {name: (current * scale - baseline[name]) / baseline[name] * 100
+            for name, current in results.items() if name != 'calibration' and baseline.get(name)}
+
+
+def compare(results, baseline, threshold, rerun=None, reruns=3):
+    """Print each case against the baseline and return the cases that regressed.
+
+    With rerun, a function timing the given case names again, the cases
+    slower than the threshold are timed reruns more times, and regress
+    when the median of their changes is also above it.
+    """
+    first = changes(results, baseline)
+    suspects = {name for name, change in first.items() if change > threshold}
+    samples = {name: [first[name]] for name in suspects}
+    for _ in range(reruns if rerun is not None and suspects else 0):
+        again = changes(rerun(suspects), baseline)
+        for name in suspects:
+            samples[name].append(again[name])
+    medians = {name: statistics.median(values) for name, values in samples.items()}
+    regressions = [name for name, change in medians.items() if change > threshold]
+    print(f"calibration: baseline {baseline['calibration']:.3f} us, current {results['calibration']:.3f} us")
+    print(f"{'case':36} {'baseline us':>12} {'current us':>12} {'change':>8} {'median':>8}")
+    for name, current in results.items():
+        if name == 'calibration':
+            continue
+        if name not in first:
+            print(f"{name:36} {'-':>12} {current:12.3f}")
+            continue
+        median = f"{medians[name]:+7.1f}%" if name in medians else ''
+        note = '  REGRESSION' if name in regressions else ''
+        print(f"{name:36} {baseline[name]:12.3f} {current:12.3f} {first[name]:+7.1f}% {median:>8}{note}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the state-diff and path primitives.')
+    parser.add_argument('-n', '--number', type=int, default=2000, help='Calls per timing run')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='Timing runs per case, the best is kept')
+    parser.add_argument('--save-baseline', type=str, help='Write the results to this baseline file')
+    parser.add_argument('--compare', type=str, help='Compare against this baseline file')
+    parser.add_argument('--threshold', type=float, default=25.0, help='Allowed slowdown in percent')
+    parser.add_argument('--reruns', type=int, default=3,
+                        help='Extra runs of the cases over the threshold, and of all cases for a baseline')
+    args = parser.parse_args()
+
+    if args.save_baseline:
+        # A baseline is compared against many times, so it gets the median of the same number of runs
+        runs = [run(args.number, args.repeat) for _ in range(1 + args.reruns)]
+        results = {name: round(statistics.median(result[name] for result in runs), 3) for name in runs[0]}
+    else:
+        results = run(args.number, args.repeat)
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline['results'], args.threshold,
+                              rerun=lambda names: run(args.number, args.repeat, names), reruns=args.reruns)
+        if regressions:
+            print(f"{len(regressions)} cases regressed by more than {args.threshold}%")
+            sys.exit(1)
+    else:
+        for name, value in results.items():
+            print(f"{name:36} {value:10.3f} us")
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save_baseline)), exist_ok=True)
+        with open(args.save_baseline, 'w') as file:
+            json.dump({'python': platform.python_version(), 'machine': platform.machine(),
+                       'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results}, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
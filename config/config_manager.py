@@ -82,6 +82,9 @@ class ConfigManager:
     def getint(self, section, key, fallback=None):
         return self.config.getint(section, key, fallback=fallback)
 
+    def getfloat(self, section, key, fallback=None):
+        return self.config.getfloat(section, key, fallback=fallback)
+
     def getboolean(self, section, key, fallback=None):
         return self.config.getboolean(section, key, fallback=fallback)
 
@@ -1,9 +1,10 @@
-import math
 import sys
 import os
 import threading
 from skylight.effects_thread import EffectsThread
 from skylight.color_utils import ColorUtils
+from skylight.scene_program import compile_scene, freeze, process_value, BLACK, BREATHE_FACTORS, BREATH_PERCENT, \
+    NUM_STEPS
 import time
 try:
     import neopixel
@@ -21,7 +22,6 @@ except ImportError:
 class LEDController:
     def __init__(self, led_count=30, led_pin=board.D18, led_brightness=0.25, led_order=neopixel.GRB):
         self.strip = neopixel.NeoPixel(led_pin, led_count, brightness=led_brightness, auto_write=False, pixel_order=led_order)
-        self.pixels = [(0, 0, 0)] * led_count
         self.fill_color = (0, 0, 0)
         self.effect_name = None
         self.effects_thread = EffectsThread(update_interval=1/15)
@@ -35,10 +35,16 @@ class LEDController:
         self.led_count = led_count
         self.brightness = led_brightness
 
-        # Precompute breathe factor for 256 steps
-        self.breath_percent = bc = 0.50
-        self.num_steps = num = 256
-        self.breathe_factors = [1 - (bc/2) + (bc/2) * math.sin(4 * math.pi * i / num) for i in range(num)]
+        # The compiled scene, the pixels of its fields that do not animate, and the frame last shown
+        self.program = None
+        self.patterns = []
+        self.animated_fields = []
+        self.base_frame = [BLACK] * led_count
+        self.shown_frame = [BLACK] * led_count
+
+        self.breath_percent = BREATH_PERCENT
+        self.num_steps = NUM_STEPS
+        self.breathe_factors = BREATHE_FACTORS
         # Set the default effect to effects_loop
         self.set_effect(self.effects_loop)
         self.set_brightness(led_brightness)
@@ -46,18 +52,22 @@ class LEDController:
     def add_color(self, name, rgb):
         """Add a new color to the dictionary."""
         ColorUtils.add_color(name, rgb)
+        # Compiled scenes hold resolved colors
+        compile_scene.cache_clear()
 
     def remove_color(self, name):
         """Remove a color from the dictionary."""
         ColorUtils.remove_color(name)
+        compile_scene.cache_clear()
 
     def get_color(self, color):
         """Retrieve a named color from the dictionary."""
         return ColorUtils.get_color(color)
 
     def get_pixels(self):
+        """Return the colors shown, scaled by the brightness."""
         with self.lock:
-            return self.pixels
+            return ColorUtils.scale_pixels(self.shown_frame, self.brightness)
 
     def show_strip(self):
         #with self.lock:
@@ -65,23 +75,31 @@ class LEDController:
 
 
     def set_data_fields(self, init_data_fields):
-        #with self.lock:
         if init_data_fields:
-            self.data_fields = []
-            self.data_values = []
-            start = 0
-            #print(init_data_fields)
-            for field in init_data_fields:
-                mode, value, length, color, bg_color, pad = field
-                if isinstance(length, int):
-                    mode = "chase" if not isinstance(mode, str) else mode
-                    value = self.process_value(value, length, mode)
-                    color, bg_color = self.get_color(color), self.get_color(bg_color)
-                    pad = 0 if not isinstance(pad, int) else pad
-                    start += length + pad
-                    if start <= self.led_count:
-                        self.data_fields.append((mode, length, color, bg_color, pad))
-                        self.data_values.append(value)
+            program = compile_scene(freeze(init_data_fields), self.led_count, self.reverse_order)
+            with self.lock:
+                self.load_program(program, program.values)
+
+    def load_program(self, program, values):
+        """Show a compiled scene with the given field values."""
+        self.program = program
+        self.data_fields = [(field.mode, field.length, field.color, field.bg_color, field.pad)
+                            for field in program.fields]
+        self.data_values = list(values)
+        self.patterns = [None] * len(program.fields)
+        self.animated_fields = [i for i, field in enumerate(program.fields) if field.animated]
+        self.base_frame = [BLACK] * self.led_count
+        for i in range(len(program.fields)):
+            self.render_field_base(i)
+
+    def render_field_base(self, i):
+        """Recompute the on/off pattern of a field and, unless it animates, its pixels in the base frame."""
+        field = self.program.fields[i]
+        value = self.data_values[i]
+        pattern = self.patterns[i] = field.pattern(value)
+        if not field.animated:
+            for index, color in zip(field.indices, field.render_static(value, pattern)):
+                self.base_frame[index] = color
 
     def set_data_values(self, new_values):
         with self.lock:
@@ -89,7 +107,10 @@ class LEDController:
                 return
             for i, value in enumerate(new_values):
                 mode, length, _, _, _ = self.data_fields[i]
-                self.data_values[i] = self.process_value(value, length, mode)
+                value = self.process_value(value, length, mode)
+                if value != self.data_values[i]:
+                    self.data_values[i] = value
+                    self.render_field_base(i)
 
     def set_brightness(self, brightness):
         with self.lock:
@@ -100,18 +121,19 @@ class LEDController:
     def set_reverse_order(self, reversed):
         with self.lock:
             self.reverse_order = reversed
+            if self.program is not None and self.program.reverse != reversed:
+                self.load_program(compile_scene(self.program.scene, self.led_count, reversed), self.data_values)
 
     def set_color(self, color, index=None):
         color = self.get_color(color)
-        scaled_color = ColorUtils.scale_color(color, self.brightness)
         #with self.lock:
         if index is not None and index < self.led_count:
             index = self.led_count - index - 1 if self.reverse_order else index
-            self.pixels[index] = scaled_color
             self.strip[index] = color
+            self.shown_frame[index] = color
         else:
-            self.pixels = [scaled_color] * self.led_count
             self.strip.fill(color)
+            self.shown_frame = [color] * self.led_count
 
     def select_color(self, condition, color, bg_color, index):
         self.set_color(color if condition else bg_color, index)
@@ -160,74 +182,41 @@ class LEDController:
         }
 
     def effects_loop(self):
-        #print ('effects_loop')
-        sleep_time = 0.010
-        with self.lock:
-            if self.brightness < 0.01:
-                self.clear()
-                return
+        """Show led_count effect steps of the current scene.
 
-            for count in range(self.led_count):
+        Fields that do not animate are already in the base frame, so a step
+        only renders the animated fields, and only pixels that changed since
+        the last frame are written to the strip. The lock is held for one
+        frame at a time, so scene and value changes never wait for a sleep.
+        """
+        sleep_time = 0.010
+        for count in range(self.led_count):
+            with self.lock:
+                if self.brightness < 0.01:
+                    self.clear()
+                    return
                 self.effect_step = (self.effect_step + 1) % self.num_steps
-                breathe_factor = self.breathe_factors[self.effect_step]
-                start = 0
-                self.set_color("black")
-                for i, value in enumerate(self.data_values):
-                    mode, length, color, bg_color, pad = self.data_fields[i]
-                    #if mode == 'breathe':
-                    #    print(f'breath_factor = {breathe_factor}')
-                    progress = int(length * value) if isinstance(value, float) else 0
-                    fade_color = ColorUtils.blend_colors(color, bg_color, value) if isinstance(value, float) else color
-                    blend_color = ColorUtils.blend_colors(color, bg_color, breathe_factor)
-                    breathe_color = ColorUtils.blend_colors((0, 0, 0), color, breathe_factor)
-                    breathe_bg_color = ColorUtils.blend_colors((0, 0, 0), bg_color, breathe_factor)
-                    for index in range(length):
-                        self.apply_mode(mode, self.effect_step, index, length, start+index, progress, color, bg_color, fade_color, blend_color, breathe_color, breathe_bg_color, value)
-                    start += length + pad
+                self.render_frame(self.effect_step)
                 self.show_strip()
-                time.sleep(sleep_time)
-
-    def apply_mode(self, mode, step, index, length, offset_index, progress, color, bg_color, fade_color, blend_color, breathe_color, breathe_bg_color, value):
-        try:
-            if mode == "chase":
-                self.select_color((int(step/3) - index) % length == 0, color, bg_color, offset_index)
-            elif mode == "progress":
-                self.select_color(progress >= index, color, bg_color, offset_index)
-            elif mode == "fade":
-                self.set_color(fade_color, offset_index)
-            elif mode in ["output", "count", "binary"]:
-                self.select_color(value[index] == '1', color, bg_color, offset_index)
-            elif mode == "blink":
-                # self.set_color("black" if (step - index) % length == 0 else color, offset_index)
-                if (step - index) % length == 0:
-                    self.set_color("black")
-                else:
-                    self.select_color(value[index] == '1', color, bg_color, offset_index)
-            elif mode == "blend":
-                self.select_color(value[index] == '1', blend_color, bg_color, offset_index)
-            elif mode == "breathe":
-                self.select_color(value[index] == '1', breathe_color, breathe_bg_color, offset_index)
-            elif mode == "rainbow":
-                # need to be tested
-                pos = (index * 256 // self.led_count) + step
-                self.set_color(ColorUtils.wheel(pos), offset_index)
-        except Exception as e:
-            print(f"Unexpected error: {e}")
-            print(f"mode={mode}, step={step}, index={index}, length={length}, offset_index={offset_index}, progress={progress}")
-            print(f"color={color}, bg_color={bg_color}, fade_color={fade_color}, blend_color={blend_color}")
-            print(f"breathe_color={breathe_color}, breathe_bg_color={breathe_bg_color}, value={value}")
-            raise e
+            time.sleep(sleep_time)
+
+    def render_frame(self, step):
+        frame = self.base_frame[:]
+        if self.program is not None:
+            fields = self.program.fields
+            for i in self.animated_fields:
+                field = fields[i]
+                for index, color in zip(field.indices, field.render(step, self.patterns[i])):
+                    frame[index] = color
+        self.write_frame(frame)
+
+    def write_frame(self, frame):
+        """Write the pixels that differ from the frame last shown to the strip."""
+        shown = self.shown_frame
+        for index, color in enumerate(frame):
+            if shown[index] != color:
+                self.strip[index] = color
+        self.shown_frame = frame
 
     def process_value(self, value, length, mode):
-        if isinstance(value, str):
-            return value.ljust(length, '0')
-        if mode in ['breathe', 'blend', 'output']:
-            return '1' * length
-        if mode == 'count':
-            return ('1' * value).ljust(length, '0')
-        if isinstance(value, int):
-            return bin(value)[2:].zfill(length) if mode == 'binary' else float(value) / 100
-        if isinstance(value, float):
-            return max(min(value, 1.0), 0.0)
-        return value
-
+        return process_value(value, length, mode)
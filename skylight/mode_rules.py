@@ -0,0 +1,200 @@
+import re
+
+# Client state paths the rules read, by the name the rules use for them
+DEFAULT_INPUTS = {
+    "temperature": "moonraker.extruder.temperature",
+    "target": "moonraker.extruder.target",
+    "progress": "moonraker.display_status.progress",
+    "state": "moonraker.idle_timeout.state",
+    "is_paused": "moonraker.pause_resume.is_paused",
+}
+
+# Modes in order of precedence, see ModeRules for the syntax
+DEFAULT_MODES = {
+    "paused": "is_paused",
+    "progress": "progress > 0, target - temperature < 2 ~ 1 -> progress",
+    "temperature": "target > 0; temperature > 50 ~ 5 -> temperature / (target if target > 0 else 250)",
+    "ready": 'state == "Ready", target <= 0, progress < 0.01',
+    "idle": 'state == "Idle"',
+    "rainbow": "True",
+}
+
+COMPARISON = re.compile(r'^(?P<expr>.+?)\s*(?P<op>>=|<=|>|<)\s*(?P<threshold>-?[\d.]+)(?:\s*~\s*(?P<band>[\d.]+))?$')
+OPERATORS = {
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+}
+SAFE_BUILTINS = {'min': min, 'max': max, 'abs': abs, 'round': round}
+
+
+def split_top_level(text, separator):
+    """Split text on separator where it is not inside parentheses or quotes."""
+    parts, depth, quote, start = [], 0, None, 0
+    for i, char in enumerate(text):
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in '"\'':
+            quote = char
+        elif char in '([':
+            depth += 1
+        elif char in ')]':
+            depth -= 1
+        elif char == separator and depth == 0:
+            parts.append(text[start:i])
+            start = i + 1
+    parts.append(text[start:])
+    return [part.strip() for part in parts if part.strip()]
+
+
+def compile_expression(source):
+    code = compile(source, f'<rule {source}>', 'eval')
+    return code, frozenset(code.co_names)
+
+
+def evaluate(code, values):
+    """Evaluate a rule expression, None when an input is missing or has the wrong type."""
+    try:
+        return eval(code, {'__builtins__': SAFE_BUILTINS}, values)
+    except (TypeError, ValueError, ZeroDivisionError, NameError, KeyError, IndexError):
+        return None
+
+
+class Clause:
+    """One condition of a mode, either a boolean expression or a comparison with optional hysteresis.
+
+    ``temperature > 50 ~ 5`` turns true above 50 and only turns false again
+    at or below 45, so a reading wobbling around 50 does not flip it.
+    """
+    __slots__ = ('source', 'code', 'names', 'op', 'threshold', 'band', 'state')
+
+    def __init__(self, source):
+        self.source = source
+        match = COMPARISON.match(source)
+        if match:
+            self.op = match['op']
+            self.threshold = float(match['threshold'])
+            self.band = float(match['band'] or 0)
+            source = match['expr']
+        else:
+            self.op = None
+        self.code, self.names = compile_expression(source)
+        self.state = False
+
+    def update(self, values):
+        value = evaluate(self.code, values)
+        if self.op is None:
+            self.state = bool(value)
+            return
+        if not isinstance(value, (int, float)):
+            self.state = False
+            return
+        threshold = self.threshold
+        if self.state:
+            threshold += -self.band if self.op[0] == '>' else self.band
+        self.state = OPERATORS[self.op](value, threshold)
+
+
+class ModeRule:
+    """A mode, the alternatives of clauses that select it and the expression of its value."""
+    __slots__ = ('mode', 'alternatives', 'value_code')
+
+    def __init__(self, mode, definition):
+        self.mode = mode
+        condition, _, value = definition.partition('->')
+        self.alternatives = [[Clause(clause) for clause in split_top_level(alternative, ',')]
+                             for alternative in split_top_level(condition, ';')]
+        self.value_code = compile_expression(value.strip())[0] if value.strip() else None
+
+    def clauses(self):
+        return [clause for alternative in self.alternatives for clause in alternative]
+
+    def matches(self):
+        return any(all(clause.state for clause in alternative) for alternative in self.alternatives)
+
+    def value(self, values):
+        """Return the mode's value clamped to 0..1, 0 without a value expression."""
+        if self.value_code is None:
+            return 0
+        value = evaluate(self.value_code, values)
+        if not isinstance(value, (int, float)):
+            return 0
+        return max(0.0, min(1.0, float(value)))
+
+
+class ModeRules:
+    """Picks the skylight mode from printer state with a declarative rule set.
+
+    The rules come from the [skylight_modes] config section, one mode per
+    line in order of precedence, the first mode whose condition holds wins:
+
+        progress = progress > 0, target - temperature < 2 ~ 1 -> progress
+
+    Clauses separated by ',' must all hold, alternatives separated by ';'
+    are or-ed, and the expression after '->' gives the mode's 0..1 value.
+    Expressions use the input names from [skylight_inputs], which map names
+    to client state paths. A comparison may end in '~ band' for hysteresis.
+
+    Only the clauses that read a changed input are evaluated again.
+    """
+
+    def __init__(self, inputs=None, modes=None, value_deadband=0.01):
+        self.inputs = dict(inputs or DEFAULT_INPUTS)
+        self.names = {path: name for name, path in self.inputs.items()}
+        self.rules = [ModeRule(mode, definition) for mode, definition in (modes or DEFAULT_MODES).items()]
+        self.value_deadband = value_deadband
+        self.values = {name: None for name in self.inputs}
+        self.dependents = {name: [] for name in self.inputs}
+        for rule in self.rules:
+            for clause in rule.clauses():
+                for name in clause.names & self.dependents.keys():
+                    self.dependents[name].append(clause)
+                clause.update(self.values)
+
+    @classmethod
+    def from_config(cls, config_manager):
+        inputs = config_manager.get_section_items('skylight_inputs') or None
+        modes = config_manager.get_section_items('skylight_modes') or None
+        return cls(inputs, modes, config_manager.getfloat('skylight', 'mode_value_deadband', 0.01))
+
+    def find_input(self, path):
+        """Return the input name of a path and the keys of path below the input, or (None, ()) for other paths."""
+        keys = path.split('.')
+        for depth in range(len(keys), 0, -1):
+            name = self.names.get('.'.join(keys[:depth]))
+            if name is not None:
+                return name, keys[depth:]
+        return None, ()
+
+    def set_input(self, path, value):
+        """Store the new value of an input path and re-evaluate the clauses that read it.
+
+        When the input is an object, path is one of its leaves and only that
+        leaf is set. Returns the input name, None for a path no input covers.
+        """
+        name, keys = self.find_input(path)
+        if name is None:
+            return None
+        if keys:
+            if not isinstance(self.values[name], dict):
+                self.values[name] = {}
+            node = self.values[name]
+            for key in keys[:-1]:
+                if not isinstance(node.get(key), dict):
+                    node[key] = {}
+                node = node[key]
+            node[keys[-1]] = value
+        else:
+            self.values[name] = value
+        for clause in self.dependents[name]:
+            clause.update(self.values)
+        return name
+
+    def evaluate(self):
+        """Return (mode, value) of the first mode whose condition holds."""
+        for rule in self.rules:
+            if rule.matches():
+                return rule.mode, rule.value(self.values)
+        return None, 0
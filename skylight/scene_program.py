@@ -0,0 +1,141 @@
+import math
+import functools
+from skylight.color_utils import ColorUtils
+
+NUM_STEPS = 256
+BREATH_PERCENT = 0.50
+# Breathe factor for each effect step
+BREATHE_FACTORS = tuple(1 - (BREATH_PERCENT / 2) + (BREATH_PERCENT / 2) * math.sin(4 * math.pi * i / NUM_STEPS)
+                        for i in range(NUM_STEPS))
+WHEEL = tuple(ColorUtils.wheel(pos) for pos in range(255))
+BLACK = (0, 0, 0)
+
+# Modes whose colors change with the effect step, the others only change with their value
+ANIMATED_MODES = frozenset(('chase', 'blink', 'blend', 'breathe', 'rainbow'))
+# Modes that light the LEDs whose value character is '1'
+PATTERN_MODES = frozenset(('output', 'count', 'binary', 'blink', 'blend', 'breathe'))
+
+
+def process_value(value, length, mode):
+    """Normalize a field value: a '0'/'1' string for pattern modes, a 0..1 float for progress and fade."""
+    if isinstance(value, str):
+        return value.ljust(length, '0')
+    if mode in ['breathe', 'blend', 'output']:
+        return '1' * length
+    if mode == 'count':
+        return ('1' * value).ljust(length, '0')
+    if isinstance(value, int):
+        return bin(value)[2:].zfill(length) if mode == 'binary' else float(value) / 100
+    if isinstance(value, float):
+        return max(min(value, 1.0), 0.0)
+    return value
+
+
+def freeze(value):
+    """Turn the lists of a scene format into tuples, so it can key the program cache."""
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+class FieldProgram:
+    """One compiled data field: its LED indices, resolved colors and per-step palettes.
+
+    Programs are shared through the compile cache and must not be modified.
+    """
+    __slots__ = ('mode', 'length', 'pad', 'indices', 'color', 'bg_color', 'palette', 'bg_palette', 'wheel_offsets')
+
+    def __init__(self, mode, start, length, pad, color, bg_color, led_count, reverse):
+        self.mode = mode
+        self.length = length
+        self.pad = pad
+        self.indices = tuple(led_count - i - 1 if reverse else i for i in range(start, start + length))
+        self.color = color
+        self.bg_color = bg_color
+        self.palette = self.bg_palette = self.wheel_offsets = None
+        if mode == 'blend':
+            self.palette = tuple(ColorUtils.blend_colors(color, bg_color, factor) for factor in BREATHE_FACTORS)
+        elif mode == 'breathe':
+            self.palette = tuple(ColorUtils.blend_colors(BLACK, color, factor) for factor in BREATHE_FACTORS)
+            self.bg_palette = tuple(ColorUtils.blend_colors(BLACK, bg_color, factor) for factor in BREATHE_FACTORS)
+        elif mode == 'rainbow':
+            self.wheel_offsets = tuple(index * 256 // led_count for index in range(length))
+
+    @property
+    def animated(self):
+        return self.mode in ANIMATED_MODES
+
+    def pattern(self, value):
+        """Return which LEDs a value switches on, or None for modes that do not use one."""
+        if self.mode == 'progress':
+            progress = int(self.length * value) if isinstance(value, float) else 0
+            return tuple(progress >= index for index in range(self.length))
+        if self.mode in PATTERN_MODES:
+            if not isinstance(value, str):
+                return (False,) * self.length
+            return tuple(value[index] == '1' for index in range(self.length))
+        return None
+
+    def render_static(self, value, pattern):
+        """Return the colors of a field that only changes with its value."""
+        if self.mode == 'fade':
+            return (ColorUtils.blend_colors(self.color, self.bg_color, value) if isinstance(value, float)
+                    else self.color,) * self.length
+        if pattern is not None:
+            return tuple(self.color if on else self.bg_color for on in pattern)
+        return (BLACK,) * self.length
+
+    def render(self, step, pattern):
+        """Return the colors of an animated field at an effect step."""
+        mode = self.mode
+        if mode == 'chase':
+            lit = (step // 3) % self.length
+            return tuple(self.color if index == lit else self.bg_color for index in range(self.length))
+        if mode == 'blink':
+            # Only the field's own blinking LED goes dark, the loop before compiled scenes blanked the whole strip
+            dark = step % self.length
+            return tuple(BLACK if index == dark else self.color if on else self.bg_color
+                         for index, on in enumerate(pattern))
+        if mode == 'blend':
+            color = self.palette[step]
+            return tuple(color if on else self.bg_color for on in pattern)
+        if mode == 'breathe':
+            color, bg_color = self.palette[step], self.bg_palette[step]
+            return tuple(color if on else bg_color for on in pattern)
+        return tuple(WHEEL[(offset + step) % 255] for offset in self.wheel_offsets)
+
+
+class SceneProgram:
+    """A scene format compiled for one strip: its field programs and their initial values."""
+    __slots__ = ('scene', 'fields', 'values', 'led_count', 'reverse')
+
+    def __init__(self, scene, fields, values, led_count, reverse):
+        self.scene = scene
+        self.fields = fields
+        self.values = values
+        self.led_count = led_count
+        self.reverse = reverse
+
+
+@functools.lru_cache(maxsize=32)
+def compile_scene(scene, led_count, reverse):
+    """Compile a frozen scene format of [mode, value, length, color, bg_color, pad] fields.
+
+    Fields that do not fit on the strip are left out. Results are cached, so
+    switching back to a scene that was shown before costs a dict lookup.
+    """
+    fields = []
+    values = []
+    start = 0
+    for mode, value, length, color, bg_color, pad in scene:
+        if not isinstance(length, int):
+            continue
+        mode = "chase" if not isinstance(mode, str) else mode
+        pad = 0 if not isinstance(pad, int) else pad
+        if start + length + pad > led_count:
+            break
+        fields.append(FieldProgram(mode, start, length, pad, ColorUtils.get_color(color),
+                                   ColorUtils.get_color(bg_color), led_count, reverse))
+        values.append(process_value(value, length, mode))
+        start += length + pad
+    return SceneProgram(scene, tuple(fields), tuple(values), led_count, reverse)
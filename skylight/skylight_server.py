@@ -6,12 +6,14 @@ import sys
 import os
 # Add the root directory of your project to the Python path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-import time
 import asyncio
 from aiohttp import web
 from websocket_server.base_websocket_server import BaseWebSocketServer
 from websocket_server.websocket_client_mixin import WebSocketClientMixin
+from websocket_server.compression import CompressionSettings
+from websocket_server.traffic_recorder import TrafficRecorder
 from skylight.led_controller import LEDController
+from skylight.mode_rules import ModeRules
 from config.config_manager import ConfigManager
 import json
 
@@ -20,7 +22,14 @@ class SkylightServer(BaseWebSocketServer, WebSocketClientMixin):
         # Initialize server part
         skylight_port = config_manager.getint('skylight', 'skylight_port', 7120)
         debug = config_manager.getboolean('skylight', 'debug', True)
-        BaseWebSocketServer.__init__(self, host, skylight_port, debug)
+        coalesce_interval = config_manager.getfloat('skylight', 'coalesce_interval', 0.05)
+        compression = CompressionSettings.from_config(config_manager, 'skylight')
+        profiler = config_manager.getboolean('skylight', 'profiler', False)
+        # Server and client traffic go to one log, replayable with benchmarks/replay_traffic.py
+        record_path = config_manager.get('skylight', 'record_path', '')
+        recorder = TrafficRecorder(record_path, debug=debug) if record_path else None
+        BaseWebSocketServer.__init__(self, host, skylight_port, debug, coalesce_interval=coalesce_interval,
+                                     compression=compression, profiler=profiler, recorder=recorder)
 
         # Initialize client part
         connections = [{'moonraker': config_manager.moonraker_uri()},
@@ -52,20 +61,25 @@ class SkylightServer(BaseWebSocketServer, WebSocketClientMixin):
                 "id": 3
             }
         }
-        WebSocketClientMixin.__init__(self, connections, subscriptions, debug)
+        retry_max = config_manager.getfloat('skylight', 'retry_max', 30)
+        shared = config_manager.getboolean('skylight', 'shared_client', False)
+        WebSocketClientMixin.__init__(self, connections, subscriptions, debug, shared=shared, retry_max=retry_max,
+                                      recorder=recorder)
 
         # Other initializations
         self.config_manager = config_manager
         led_count = config_manager.getint('skylight', 'led_count', 30)
-        update_interval = config_manager.getint('skylight', 'update_interval', 2)
-        self.last_update_time = 0
-        self.current_state = self.initialize_current_state(led_count, update_interval)
+        self.current_state = self.initialize_current_state(led_count)
         self.led_controller = LEDController(led_count)
+        self.mode_rules = ModeRules.from_config(config_manager)
+        self.mode_value = 0
+        self.pending_mode_update = None
+        for path in self.mode_rules.inputs.values():
+            self.client.add_path_callback(path, self.handle_input_change)
         self.show_preset("rainbow")
 
-    def initialize_current_state(self, led_count, update_interval):
+    def initialize_current_state(self, led_count):
         return {
-            "update_interval": update_interval,
             "scene": {},
             "skylight": {
                 "status": "on",
@@ -95,70 +109,54 @@ class SkylightServer(BaseWebSocketServer, WebSocketClientMixin):
         }
 
     async def handle_client_update(self, root, updated_objects):
-        """Override the handle_client_update to call handle_moonraker_update."""
-        self.handle_moonraker_update(root, updated_objects)
-
-    def handle_moonraker_update(self, root, updated_objects):
-        if root == "moonraker":
-            self.current_state["moonraker"]["temperature"] = self.client.get_state("moonraker.extruder.temperature", 25.0)
-            self.current_state["moonraker"]["target"] = self.client.get_state("moonraker.extruder.target", 0.0)
-            self.current_state["moonraker"]["progress"] = self.client.get_state("moonraker.display_status.progress", 0.0)
-            self.current_state["moonraker"]["state"] = self.client.get_state("moonraker.idle_timeout.state")
-            self.current_state["moonraker"]["is_paused"] = self.client.get_state("moonraker.pause_resume.is_paused")
-            if time.time() - self.last_update_time > self.current_state["update_interval"]:
-                self.last_update_time = time.time()
-                self.update_skylight("moonraker")
+        """Override the handle_client_update to print skybox updates, mode inputs have path callbacks."""
         if root == "skybox":
             print(root, updated_objects)
 
+    def handle_input_change(self, path, old, new):
+        """Path callback for the inputs of the mode rules, updates the LEDs as soon as the mode or value moves."""
+        name = self.mode_rules.set_input(path, new)
+        if name is None:
+            return
+        self.publish_state({"moonraker": {name: self.mode_rules.values[name]}})
+        # Pick the mode once all inputs changed by the same message are set
+        if self.pending_mode_update is None:
+            self.pending_mode_update = asyncio.get_event_loop().call_soon(self.run_mode_update)
+
+    def run_mode_update(self):
+        self.pending_mode_update = None
+        self.update_skylight()
 
-    def determine_mode(self):
-        heater_on = self.get_state("moonraker.target") > 0
-        warming_up = self.get_state("moonraker.target") - self.get_state("moonraker.temperature") > 2 and heater_on
-        cooling_down = self.get_state("moonraker.temperature") > 50 and not heater_on
-        ratio = (self.current_state["moonraker"]["temperature"] /
-                 (self.current_state["moonraker"]["target"] if heater_on else 250))
-        progress = self.current_state["moonraker"]["progress"]
-        is_paused = self.current_state["moonraker"]["is_paused"]
-        is_ready = (self.current_state["moonraker"]["state"] == "Ready" and not heater_on and progress < 0.01)
-        is_idle = (self.current_state["moonraker"]["state"] == "Idle")
-
-        if is_paused:
-            return "paused", 0
-        if not warming_up and progress > 0:
-            return "progress", progress
-        if heater_on or cooling_down:
-            ratio = max(0.0, min(1.0, ratio))
-            return "temperature", ratio
-        if is_ready:
-            return "ready", 0
-        if is_idle:
-            return "idle", 0
-        return "rainbow", 0
-
-    def update_skylight(self, root):
+    def update_skylight(self):
         if self.current_state['skylight']['preset_scene'] == "skybox":
             return
         try:
-            preset_scene, percent = self.determine_mode()
+            preset_scene, percent = self.mode_rules.evaluate()
+            if preset_scene is None:
+                return
             if preset_scene != self.current_state['skylight']['preset_scene']:
-                self.current_state['skylight']['preset_scene'] = preset_scene
+                self.publish_state({"skylight": {"preset_scene": preset_scene}})
 
                 formats = self.current_state["preset_formats"].get(preset_scene, [])
                 self.set_scene_format(formats)
-            else:
+                self.mode_value = percent
+                self.set_scene_values(percent)
+            elif abs(percent - self.mode_value) >= self.mode_rules.value_deadband:
+                # Values within the deadband of the last one sent are sensor noise
+                self.mode_value = percent
                 self.set_scene_values(percent)
         except Exception as e:
-            print(f'Exception in handle_moonraker_update(): {e}')
+            print(f'Exception in update_skylight(): {e}')
 
     def show_preset(self, name):
         format_data = self.current_state["preset_formats"].get(name, [])
         if format_data:
-            self.current_state['skylight']['preset_scene'] = name
+            self.publish_state({"skylight": {"preset_scene": name}})
             self.set_scene_format(format_data)
 
     def set_scene_format(self, formats):
-        self.current_state["scene"] = formats
+        # A copy, so setting values does not change the preset the format came from
+        self.publish_state({"scene": [list(field) for field in formats]})
         if self.debug:
             print(f'formats = {formats}')
         self.led_controller.set_data_fields(formats)
@@ -166,13 +164,13 @@ class SkylightServer(BaseWebSocketServer, WebSocketClientMixin):
     def set_scene_values(self, values):
         if self.debug:
             print(f'values = {values}')
-        formats = self.current_state["scene"]
-        n_values = len(formats) if formats else 1
+        # A new scene list, the store detects changes by comparing it with the one it holds
+        scene = [list(field) for field in self.current_state["scene"] or []]
         if not isinstance(values, list):
-            values = [values] * n_values
-        for i in range(n_values):
-            if i < len(values):
-                self.current_state["scene"][i][1] = values[i]
+            values = [values] * max(len(scene), 1)
+        for field, value in zip(scene, values):
+            field[1] = value
+        self.publish_state({"scene": scene})
 
         self.led_controller.set_data_values(values)
 
@@ -192,7 +190,8 @@ class SkylightServer(BaseWebSocketServer, WebSocketClientMixin):
                 post_params = {}
 
         if path == "/skylight/status" and request.method == 'GET':
-            return web.json_response(self.current_state)
+            await self.long_poll(request)
+            return self.cached_json_response(request, 'skylight/status', lambda: self.current_state)
 
         if path == "/skylight/control" and request.method in ['GET', 'POST']:
             combined_params = {**query_params, **post_params}
@@ -202,10 +201,10 @@ class SkylightServer(BaseWebSocketServer, WebSocketClientMixin):
             if "action" in combined_params:
                 action = combined_params["action"]
                 if action == 'on':
-                    self.current_state["skylight"]["status"] = "on"
+                    self.publish_state({"skylight": {"status": "on"}})
                     self.set_brightness(self.current_state["skylight"]["brightness"])
                 elif action == 'off':
-                    self.current_state["skylight"]["status"] = "off"
+                    self.publish_state({"skylight": {"status": "off"}})
                     self.led_controller.set_brightness(0)
 
             return web.json_response(self.current_state["skylight"])
@@ -214,7 +213,7 @@ class SkylightServer(BaseWebSocketServer, WebSocketClientMixin):
             combined_params = {**query_params, **post_params}
             if "format" in combined_params:
                 format_data = json.loads(combined_params["format"])
-                self.current_state['skylight']['preset_scene'] = "skybox"
+                self.publish_state({"skylight": {"preset_scene": "skybox"}})
                 self.set_scene_format(format_data)
             if "values" in combined_params:
                 values = json.loads(combined_params["values"])
@@ -227,7 +226,7 @@ class SkylightServer(BaseWebSocketServer, WebSocketClientMixin):
         return web.Response(status=404, text=f"{path} Not Found")
 
     def set_brightness(self, brightness):
-        self.current_state["skylight"]["brightness"] = brightness
+        self.publish_state({"skylight": {"brightness": brightness}})
         percent = brightness / 256 if brightness < 256 else 1.0
         self.led_controller.set_brightness(percent)
 
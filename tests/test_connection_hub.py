@@ -0,0 +1,132 @@
+import sys
+import os
+import json
+import asyncio
+from aiohttp import web
+
+# Add the root directory of your project to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from websocket_server.connection_hub import ConnectionHub, HubClient
+
+STATUS = {"extruder": {"temperature": 210.5, "target": 215.0}, "idle_timeout": {"state": "Printing"}}
+
+
+async def start_upstream(status=STATUS):
+    """Serve a Moonraker-like upstream answering subscribes with the subscribed objects of status.
+
+    Like BaseWebSocketServer it sends an epoch and seq, and a subscribe
+    resuming with since only gets what changed since, which here is nothing.
+    """
+    async def handle(request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        async for msg in ws:
+            data = json.loads(msg.data)
+            params = data.get('params', {})
+            objects = params.get('objects', {})
+            current = {} if 'since' in params else {name: status[name] for name in objects if name in status}
+            await ws.send_str(json.dumps({"jsonrpc": "2.0", "id": data.get('id'),
+                                          "result": {"status": current, "epoch": "e1", "seq": 1}}))
+            await ws.send_str(json.dumps({"jsonrpc": "2.0", "method": "notify_status_update",
+                                          "params": [current, 0.0, 1]}))
+        return ws
+
+    app = web.Application()
+    app.router.add_get('/websocket', handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host='127.0.0.1', port=0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"ws://127.0.0.1:{port}/websocket"
+
+
+def subscription(objects):
+    return {"jsonrpc": "2.0", "method": "printer.objects.subscribe", "params": {"objects": objects}, "id": 1}
+
+
+async def wait_for(condition, timeout=5.0):
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("condition not met in time")
+
+
+def test_late_consumer_gets_known_values_on_path_callbacks():
+    async def run():
+        runner, uri = await start_upstream()
+        hub = ConnectionHub(debug=False)
+        objects = {"extruder": None, "idle_timeout": None}
+        first = HubClient(hub, [{"moonraker": uri}], {"moonraker": subscription(objects)}, debug=False)
+        first_calls = []
+        first.add_path_callback("moonraker.extruder.target", lambda *change: first_calls.append(change))
+        first_task = asyncio.ensure_future(first.start())
+        await wait_for(lambda: first_calls)
+
+        # Same objects, so the hub does not resubscribe and nothing upstream changes
+        second = HubClient(hub, [{"printer": uri}], {"printer": subscription(objects)}, debug=False)
+        second_calls = []
+        second.add_path_callback("printer.extruder.target", lambda *change: second_calls.append(change))
+        second.add_path_callback("printer.idle_timeout", lambda *change: second_calls.append(change))
+        second_task = asyncio.ensure_future(second.start())
+        await wait_for(lambda: len(second_calls) == 2)
+
+        assert sorted(second_calls) == [("printer.extruder.target", None, 215.0),
+                                        ("printer.idle_timeout.state", None, "Printing")]
+        assert first_calls == [("moonraker.extruder.target", None, 215.0)]
+
+        await second.stop()
+        await first.stop()
+        await asyncio.gather(first_task, second_task)
+        await runner.cleanup()
+
+    asyncio.run(run())
+
+
+def test_widened_subscription_gets_the_current_values_of_new_objects():
+    async def run():
+        runner, uri = await start_upstream()
+        hub = ConnectionHub(debug=False)
+        first = HubClient(hub, [{"moonraker": uri}], {"moonraker": subscription({"extruder": None})}, debug=False)
+        first_task = asyncio.ensure_future(first.start())
+        await wait_for(lambda: first.get_state("moonraker.extruder.target") is not None)
+        await wait_for(lambda: hub.client.resume_points.get("moonraker", {}).get('since') is not None)
+
+        second = HubClient(hub, [{"printer": uri}], {"printer": subscription({"idle_timeout": None})}, debug=False)
+        second_task = asyncio.ensure_future(second.start())
+        await wait_for(lambda: second.get_state("printer.idle_timeout.state") == "Printing")
+
+        await second.stop()
+        await first.stop()
+        await asyncio.gather(first_task, second_task)
+        await runner.cleanup()
+
+    asyncio.run(run())
+
+
+def test_same_root_on_two_uris_keeps_separate_state():
+    async def run():
+        first_runner, first_uri = await start_upstream({"extruder": {"target": 1.0}})
+        second_runner, second_uri = await start_upstream({"extruder": {"target": 2.0}})
+        hub = ConnectionHub(debug=False)
+        objects = {"extruder": None}
+        first = HubClient(hub, [{"moonraker": first_uri}], {"moonraker": subscription(objects)}, debug=False)
+        second = HubClient(hub, [{"moonraker": second_uri}], {"moonraker": subscription(objects)}, debug=False)
+        second_calls = []
+        second.add_path_callback("moonraker.extruder.target", lambda *change: second_calls.append(change))
+        tasks = [asyncio.ensure_future(first.start()), asyncio.ensure_future(second.start())]
+        await wait_for(lambda: second_calls)
+
+        assert "." not in second.hub_roots["moonraker"]
+        assert first.get_state("moonraker.extruder.target") == 1.0
+        assert second.get_state("moonraker.extruder.target") == 2.0
+        assert second_calls == [("moonraker.extruder.target", None, 2.0)]
+
+        await second.stop()
+        await first.stop()
+        await asyncio.gather(*tasks)
+        await first_runner.cleanup()
+        await second_runner.cleanup()
+
+    asyncio.run(run())
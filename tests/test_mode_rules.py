@@ -0,0 +1,36 @@
+import sys
+import os
+
+# Add the root directory of your project to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from skylight.mode_rules import ModeRules
+
+INPUTS = {
+    "extruder": "moonraker.extruder",
+    "is_paused": "moonraker.pause_resume.is_paused",
+}
+MODES = {
+    "paused": "is_paused",
+    "temperature": "extruder['target'] > 0 -> extruder['temperature'] / extruder['target']",
+    "idle": "True",
+}
+
+
+def test_object_input_is_set_from_its_leaves():
+    rules = ModeRules(INPUTS, MODES)
+    assert rules.evaluate() == ("idle", 0)
+
+    assert rules.set_input("moonraker.extruder.temperature", 100.0) == "extruder"
+    assert rules.set_input("moonraker.extruder.target", 200.0) == "extruder"
+    assert rules.values["extruder"] == {"temperature": 100.0, "target": 200.0}
+    assert rules.evaluate() == ("temperature", 0.5)
+
+    rules.set_input("moonraker.pause_resume.is_paused", True)
+    assert rules.evaluate() == ("paused", 0)
+
+
+def test_paths_outside_the_inputs_are_ignored():
+    rules = ModeRules(INPUTS, MODES)
+    assert rules.set_input("moonraker.display_status.progress", 0.5) is None
+    assert rules.set_input("moonraker.pause_resume.other", 1) is None
+    assert rules.evaluate() == ("idle", 0)
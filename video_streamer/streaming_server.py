@@ -23,11 +23,17 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from video_streamer.streaming_module import StreamingOutput, StreamingHandler, StreamingServer
 from config.config_manager import ConfigManager
 from video_streamer.overlay_manager import OverlayManager
+from websocket_server.compression import CompressionSettings
+from websocket_server.metrics import MetricsRegistry, EventLoopMonitor
+from websocket_server.profiler import ProfilerEndpoint
 
 
 class WebSocketFrameReceiver:
-    def __init__(self, port, filepath):
+    def __init__(self, port, filepath, compression=None, profiler=False):
         self.port = port
+        self.profiler = ProfilerEndpoint() if profiler else None
+        # JPEG frames are already compressed, so deflate is off unless configured
+        self.compression = compression if compression is not None else CompressionSettings(enabled=False)
         self.output = None
         self.connected = False
         self.default_frame = self.initialize_default_frame(filepath)
@@ -35,6 +41,20 @@ class WebSocketFrameReceiver:
         self.current_frame = None
         self.current_overlay = None
         self.stream_addr = ""
+        self.connection_count = 0
+        self.init_metrics()
+
+    def init_metrics(self):
+        """Create the metrics served at /metrics."""
+        self.metrics = metrics = MetricsRegistry(prefix='skybox_stream_')
+        metrics.gauge('connections', 'Number of open frame websocket connections', lambda: self.connection_count)
+        self.messages_in = metrics.counter('messages_in_total', 'Messages received, by websocket message type')
+        self.decode_time = metrics.histogram('frame_decode_seconds', 'Time spent decoding received frames')
+        self.overlay_time = metrics.histogram('overlay_draw_seconds', 'Time spent drawing overlay shapes')
+        self.encode_time = metrics.histogram('jpeg_encode_seconds', 'Time spent encoding JPEG frames for the stream')
+        self.errors = metrics.counter('errors_total', 'Messages that could not be processed')
+        self.loop_lag = metrics.histogram('event_loop_lag_seconds', 'How late the event loop runs a periodic timer')
+        self.loop_monitor = EventLoopMonitor(self.loop_lag)
 
     def initialize_default_frame(self, filepath):
         frame = cv2.imread(filepath, cv2.IMREAD_COLOR)
@@ -44,38 +64,49 @@ class WebSocketFrameReceiver:
         return buffer
 
     async def websocket_handler(self, request):
-        ws = web.WebSocketResponse()
+        ws = self.compression.create_response()
         await ws.prepare(request)
+        self.compression.configure(ws)
 
         self.connected = True
-        async for message in ws:
-            try:
-                # Process WebSocket message
-                if message.type == aiohttp.WSMsgType.TEXT:
-                    data = json.loads(message.data)
-                    if 'frame' in data:
-                        frame_data = base64.b64decode(data['frame'])
-                        self.current_frame = cv2.imdecode(np.frombuffer(frame_data, dtype=np.uint8), cv2.IMREAD_COLOR)
-                    if 'overlay' in data:
-                        self.current_overlay = data['overlay']
-                elif message.type == aiohttp.WSMsgType.BINARY:
-                    frame_data = np.frombuffer(message.data, dtype=np.uint8)
-                    self.current_frame = cv2.imdecode(frame_data, cv2.IMREAD_COLOR)
-
-                frame = self.current_frame
-                if self.current_overlay:
-                    frame = self.overlay_manager.draw_overlay_shapes(self.current_frame.copy(), self.current_overlay)
-
-            except Exception as e:
-                logging.error(f"Error processing message: {e}")
-                continue
-
-            if self.output:
-                _, jpeg = cv2.imencode('.jpg', frame)
-                self.output.update_frame(jpeg)
-                self.default_frame = jpeg
-
-        self.connected = False
+        self.connection_count += 1
+        try:
+            async for message in ws:
+                self.messages_in.inc(type=message.type.name.lower())
+                try:
+                    # Process WebSocket message
+                    if message.type == aiohttp.WSMsgType.TEXT:
+                        data = json.loads(message.data)
+                        if 'frame' in data:
+                            with self.decode_time.time():
+                                frame_data = base64.b64decode(data['frame'])
+                                self.current_frame = cv2.imdecode(np.frombuffer(frame_data, dtype=np.uint8), cv2.IMREAD_COLOR)
+                        if 'overlay' in data:
+                            self.current_overlay = data['overlay']
+                    elif message.type == aiohttp.WSMsgType.BINARY:
+                        with self.decode_time.time():
+                            frame_data = np.frombuffer(message.data, dtype=np.uint8)
+                            self.current_frame = cv2.imdecode(frame_data, cv2.IMREAD_COLOR)
+
+                    frame = self.current_frame
+                    if self.current_overlay:
+                        with self.overlay_time.time():
+                            frame = self.overlay_manager.draw_overlay_shapes(self.current_frame.copy(), self.current_overlay)
+
+                except Exception as e:
+                    self.errors.inc()
+                    logging.error(f"Error processing message: {e}")
+                    continue
+
+                if self.output:
+                    with self.encode_time.time():
+                        _, jpeg = cv2.imencode('.jpg', frame)
+                    self.output.update_frame(jpeg)
+                    self.default_frame = jpeg
+        finally:
+            # Also on errors and cancellation, so the connections gauge does not stay up
+            self.connection_count -= 1
+            self.connected = False
         return ws
 
     async def http_handler(self, request):
@@ -96,12 +127,20 @@ class WebSocketFrameReceiver:
         # HTTP route to query the current overlay
         app.router.add_route('GET', '/status', self.http_handler)
 
+        # Prometheus metrics
+        app.router.add_route('GET', '/metrics', self.metrics.handle_request)
+
+        # CPU profile of all threads, only when enabled in the config
+        if self.profiler is not None:
+            app.router.add_route('GET', '/debug/profile', self.profiler.handle_request)
+
         runner = web.AppRunner(app)
         await runner.setup()
 
         # Start the server on the specified port (for both HTTP and WS)
         site = web.TCPSite(runner, '0.0.0.0', self.port)
         await site.start()
+        self.loop_monitor.start()
 
         logging.info(f"Server started on port {self.port} (HTTP & WebSocket)")
 
@@ -115,11 +154,13 @@ class WebSocketStreamer:
         stream_port = config_manager.getint('video_streamer', 'stream_port', fallback=8085)
         ws_port = config_manager.getint('video_streamer', 'ws_port', fallback=7130)
         filepath = config_manager.get('video_streamer', 'default_frame_filepath')
+        compression = CompressionSettings.from_config(config_manager, 'video_streamer', enabled=False)
+        profiler = config_manager.getboolean('video_streamer', 'profiler', False)
 
         self.output = StreamingOutput()
         StreamingHandler.output = self.output
         self.server = StreamingServer(('0.0.0.0', stream_port), StreamingHandler)
-        self.ws_receiver = WebSocketFrameReceiver(ws_port, filepath)
+        self.ws_receiver = WebSocketFrameReceiver(ws_port, filepath, compression, profiler)
         self.ws_receiver.output = self.output
         self.ws_receiver.stream_addr = f'http://{self.get_server_ip()}:{stream_port}'
         self.is_running = False
@@ -1,221 +1,210 @@
 import asyncio
 import json
-import websockets
-import time
+from websocket_server import codec
+from websocket_server.connection_supervisor import Backoff, ConnectionSupervisor
+from websocket_server.metrics import MetricsRegistry
+from websocket_server.state_store import StateStore, compile_path, iter_leaves
+from websocket_server.update_dispatcher import UpdateDispatcher
 
 class BaseWebSocketClient:
-    def __init__(self, connections, subscriptions, debug=True):
+    def __init__(self, connections, subscriptions, debug=True, retry_initial=0.5, retry_max=30.0,
+                 watchdog_timeout=30.0, recorder=None):
         self.connections = connections
         self.subscriptions = subscriptions
         self.debug = debug
-        self.current_state = {}
-        self.connection_tasks = []
+        self.retry_initial = retry_initial
+        self.retry_max = retry_max
+        self.watchdog_timeout = watchdog_timeout
+        self.recorder = recorder
+        self.state = StateStore()
+        self.resume_points = {}
+        self.supervisors = {}
+        self.path_callbacks = {}
         self.running = False
+        self.init_metrics()
+        self.dispatcher = UpdateDispatcher(self.run_state_handler, self.run_path_callbacks, self.handler_time, debug)
         #self.on_state_update = None  # Callback for state updates
 
-    async def _connect_with_retries(self, uri, root, name):
-        """Attempt to connect with retries on failure."""
-        retry_interval = 5
-        while self.running:
-            try:
-                async with websockets.connect(uri) as websocket:
-                    if self.debug:
-                        print(f"Connected to {name}: {uri}")
-                    await self.subscribe(websocket, name)
-                    await self.listen(websocket, root, name)
-            except (websockets.ConnectionClosedError, websockets.InvalidURI, websockets.InvalidHandshake) as e:
-                if self.debug:
-                    print(f"Connection to {name} failed: {e}. Retrying in {retry_interval} seconds...")
-                await asyncio.sleep(retry_interval)
-            except (ConnectionRefusedError, OSError) as e:
-                if self.debug:
-                    print(f"Connection to {name} failed: {e}. Retrying in {retry_interval} seconds...")
-                await asyncio.sleep(retry_interval)
-            except Exception as e:
-                if self.debug:
-                    print(f"Unexpected error while connecting to {name}: {e}")
-                await asyncio.sleep(retry_interval)
-
-
-    async def connect_with_retries(self, uri, root, name):
-        """Attempt to connect with retries on failure."""
-        retry_interval = 5
-        max_retries = 60  # Maximum retries before considering failure (adjust as needed)
-    
-        retry_count = 0
-        while self.running:
-            try:
-                async with websockets.connect(uri) as websocket:
-                    if self.debug:
-                        print(f"Connected to {name}: {uri}")
-    
-                    # Resubscribe after connecting
-                    await self.subscribe(websocket, name)
-
-                    # Start the periodic timeout checker
-                    asyncio.create_task(self.check_broadcast_timeout())
-
-                    # Start listening for messages
-                    await self.listen(websocket, root, name)
-
-                    # Reset retry count if connection was successful
-                    retry_count = 0
-
-            except (websockets.ConnectionClosedError, websockets.InvalidURI, websockets.InvalidHandshake) as e:
-                if self.debug:
-                    print(f"Connection to {name} failed: {e}. Retrying in {retry_interval} seconds...")
-
-                retry_count += 1
-                if retry_count >= max_retries:
-                    if self.debug:
-                        print(f"Max retries reached for {name}. Giving up.")
-                    break  # Exit the loop if maximum retries are exceeded
-
-                await asyncio.sleep(retry_interval)
-
-            except (ConnectionRefusedError, OSError) as e:
-                if self.debug:
-                    print(f"Connection to {name} failed: {e}. Retrying in {retry_interval} seconds...")
-
-                retry_count += 1
-                if retry_count >= max_retries:
-                    if self.debug:
-                        print(f"Max retries reached for {name}. Giving up.")
-                    break  # Exit the loop if maximum retries are exceeded
-
-                await asyncio.sleep(retry_interval)
-
-            except Exception as e:
-                if self.debug:
-                    print(f"Unexpected error while connecting to {name}: {e}")
-                    import traceback
-                    traceback.print_exc()  # Log detailed traceback
-
-                await asyncio.sleep(retry_interval)
-
+    def init_metrics(self):
+        """Create the connection health metrics, rendered by the server that owns this client."""
+        self.metrics = metrics = MetricsRegistry(prefix='skybox_client_')
+
+        def health(field):
+            return lambda: {(('connection', root),): supervisor.health()[field] or 0
+                            for root, supervisor in self.supervisors.items()}
+        metrics.gauge('connection_up', 'Whether each upstream connection is subscribed (1) or not (0)',
+                      lambda: {(('connection', root),): int(supervisor.state == 'connected')
+                               for root, supervisor in self.supervisors.items()})
+        metrics.gauge('seconds_since_message', 'Seconds since each connection last received a message',
+                      health('seconds_since_message'))
+        metrics.gauge('connects_total', 'Successful connects per upstream connection', health('connects'))
+        metrics.gauge('reconnects_total', 'Reconnect attempts per upstream connection', health('reconnects'))
+        metrics.gauge('watchdog_timeouts_total', 'Connections closed by the watchdog', health('watchdog_timeouts'))
+        metrics.gauge('messages_received_total', 'Messages received per upstream connection', health('messages'))
+        metrics.gauge('dispatch_queue_depth', 'Roots with a state update waiting for the handler',
+                      lambda: len(self.dispatcher))
+        metrics.gauge('dispatched_updates_total', 'State updates passed to the handler',
+                      lambda: self.dispatcher.dispatched)
+        metrics.gauge('coalesced_updates_total', 'State updates merged into one already waiting',
+                      lambda: self.dispatcher.coalesced)
+        self.handler_time = metrics.histogram('state_handler_seconds', 'Time spent in the state update handler')
+
+    @property
+    def current_state(self):
+        """The nested state dictionary held by the state store."""
+        return self.state.data
+
+    @current_state.setter
+    def current_state(self, data):
+        self.state.reset(data)
 
     async def subscribe(self, websocket, name):
-        """Subscribe to a specific service and initialize the last_broadcast_time for that subscription."""
-    
-        # Ensure the dictionary to track the last broadcast time exists
-        if not hasattr(self, 'last_broadcast_times'):
-            self.last_broadcast_times = {}
-
-        # Initialize the last_broadcast_time for the specific subscription (name)
-        self.last_broadcast_times[name] = time.time()
-
+        """Send the subscription for a specific service."""
         # Extract the subscription command for the specified name
         subscribe_command = self.subscriptions[name]
-        await websocket.send(json.dumps(subscribe_command))
+        resume = self.resume_points.get(name)
+        if resume and resume['since'] is not None:
+            # Only ask for what changed since the last notification we received
+            params = dict(subscribe_command.get('params', {}), **resume)
+            subscribe_command = dict(subscribe_command, params=params)
+        message = json.dumps(subscribe_command)
+        if self.recorder is not None:
+            self.recorder.outbound(name, message)
+        await websocket.send(message)
 
         if self.debug:
             print(f"Subscribed to {name}")
 
 
-    async def listen(self, websocket, root, name):
-        while self.running:
-            try:
-                message = await websocket.recv()
-                data = json.loads(message)
-                #print(f"data = {data}")
-                if 'method' in data and data['method'].endswith('disconnected'):
-                    if self.debug:
-                        print(f"Received '{data['method']}' for {name}. Attempting to reconnect...")
-                    # Stop the client and reconnect dynamically based on root
-                    await self.stop()
-                    # Reconnect and resubscribe dynamically
-                    await self.reconnect_to_service(root)
-                elif 'method' in data and data['method'].endswith('update'):
-                    await self.update_state(data['params'][0], root)
-                elif 'result' in data and 'status' in data['result']:
-                    await self.update_state(data['result']['status'], root)
-            except websockets.ConnectionClosed:
-                if self.debug:
-                    print(f"Connection to {name} closed")
-                break
-            except Exception as e:
-                if self.debug:
-                    print(f"Error while listening to {name}: {e}")
-                break
-
-    async def check_broadcast_timeout(self, timeout_interval=30):
-        """ Periodically check if broadcasts from Moonraker are being received for each subscription. """
-        while self.running:
-            await asyncio.sleep(10)  # Check every 10 seconds
-            print(self.last_broadcast_times)
- 
-            # Loop through each subscription (root) and check the last broadcast time
-            for root, last_time in self.last_broadcast_times.items():
-                time_since_last_broadcast = time.time() - last_time
-                if time_since_last_broadcast > timeout_interval:
-                    if self.debug:
-                        print(f"Timeout detected for {root}: No broadcasts for {timeout_interval} seconds.")
-                    # Trigger reconnection or resubscription for this root
-                    await self.reconnect_to_service(root)
-
-    async def reconnect_to_service(self, root):
-        """Reconnect to a service and resubscribe to broadcasts dynamically based on the root."""
-        if self.debug:
-            print(f"Reconnecting to service for {root}...")
-
-        # Check if the connection exists for the given root and close it if it's open
-        if root in self.connections and self.connections[root].open:
-            await self.connections[root].close()
+    async def handle_message(self, message, root, supervisor):
+        """Process one message received on the connection of root."""
+        if self.recorder is not None:
+            self.recorder.inbound(root, message)
+        try:
+            data = codec.json_codec.decode(message)
+        except ValueError as e:
             if self.debug:
-                print(f"Closed existing WebSocket connection for {root}.")
-
-        # Use the URI from self.connections for this specific root
-        service_uri = self.connections.get(root, {}).get("uri", None)
-
-        if not service_uri:
+                print(f"Invalid message from {root}: {e}")
+            return
+        if not isinstance(data, dict):
+            return
+        #print(f"data = {data}")
+        self.track_resume_point(root, data)
+        method = data.get('method', '')
+        if not isinstance(method, str):
+            return
+        if method.endswith('disconnected'):
             if self.debug:
-                print(f"No URI found for {root}, skipping reconnection.")
+                print(f"Received '{method}' for {root}. Reconnecting...")
+            await supervisor.reconnect()
+        elif method == 'notify_klippy_ready':
+            # Klippy restarted behind Moonraker, which dropped our subscription
+            await supervisor.resubscribe()
+        elif method.endswith('update'):
+            params = data.get('params')
+            if isinstance(params, list) and params and isinstance(params[0], dict):
+                await self.update_state(params[0], root)
+            elif self.debug:
+                print(f"Ignoring '{method}' from {root} without a status in its params")
+        elif isinstance(data.get('result'), dict) and 'status' in data['result']:
+            await self.update_state(data['result']['status'], root)
+
+    def track_resume_point(self, name, data):
+        """Remember the epoch and seq a server sends, to resume its subscription after reconnecting.
+
+        The epoch comes with the subscribe response and the seq with each
+        notification. Servers that send neither, like Moonraker, are always
+        resubscribed from scratch.
+        """
+        if not isinstance(data, dict):
             return
-
-        # Reconnect using the connection URI and the root
-        await self.connect_with_retries(service_uri, root, root)
-
-        # After reconnecting, resubscribe using the subscriptions for this root
-        if root in self.subscriptions:
-            subscribe_command = self.subscriptions[root]
-            await self.subscribe(subscribe_command, root)
-
-        if self.debug:
-            print(f"Successfully reconnected and resubscribed to {root}.")
+        result = data.get('result')
+        if isinstance(result, dict) and 'epoch' in result:
+            resume = self.resume_points.get(name)
+            if resume is None or resume['epoch'] != result['epoch']:
+                self.resume_points[name] = {'epoch': result['epoch'], 'since': None}
+        elif data.get('method') == 'notify_status_update' and name in self.resume_points:
+            params = data.get('params', [])
+            if isinstance(params, list) and len(params) > 2:
+                self.resume_points[name]['since'] = params[2]
+
+    def forget_resume_point(self, name):
+        """Make the next subscribe of name ask for the full state, e.g. after its objects changed."""
+        resume = self.resume_points.get(name)
+        if resume is not None:
+            resume['since'] = None
 
     async def update_state(self, updated_objects, root):
         """Update the state dictionary with the objects that have changed."""
-        if root not in self.current_state:
-            self.current_state[root] = {}
         if self.debug:
             print(f"updated_objects = {updated_objects}")
 
-        self.deep_update(self.current_state[root], updated_objects)
-
+        changes = self.state.update({root: updated_objects})
+        if self.path_callbacks:
+            watched = [change for change in changes if self.find_path_callbacks(change[0])]
+            if watched:
+                self.dispatcher.put_changes(watched)
+
+        # The handlers run on the dispatcher's task, so a slow handler does not hold up reading the socket
+        self.dispatcher.put(root, updated_objects)
+
+    def add_path_callback(self, path, callback):
+        """Call callback(path, old, new) when a value at or below a dotted path like 'moonraker.extruder.target' changes.
+
+        The callback may be a function or a coroutine function, and gets the
+        dotted path of the changed leaf with its previous and new value.
+        """
+        self.path_callbacks.setdefault(compile_path(path), []).append(callback)
+
+    def remove_path_callback(self, path, callback):
+        key = compile_path(path)
+        callbacks = self.path_callbacks.get(key, [])
+        if callback in callbacks:
+            callbacks.remove(callback)
+        if not callbacks:
+            self.path_callbacks.pop(key, None)
+
+    async def replay_path_callback(self, path, callback):
+        """Call callback(path, None, value) for every leaf the state already holds at or below a dotted path.
+
+        A callback added after its values arrived is otherwise only called
+        when they next change.
+        """
+        key = compile_path(path)
+        value = self.state.get(key)
+        if value is None:
+            return
+        for leaf_path, leaf in iter_leaves(key, value):
+            result = callback('.'.join(leaf_path), None, leaf)
+            if asyncio.iscoroutine(result):
+                await result
+
+    def find_path_callbacks(self, path):
+        """Return the callbacks registered for a key tuple or any of its parents."""
+        callbacks = []
+        for depth in range(1, len(path) + 1):
+            callbacks.extend(self.path_callbacks.get(path[:depth], ()))
+        return callbacks
+
+    async def run_path_callbacks(self, path, old, new):
+        dotted = '.'.join(path)
+        for callback in self.find_path_callbacks(path):
+            result = callback(dotted, old, new)
+            if asyncio.iscoroutine(result):
+                await result
+
+    async def run_state_handler(self, root, updated_objects):
+        """Call on_state_update, which may be replaced by the owner of the client."""
         if self.on_state_update:
             await self.on_state_update(root, updated_objects)
 
-    def deep_update(self, source, updates):
-        """Recursively update the source dictionary with updates."""
-        for key, value in updates.items():
-            if isinstance(value, dict) and key in source and isinstance(source[key], dict):
-                self.deep_update(source[key], value)
-            else:
-                source[key] = value
-
     def get_state(self, path, default=None):
         """Get the value from self.current_state specified by the path."""
-        keys = path.split('.')
-        current_dict = self.current_state
-        for key in keys:
-            if isinstance(current_dict, dict) and key in current_dict:
-                current_dict = current_dict[key]
-            else:
-                return default
-        if default is not None and current_dict is not None:
-            if self.debug and type(default) != type(current_dict):
-                print(f'get_state() type mismatch {type(default)} {type(current_dict)}')
-        return current_dict if current_dict is not None else default
+        value = self.state.get(path)
+        if default is not None and value is not None:
+            if self.debug and type(default) != type(value):
+                print(f'get_state() type mismatch {type(default)} {type(value)}')
+        return value if value is not None else default
 
     async def on_state_update(self, root, updated_objects):
         """Hook method for handling state updates."""
@@ -224,11 +213,26 @@ class BaseWebSocketClient:
         pass
 
     async def run_connections(self):
+        """Start the update dispatcher and one supervisor per connection, and wait until they stop."""
+        self.dispatcher.start()
         for connection in self.connections:
             for root, uri in connection.items():
-                task = asyncio.create_task(self.connect_with_retries(uri, root, root))
-                self.connection_tasks.append(task)
-        await asyncio.gather(*self.connection_tasks)
+                if root not in self.supervisors:
+                    self.supervisors[root] = self.create_supervisor(root, uri)
+        await asyncio.gather(*[supervisor.start() for supervisor in self.supervisors.values()],
+                             return_exceptions=True)
+
+    def create_supervisor(self, root, uri):
+        return ConnectionSupervisor(self, root, uri, Backoff(self.retry_initial, self.retry_max),
+                                    watchdog_timeout=self.watchdog_timeout, debug=self.debug)
+
+    def add_connection(self, root, uri, subscription):
+        """Add a connection and its subscription, connecting at once if the client is already running."""
+        self.connections.append({root: uri})
+        self.subscriptions[root] = subscription
+        if self.running and root not in self.supervisors:
+            self.supervisors[root] = self.create_supervisor(root, uri)
+            self.supervisors[root].start()
 
     async def start(self):
         if self.debug:
@@ -238,14 +242,19 @@ class BaseWebSocketClient:
 
     async def stop(self):
         self.running = False
-        for task in self.connection_tasks:
-            task.cancel()
-        await asyncio.gather(*self.connection_tasks, return_exceptions=True)
-        self.connection_tasks.clear()
+        for supervisor in self.supervisors.values():
+            await supervisor.stop()
+        await self.dispatcher.stop()
+        if self.recorder is not None:
+            self.recorder.flush()
 
     def get_current_state(self):
         return self.current_state
 
+    def connection_health(self):
+        """Return the health of each connection, keyed by root."""
+        return {root: supervisor.health() for root, supervisor in self.supervisors.items()}
+
 # Example usage
 def main():
     connections = [
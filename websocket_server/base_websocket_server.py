@@ -1,120 +1,333 @@
-import json
 import time
 import asyncio
+import functools
+from collections import OrderedDict
 from aiohttp import web
+from websocket_server import codec, rpc
+from websocket_server.change_history import ChangeHistory
+from websocket_server.compression import CompressionSettings
+from websocket_server.metrics import MetricsRegistry, EventLoopMonitor
+from websocket_server.outbound_queue import OutboundQueue
+from websocket_server.profiler import ProfilerEndpoint
+from websocket_server.rpc import MethodRegistry, RequestBatch, RpcError
+from websocket_server.session import Session, Subscription
+from websocket_server.state_store import StateStore, compile_path
+from websocket_server.subscription_filter import SubscriptionFilters, is_number
+from websocket_server.subscription_index import SubscriptionIndex, WILDCARD
+
+LONG_POLL_PARAMS = frozenset(('since', 'epoch', 'timeout'))
+# Encoded HTTP responses kept per state seq, least recently used dropped first
+HTTP_CACHE_SIZE = 32
 
 class BaseWebSocketServer:
-    def __init__(self, host='0.0.0.0', port=8080, debug=False):
+    def __init__(self, host='0.0.0.0', port=8080, debug=False, queue_size=64, send_timeout=5.0, max_dropped=256,
+                 coalesce_interval=0.0, compression=None, method_limits=None, history_size=256, profiler=False,
+                 recorder=None):
         self.host = host
         self.port = port
         self.debug = debug
+        self.queue_size = queue_size
+        self.send_timeout = send_timeout
+        self.max_dropped = max_dropped
+        self.coalesce_interval = coalesce_interval
+        self.compression = compression if compression is not None else CompressionSettings()
         self.running = False
-        self.subscribers = set()
+        self.sessions = {}
+        self.subscription_index = SubscriptionIndex()
+        self.connection_count = 0
         self.loop = None
-        self.current_state = {}
-        self.last_sent_state = {}
+        self.state = StateStore(history=ChangeHistory(history_size))
+        self.pending_paths = set()
+        self.pending_flush = None
+        self.state_changed = None
+        self.http_cache = OrderedDict()
+        self.http_cache_seq = None
+        self.method_limits = method_limits or {}
+        self.profiler = ProfilerEndpoint(debug=debug) if profiler else None
+        self.recorder = recorder
+        self.methods = MethodRegistry()
+        self.register_methods()
+        self.init_metrics()
 
         if self.debug:
             print(f"Initialized BaseWebSocketServer with host={self.host}, port={self.port}")
 
+    def init_metrics(self):
+        """Create the metrics served at /metrics."""
+        self.metrics = metrics = MetricsRegistry(prefix='skybox_ws_')
+        metrics.gauge('subscribers', 'Number of active subscriptions', lambda: len(self.subscription_index))
+        metrics.gauge('connections', 'Number of open websocket sessions', lambda: len(self.sessions))
+        self.sessions_opened = metrics.counter('sessions_opened_total', 'Websocket sessions opened')
+        metrics.gauge('session_bytes', 'Estimated bytes held by each session',
+                      lambda: {(('connection', session.name),): session.memory_usage()
+                               for session in self.sessions.values()})
+        self.messages_in = metrics.counter('messages_in_total', 'Messages received, by method')
+        self.messages_out = metrics.counter('messages_out_total', 'Messages queued for sending, by method')
+        self.broadcast_latency = metrics.histogram('broadcast_seconds', 'Time to fan a state change out to subscribers')
+        self.broadcast_fanout = metrics.histogram('broadcast_fanout', 'Subscribers notified per state change',
+                                                  buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500))
+        self.encode_time = metrics.histogram('encode_seconds', 'Time spent encoding notification params')
+        self.filtered_notifications = metrics.counter('filtered_notifications_total',
+                                                      'Notifications skipped by subscription deadband filters')
+        metrics.gauge('queue_depth', 'Messages waiting in each connection\'s outbound queue',
+                      lambda: {(('connection', session.name),): len(session.queue) for session in self.sessions.values()})
+        self.dropped_messages = metrics.counter('dropped_messages_total', 'Messages dropped from full outbound queues')
+        self.evicted_connections = metrics.counter('evicted_connections_total', 'Slow connections that were evicted')
+        self.loop_lag = metrics.histogram('event_loop_lag_seconds', 'How late the event loop runs a periodic timer')
+        self.loop_monitor = EventLoopMonitor(self.loop_lag)
+
+    def register_methods(self):
+        """Register the JSON-RPC methods served on the websocket. Subclasses can add their own."""
+        for prefix in ('', 'printer.objects.'):
+            self.register_method(prefix + 'subscribe', self.handle_subscribe)
+            self.register_method(prefix + 'query', self.handle_query)
+            self.register_method(prefix + 'update', self.handle_update)
+            self.register_method(prefix + 'resync', self.handle_resync)
+
+    def register_method(self, name, handler, max_concurrent=None):
+        """Register handler(request, ws, batch) for a method, limited by method_limits if configured."""
+        self.methods.register(name, handler, self.method_limits.get(name, max_concurrent))
+
+    @property
+    def current_state(self):
+        """The nested state dictionary held by the state store."""
+        return self.state.data
+
+    @current_state.setter
+    def current_state(self, data):
+        self.state.reset(data)
+
     def get_state(self, path, default=None):
         """Get the value from self.current_state specified by the path."""
-        keys = path.split('.')
-        current_dict = self.current_state
-        for key in keys:
-            if isinstance(current_dict, dict) and key in current_dict:
-                current_dict = current_dict[key]
-            else:
-                return default
-        if default is not None and type(default) != type(current_dict):
-            print(f'get_state() type mismatch {type(default)} {type(current_dict)}')
-        return current_dict if current_dict is not None else default
+        value = self.state.get(path)
+        if default is not None and value is not None and type(default) != type(value):
+            print(f'get_state() type mismatch {type(default)} {type(value)}')
+        return value if value is not None else default
 
     async def broadcast_state_update(self, new_state):
-        """Broadcast the server state to all subscribers if there are changes."""
-        changed_objects = self.detect_changes(new_state)
-        if not changed_objects:
+        """Apply new_state and broadcast the changes to the affected subscribers."""
+        changes = self.detect_changes(new_state)
+        if changes:
+            await self.broadcast_changes([path for path, _, _ in changes])
+
+    async def broadcast_changes(self, changed_paths):
+        """Notify the subscribers whose requested paths are affected by changed_paths."""
+        start = time.perf_counter()
+        eventtime = time.time()
+        encoded_params = {}
+        subscriptions = self.subscription_index.match(changed_paths)
+        for subscription in subscriptions:
+            if subscription.filters is not None and not self.passes_filters(subscription, changed_paths):
+                continue
+            try:
+                await self.notify_subscriber(subscription, eventtime, encoded_params)
+            except Exception as e:
+                if self.debug:
+                    print(f'Error broadcasting state update: {e}')
+        self.broadcast_fanout.observe(len(subscriptions))
+        self.broadcast_latency.observe(time.perf_counter() - start)
+
+    def passes_filters(self, subscription, changed_paths):
+        """Check a subscription's path filters before anything is encoded for it.
+
+        A change held back only by a min_interval is sent with a deferred
+        notification once the interval has passed.
+        """
+        notify, wait = subscription.filters.check(changed_paths, self.state.get, time.monotonic())
+        if notify:
+            return True
+        self.filtered_notifications.inc()
+        if wait is not None and subscription.deferred is None:
+            subscription.deferred = asyncio.get_event_loop().call_later(
+                wait, lambda: asyncio.ensure_future(self.flush_deferred_notification(subscription)))
+        return False
+
+    def record_filtered_values(self, subscription):
+        """Remember the values and time a filtered subscription is notified with."""
+        filters = subscription.filters
+        now = time.monotonic()
+        for key in filters.filters:
+            self.flatten_value(self.state.get(key), key, filters.sent_values)
+            filters.sent_times[key] = now
+
+    async def notify_subscriber(self, subscription, eventtime, encoded_params=None, full=False):
+        """Queue a notify_status_update for one subscription.
+
+        Delta subscribers only receive the leaf values that differ from what
+        they were last sent, unless full is set. Subscribers whose payloads are
+        identical share one encoded entry in encoded_params.
+        """
+        session = subscription.session
+        requested_paths = subscription.paths
+        if encoded_params is None:
+            encoded_params = {}
+        if not full and self.defer_notification(subscription):
+            return
+        delta = subscription.delta
+        snapshot = None
+        cache_key = ('full', requested_paths)
+        if delta:
+            snapshot = self.get_leaf_snapshot(requested_paths)
+            last_sent = None if full else subscription.last_sent
+            if last_sent is not None:
+                changed = self.get_changed_leaves(last_sent, snapshot)
+                if not changed:
+                    return
+                cache_key = ('delta', changed)
+
+        cached = encoded_params.get(cache_key)
+        if cached is None:
+            if cache_key[0] == 'delta':
+                response_params = self.build_delta_params(cache_key[1], snapshot)
+            else:
+                response_params = self.extract_state_params(requested_paths)
+            cached = encoded_params[cache_key] = (response_params, {})
+        response_params, encoded = cached
+        # Encode the params once per codec and share them between subscribers
+        ws_codec = session.codec
+        params = encoded.get(ws_codec.name)
+        if params is None:
+            with self.encode_time.time(codec=ws_codec.name):
+                params = encoded[ws_codec.name] = ws_codec.encode([response_params, eventtime, self.state.seq])
+        if self.debug:
+            print(f"Broadcasting state update to subscriber {subscription.sub_id} with params {response_params}")
+        on_sent = functools.partial(self.update_last_sent_state, subscription, snapshot) if delta else None
+        subscription.last_notify = time.monotonic()
+        if subscription.filters is not None:
+            self.record_filtered_values(subscription)
+        self.messages_out.inc(method='notify_status_update')
+        await self.send_message(session.ws, ws_codec.encode_notification(params, subscription.sub_id),
+                                key=subscription, on_sent=on_sent)
+
+    def defer_notification(self, subscription):
+        """Hold back a notification that would exceed the subscription's max_rate.
+
+        The deferred notification is sent once the interval has passed and
+        carries the state as it is at that time.
+        """
+        if not subscription.min_interval:
+            return False
+        wait = subscription.last_notify + subscription.min_interval - time.monotonic()
+        if wait <= 0:
+            return False
+        if subscription.deferred is None:
+            subscription.deferred = asyncio.get_event_loop().call_later(
+                wait, lambda: asyncio.ensure_future(self.flush_deferred_notification(subscription)))
+        return True
+
+    async def flush_deferred_notification(self, subscription):
+        """Send a notification that was held back by the subscription's max_rate."""
+        subscription.deferred = None
+        if subscription.session.subscriptions.get(subscription.sub_id) is not subscription:
+            return
+        try:
+            await self.notify_subscriber(subscription, time.time())
+        except Exception as e:
             if self.debug:
-                pass
+                print(f'Error sending deferred state update: {e}')
+
+    def get_codec(self, ws):
+        """Return the codec negotiated for a websocket connection."""
+        session = self.sessions.get(ws)
+        return session.codec if session is not None else codec.json_codec
+
+    async def send_response(self, ws, response, method=None):
+        """Encode a response with the connection's codec and send it."""
+        self.messages_out.inc(method=method or 'response')
+        await self.send_message(ws, self.get_codec(ws).encode(response))
+
+    async def send_message(self, ws, message, key=None, on_sent=None):
+        """Send an encoded message through the connection's outbound queue.
+
+        Messages with a key replace a pending message with the same key. If the
+        connection has no queue the message is sent directly.
+        """
+        session = self.sessions.get(ws)
+        if session is not None and session.queue is not None:
+            session.queue.put(message, key, on_sent)
             return
-
-        for ws, sub_id, requested_paths in self.subscribers:
-            if self.has_requested_objects_changed(requested_paths, changed_objects):
-                requested_objects = {path: self.get_nested_value(self.current_state, path.split('.')) for path in requested_paths}
-                response_params = self.extract_state_params(requested_objects)
-                response = {
-                    "jsonrpc": "2.0",
-                    "method": "notify_status_update",
-                    "params": [response_params, time.time()],
-                    "id": sub_id
-                }
-                try:
-                    message = json.dumps(response)
-                    if self.debug:
-                        print(f"Broadcasting state update to subscriber {sub_id} with params {response_params}")
-                    await ws.send_str(message)
-                    self.update_last_sent_state(ws, requested_paths, response_params)
-                except Exception as e:
-                    if self.debug:
-                        print(f'Error broadcasting state update: {e}')
+        if self.recorder is not None and session is not None:
+            self.recorder.outbound(session.name, message)
+        if isinstance(message, bytes):
+            await ws.send_bytes(message)
+        else:
+            await ws.send_str(message)
+        if on_sent:
+            on_sent()
+
+    def next_connection_name(self, request):
+        """Return a unique label for a new connection, used in metrics and debug output."""
+        self.connection_count += 1
+        return f"{request.remote}#{self.connection_count}"
+
+    def evict_subscriber(self, queue):
+        """Close a connection whose outbound queue could not keep up."""
+        self.evicted_connections.inc()
+        if self.debug:
+            print(f"Evicting slow subscriber after {queue.dropped} dropped messages "
+                  f"({self.evicted_connections.get()} evicted in total)")
+        asyncio.ensure_future(queue.ws.close())
 
     def detect_changes(self, new_state):
-        """Detect changes between the new state and the current state."""
-        changes = self.deep_compare(self.current_state, new_state)
+        """Merge new_state into the state store and return the changed leaves as (path, old, new)."""
+        changes = self.state.update(new_state)
         if changes:
-            self.deep_update(self.current_state, new_state)
+            self.wake_state_waiters()
         return changes
 
-    def deep_compare(self, old, new, path=""):
-        """Recursively compare old and new state dictionaries to detect changes."""
-        changes = {}
-        for key in old.keys() | new.keys():
-            if key in old and key in new:
-                if isinstance(old[key], dict) and isinstance(new[key], dict):
-                    nested_changes = self.deep_compare(old[key], new[key], path + f".{key}")
-                    if nested_changes:
-                        changes[key] = nested_changes
-                elif old[key] != new[key]:
-                    changes[key] = (old[key], new[key])
-            elif key in old:
-                changes[key] = (old[key], None)
-            else:
-                changes[key] = (None, new[key])
-        return changes
+    def mark_state_changed(self):
+        """Advance the state sequence number after current_state was modified in place."""
+        self.state.touch()
+        self.wake_state_waiters()
 
-    def deep_update(self, source, updates):
-        """Recursively update the source dictionary with updates."""
-        for key, value in updates.items():
-            if isinstance(value, dict) and key in source and isinstance(source[key], dict):
-                self.deep_update(source[key], value)
-            else:
-                source[key] = value
+    def wake_state_waiters(self):
+        """Release the long-poll requests waiting for the next state change."""
+        if self.state_changed is not None:
+            self.state_changed.set()
+            self.state_changed = None
+
+    async def wait_for_state_change(self, since, timeout):
+        """Wait until the state sequence number is past since, or timeout seconds elapse."""
+        if self.state.seq > since:
+            return
+        if self.state_changed is None:
+            self.state_changed = asyncio.Event()
+        try:
+            await asyncio.wait_for(self.state_changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
 
     async def websocket_handler(self, request):
         """Handle incoming WebSocket connections and requests."""
         if self.debug:
             print(f"Handling new WebSocket connection from {request.remote}")
-        ws = web.WebSocketResponse()
+        ws = self.compression.create_response(protocols=codec.subprotocols())
         await ws.prepare(request)
+        self.compression.configure(ws)
+        name = self.next_connection_name(request)
+        ws_codec = codec.get_codec(ws.ws_protocol)
+        queue = OutboundQueue(ws, self.queue_size, self.send_timeout, self.max_dropped,
+                              on_evict=self.evict_subscriber, on_drop=lambda queue: self.dropped_messages.inc(),
+                              compression=self.compression, name=name, recorder=self.recorder, debug=self.debug)
+        session = self.sessions[ws] = Session(ws, name, ws_codec, queue.start())
+        self.sessions_opened.inc()
+        if self.recorder is not None:
+            self.recorder.opened(name, 'server')
 
         try:
             async for msg in ws:
-                if msg.type == web.WSMsgType.TEXT:
-                    request = json.loads(msg.data)
+                if msg.type == web.WSMsgType.TEXT or (msg.type == web.WSMsgType.BINARY and ws_codec.binary):
+                    if self.recorder is not None:
+                        self.recorder.inbound(name, msg.data)
+                    try:
+                        request = ws_codec.decode(msg.data)
+                    except Exception as e:
+                        error = RpcError(rpc.PARSE_ERROR, 'Parse error', str(e))
+                        await self.send_response(ws, rpc.error_response(None, error), 'error')
+                        continue
                     if self.debug:
                         print(f"Received message: {request}")
-
-                    if await self.process_custom_methods(request, ws):
-                        continue
-
-                    if 'method' in request:
-                        method = request['method']
-                        if method.endswith('subscribe'):
-                            await self.handle_subscribe(request, ws)
-                        elif method.endswith('query'):
-                            await self.handle_query(request, ws)
-                        elif method.endswith('update'):
-                            await self.handle_update(request, ws)
+                    await self.process_frame(request, ws)
                 elif msg.type == web.WSMsgType.ERROR:
                     if self.debug:
                         print(f'WebSocket connection closed with exception {ws.exception()}')
@@ -122,60 +335,257 @@ class BaseWebSocketServer:
             if self.debug:
                 print(f'WebSocket error: {e}')
         finally:
-            self.subscribers = {(subscriber_ws, subscriber_id, requested_paths) for
-                                subscriber_ws, subscriber_id, requested_paths in self.subscribers if
-                                subscriber_ws != ws}
-            if self.debug and 'remote' in request:
-                print(f"WebSocket connection from {request.remote} closed.")
+            self.close_session(session)
+            if self.recorder is not None:
+                self.recorder.closed(name)
+            if self.debug:
+                print(f"WebSocket connection {session.name} closed.")
             await ws.close()
         return ws
 
-    async def handle_subscribe(self, request, ws):
-        """Handle subscription requests from clients."""
+    def close_session(self, session):
+        """Release everything held for a connection: its subscriptions, timers and outbound queue."""
+        self.sessions.pop(session.ws, None)
+        for subscription in session.subscriptions.values():
+            self.subscription_index.remove(subscription)
+            subscription.cancel()
+        session.subscriptions.clear()
+        if session.queue is not None:
+            session.queue.close()
+
+    async def process_frame(self, request, ws):
+        """Run the call, or JSON-RPC batch of calls, received in one frame.
+
+        The responses of a batch are sent together in one frame. State changes
+        made by the calls are broadcast once, after the response and after the
+        work the calls queued with batch.after_response.
+        """
+        batch = RequestBatch(ws)
+        if isinstance(request, list):
+            if request:
+                responses = [response for response in [await self.dispatch(call, ws, batch) for call in request]
+                             if response is not None]
+            else:
+                responses = rpc.error_response(None, RpcError(rpc.INVALID_REQUEST, 'Invalid Request'))
+            method = 'batch'
+        else:
+            responses = await self.dispatch(request, ws, batch)
+            method = request.get('method') if isinstance(request, dict) else None
+        if responses:
+            await self.send_response(ws, responses, method)
+        for coroutine_function, args, kwargs in batch.followups:
+            await coroutine_function(*args, **kwargs)
+        if batch.changed_paths:
+            await self.schedule_changes(batch.changed_paths)
+
+    async def dispatch(self, request, ws, batch):
+        """Run one JSON-RPC call and return its response, or None if it was a notification."""
+        if not isinstance(request, dict) or not isinstance(request.get('method'), str):
+            self.messages_in.inc(method='invalid')
+            request_id = request.get('id') if isinstance(request, dict) else None
+            return rpc.error_response(request_id, RpcError(rpc.INVALID_REQUEST, 'Invalid Request'))
+        method = self.methods.get(request['method'])
+        self.messages_in.inc(method=request['method'] if method else 'other')
+        if await self.process_custom_methods(request, ws):
+            return None
+        try:
+            if method is None:
+                raise RpcError(rpc.METHOD_NOT_FOUND, 'Method not found', request['method'])
+            result = await method.call(request, ws, batch)
+        except RpcError as e:
+            error = e
+        except Exception as e:
+            if self.debug:
+                print(f"Error in {request['method']}: {e}")
+            error = RpcError(rpc.INTERNAL_ERROR, 'Internal error', str(e))
+        else:
+            return rpc.result_response(request['id'], result) if 'id' in request else None
+        return rpc.error_response(request['id'], error) if 'id' in request else None
+
+    def get_params(self, request):
+        """Return the params of a request, which have to be an object if present."""
+        params = request.get('params', {})
+        if not isinstance(params, dict):
+            raise RpcError(rpc.INVALID_PARAMS, 'Invalid params', 'params must be an object')
+        return params
+
+    async def handle_subscribe(self, request, ws, batch):
+        """Handle subscription requests from clients.
+
+        Besides objects, the params may set delta, max_rate, since and epoch,
+        and filters of the form {path: {"deadband": x, "relative": r,
+        "min_interval": seconds}} for the leaves at or below path.
+        """
         sub_id = request.get('id')
-        requested_objects = request.get('params').get('objects', {})
+        params = self.get_params(request)
+        requested_objects = params.get('objects', {})
+        if not isinstance(requested_objects, dict):
+            raise RpcError(rpc.INVALID_PARAMS, 'Invalid params', 'objects must be an object')
         requested_paths = frozenset(self.get_all_paths(requested_objects))
-        self.subscribers.add((ws, sub_id, requested_paths))
+        max_rate = params.get('max_rate')
+        if max_rate is not None and not (is_number(max_rate) and max_rate > 0):
+            raise RpcError(rpc.INVALID_PARAMS, 'Invalid params', 'max_rate must be a positive number')
+        filters = None
+        if params.get('filters'):
+            try:
+                filters = SubscriptionFilters.from_params(
+                    params['filters'], [self.subscription_index.split_path(path) for path in requested_paths])
+            except ValueError as e:
+                raise RpcError(rpc.INVALID_PARAMS, 'Invalid params', str(e))
+        subscription = Subscription(self.sessions[ws], sub_id, requested_paths, delta=bool(params.get('delta', False)),
+                                    min_interval=1.0 / max_rate if max_rate else 0, filters=filters)
+        self.add_subscription(subscription)
         if self.debug:
-            print(f"Subscription request received: id={sub_id}, params={request.get('params')}")
-        await ws.send_str(json.dumps({"jsonrpc": "2.0", "result": {}, "id": sub_id}))
-
-        # Send the current state immediately
-        initial_state = {path: self.get_nested_value(self.current_state, path.split('.')) for path in requested_paths}
-        initial_response = {
-            "jsonrpc": "2.0",
-            "method": "notify_status_update",
-            "params": [initial_state, time.time()],
-            "id": sub_id
-        }
-        await ws.send_str(json.dumps(initial_response))
-        self.update_last_sent_state(ws, requested_paths, initial_state)
-
-    async def handle_query(self, request, ws):
+            print(f"Subscription request received: id={sub_id}, params={params}")
+
+        # Send the current state, or what changed since the client's last seq, right after the response
+        since = params.get('since')
+        if isinstance(since, int):
+            batch.after_response(self.resume_subscriber, subscription, since, params.get('epoch'))
+        else:
+            batch.after_response(self.notify_subscriber, subscription, time.time(), full=True)
+        return {"seq": self.state.seq, "epoch": self.state.history.epoch}
+
+    async def resume_subscriber(self, subscription, since, epoch=None):
+        """Catch up a resubscribing client on the changes it missed after seq since.
+
+        Only the requested paths touched by those changes are sent. If the
+        change history no longer reaches back to since, or since came from
+        another server process, the full state is sent instead.
+        """
+        changed = self.state.changes_since(since, epoch)
+        if changed is None:
+            await self.notify_subscriber(subscription, time.time(), full=True)
+            return
+        session, sub_id, requested_paths = subscription.session, subscription.sub_id, subscription.paths
+        split_path = self.subscription_index.split_path
+        delta = subscription.delta
+        if delta:
+            # Delta snapshots are keyed by (requested path, sub keys...), compare them as state key tuples
+            snapshot = self.get_leaf_snapshot(requested_paths)
+            affected = frozenset(leaf for leaf in snapshot
+                                 if any(self.paths_overlap(split_path(leaf[0]) + leaf[1:], key) for key in changed))
+        else:
+            affected = [path for path in requested_paths
+                        if any(self.paths_overlap(split_path(path), key) for key in changed)]
+        if self.debug:
+            print(f"Resuming subscriber {sub_id} from seq {since}: {len(affected)} paths changed")
+        if not affected:
+            if delta:
+                self.update_last_sent_state(subscription, snapshot)
+            return
+        if delta:
+            response_params = self.build_delta_params(affected, snapshot)
+            on_sent = functools.partial(self.update_last_sent_state, subscription, snapshot)
+        else:
+            response_params = self.extract_state_params(affected)
+            on_sent = None
+        params = session.codec.encode([response_params, time.time(), self.state.seq])
+        self.messages_out.inc(method='notify_status_update')
+        await self.send_message(session.ws, session.codec.encode_notification(params, sub_id), key=subscription,
+                                on_sent=on_sent)
+
+    def paths_overlap(self, a, b):
+        """Return True if one key tuple equals or is a prefix of the other."""
+        return a[:len(b)] == b or b[:len(a)] == a
+
+    async def handle_resync(self, request, ws, batch):
+        """Handle requests to resend the full requested state to every subscription of a connection."""
+        batch.after_response(self.resync_connection, ws)
+        return {}
+
+    async def resync_connection(self, ws):
+        """Send the full requested state to every subscription of a connection."""
+        eventtime = time.time()
+        encoded_params = {}
+        session = self.sessions.get(ws)
+        if session is None:
+            return
+        for subscription in list(session.subscriptions.values()):
+            await self.notify_subscriber(subscription, eventtime, encoded_params, full=True)
+
+    def add_subscription(self, subscription):
+        """Register a subscription with its session and in the path index, replacing one with the same id."""
+        session = subscription.session
+        previous = session.subscriptions.get(subscription.sub_id)
+        if previous is not None:
+            self.remove_subscription(previous)
+        session.subscriptions[subscription.sub_id] = subscription
+        self.subscription_index.add(subscription, subscription.paths)
+
+    def remove_subscription(self, subscription):
+        """Drop a subscription, its entries in the path index and any deferred notification."""
+        session = subscription.session
+        if session.subscriptions.get(subscription.sub_id) is subscription:
+            del session.subscriptions[subscription.sub_id]
+        self.subscription_index.remove(subscription)
+        subscription.cancel()
+
+    async def handle_query(self, request, ws, batch):
         """Handle query requests from clients."""
-        requested_paths = self.get_all_paths(request.get('params', {}).get('objects', {}))
-        response_data = {
-            "status": {path: self.get_nested_value(self.current_state, path.split('.')) for path in requested_paths}
-        }
-        response = {
-            "jsonrpc": "2.0",
-            "result": response_data,
-            "id": request["id"]
-        }
+        requested_paths = self.get_all_paths(self.get_params(request).get('objects', {}))
         if self.debug:
-            print(f"Query request received: id={request['id']}, params={request.get('params')}")
-        await ws.send_str(json.dumps(response))
+            print(f"Query request received: id={request.get('id')}, params={request.get('params')}")
+        return {"status": self.extract_state_params(requested_paths)}
 
-    async def handle_update(self, request, ws):
-        """Handle update requests from clients."""
-        new_state = request.get('params', {})
+    async def handle_update(self, request, ws, batch):
+        """Handle update requests from clients.
+
+        The state is updated immediately, the changes are broadcast once the
+        whole frame has been processed.
+        """
+        new_state = self.get_params(request)
         if self.debug:
             print(f"Update request received: {new_state}")
-        self.deep_update(self.current_state, new_state)
-        await self.broadcast_state_update(new_state)
+        batch.changed_paths.update(path for path, _, _ in self.detect_changes(new_state))
+        return {}
+
+    async def schedule_broadcast(self, new_state):
+        """Apply new_state and broadcast the changes now, or with the next coalesced broadcast."""
+        changes = self.detect_changes(new_state)
+        if changes:
+            await self.schedule_changes([path for path, _, _ in changes])
+
+    def publish_state(self, new_state):
+        """Apply new_state from synchronous code and schedule the broadcast of what changed.
+
+        Unlike mark_state_changed, the changed paths are recorded in the
+        change history, so resuming clients get a delta instead of a snapshot.
+        """
+        changes = self.detect_changes(new_state)
+        if changes and self.running:
+            asyncio.ensure_future(self.schedule_changes([path for path, _, _ in changes]))
+        return changes
+
+    async def schedule_changes(self, changed_paths):
+        """Broadcast changed paths now, or with the next coalesced broadcast.
+
+        The state store is updated before this is called so queries always see
+        the latest state. With a coalesce_interval set, the paths changed within
+        one interval are merged and broadcast together when the interval expires.
+        """
+        if self.coalesce_interval <= 0:
+            await self.broadcast_changes(changed_paths)
+            return
+        self.pending_paths.update(changed_paths)
+        if self.pending_flush is None:
+            self.pending_flush = asyncio.get_event_loop().call_later(
+                self.coalesce_interval, lambda: asyncio.ensure_future(self.flush_pending_updates()))
+
+    async def flush_pending_updates(self):
+        """Broadcast the paths changed during the last coalescing interval."""
+        pending, self.pending_paths, self.pending_flush = self.pending_paths, set(), None
+        if pending:
+            try:
+                await self.broadcast_changes(pending)
+            except Exception as e:
+                if self.debug:
+                    print(f'Error broadcasting coalesced state update: {e}')
 
     def get_nested_value(self, data, path):
-        """Get a nested value from a dictionary."""
+        """Get a nested value from a dictionary by key tuple or dotted path."""
+        if isinstance(path, str):
+            path = compile_path(path)
         for key in path:
             if isinstance(data, dict):
                 data = data.get(key)
@@ -184,13 +594,16 @@ class BaseWebSocketServer:
         return data
 
     def get_all_paths(self, obj, parent_key='', sep='.'):
-        """Get all paths from a nested dictionary, supporting wildcard."""
+        """Get all paths from a nested dictionary.
+
+        An object requested as '*' becomes a wildcard path ending in '.*', which
+        is expanded to the leaves below it whenever its values are sent.
+        """
         paths = []
         for k, v in obj.items():
             new_key = f"{parent_key}{sep}{k}" if parent_key else k
-            if v == '*':
-                sub_paths = self.get_all_paths(self.get_nested_value(self.current_state, new_key.split(sep)), new_key, sep=sep)
-                paths.extend(sub_paths)
+            if v == WILDCARD:
+                paths.append(f"{new_key}{sep}{WILDCARD}")
             elif isinstance(v, list):
                 for sub_key in v:
                     paths.append(f"{new_key}{sep}{sub_key}")
@@ -200,29 +613,130 @@ class BaseWebSocketServer:
                 paths.append(new_key)
         return paths
 
-    def update_last_sent_state(self, ws, requested_objects, state_params):
-        """Update the last sent state for a subscriber."""
-        if ws not in self.last_sent_state:
-            self.last_sent_state[ws] = {}
-        for path in requested_objects:
-            self.last_sent_state[ws][path] = self.get_nested_value(state_params, path.split('.'))
+    def expand_path(self, path, sep='.'):
+        """Yield (key, value) for a requested path.
 
-    def has_requested_objects_changed(self, requested_objects, changed_objects):
-        """Check if any of the requested objects have changed."""
-        return any(obj in changed_objects for obj in requested_objects)
+        A wildcard path yields the dotted path and value of every leaf currently
+        below its prefix, any other path yields itself and its value.
+        """
+        if not path.endswith(sep + WILDCARD):
+            yield path, self.state.get(path)
+            return
+        prefix = path[:-len(sep + WILDCARD)]
+        leaves = {}
+        self.flatten_value(self.state.get(prefix), compile_path(prefix, sep), leaves)
+        for key, value in leaves.items():
+            yield sep.join(key), value
+
+    def update_last_sent_state(self, subscription, snapshot):
+        """Record the leaf values that were last sent to a delta subscription."""
+        subscription.last_sent = snapshot
+
+    def get_leaf_snapshot(self, requested_paths):
+        """Flatten the current values of the requested paths into {leaf key tuple: value}."""
+        snapshot = {}
+        for path in requested_paths:
+            for key, value in self.expand_path(path):
+                self.flatten_value(value, (key,), snapshot)
+        return snapshot
+
+    def flatten_value(self, value, key, leaves):
+        """Add the leaves of value to leaves, keyed by their key tuple below key."""
+        if isinstance(value, dict) and value:
+            for sub_key, sub_value in value.items():
+                self.flatten_value(sub_value, key + (sub_key,), leaves)
+        else:
+            leaves[key] = value
+
+    def get_changed_leaves(self, last_sent, snapshot):
+        """Return the leaf keys whose values differ between two snapshots."""
+        changed = {key for key, value in snapshot.items() if key not in last_sent or last_sent[key] != value}
+        changed.update(key for key in last_sent if key not in snapshot)
+        return frozenset(changed)
+
+    def build_delta_params(self, changed, snapshot):
+        """Build notify params holding only the changed leaves.
+
+        Leaves that disappeared are sent as None, unless a parent of the leaf
+        was replaced by a plain value which is sent instead.
+        """
+        params = {}
+        for key in sorted(changed, key=len):
+            if key not in snapshot and any(key[:i] in snapshot for i in range(1, len(key))):
+                continue
+            node = params
+            for sub_key in key[:-1]:
+                child = node.get(sub_key)
+                if not isinstance(child, dict):
+                    child = node[sub_key] = {}
+                node = child
+            node[key[-1]] = snapshot.get(key)
+        return params
 
     def extract_state_params(self, requested_objects):
         """Extract the parameters from the state based on requested objects."""
         if self.debug:
             print(f"Extracting parameters for requested objects: {requested_objects}")
-        return {key: self.get_nested_value(self.current_state, key.split('.')) for key in requested_objects}
+        return {key: value for path in requested_objects for key, value in self.expand_path(path)}
 
     async def handle_http_request(self, request):
-        """Handle incoming HTTP GET requests."""
+        """Handle incoming HTTP GET requests.
+
+        Responses carry the state epoch and sequence number as their ETag.
+        Passing ?since=<seq>&epoch=<epoch>&timeout=<seconds> holds the
+        request until the state changes after since, or the timeout expires.
+        """
+        await self.long_poll(request)
         query_params = request.query_string.split('&')
-        requested_objects = set(param.split('=')[0] for param in query_params)
-        response_data = {"result": {"status": self.get_response_params(requested_objects)}}
-        return web.json_response(response_data)
+        requested_objects = frozenset(param.split('=')[0] for param in query_params) - LONG_POLL_PARAMS
+        return self.cached_json_response(
+            request, ('query', requested_objects),
+            lambda: {"result": {"status": self.get_response_params(requested_objects), "seq": self.state.seq,
+                                "epoch": self.state.history.epoch}})
+
+    async def long_poll(self, request, max_timeout=60.0):
+        """Wait for a state change if the request asks to with ?since=<seq>.
+
+        A since from another epoch, e.g. before the server restarted, does
+        not count the same changes, so the request is answered at once.
+        """
+        since = request.query.get('since')
+        if since is None:
+            return
+        epoch = request.query.get('epoch')
+        if epoch is not None and epoch != self.state.history.epoch:
+            return
+        try:
+            since = int(since)
+            timeout = min(float(request.query.get('timeout', 30)), max_timeout)
+        except ValueError:
+            return
+        await self.wait_for_state_change(since, timeout)
+
+    def cached_json_response(self, request, cache_key, build_response):
+        """Return a JSON response tagged with the state epoch and sequence number.
+
+        The epoch changes with every server start, so an ETag from before a
+        restart never matches. A request whose If-None-Match matches gets a
+        304. Otherwise the encoded body is cached per cache_key and reused
+        until the state changes, for at most HTTP_CACHE_SIZE keys.
+        """
+        seq = self.state.seq
+        etag = f'"{self.state.history.epoch}-{seq}"'
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304, headers=headers)
+        if self.http_cache_seq != seq:
+            self.http_cache.clear()
+            self.http_cache_seq = seq
+        body = self.http_cache.get(cache_key)
+        if body is None:
+            body = self.http_cache[cache_key] = codec.json_codec.encode(build_response()).encode()
+            if len(self.http_cache) > HTTP_CACHE_SIZE:
+                self.http_cache.popitem(last=False)
+        else:
+            self.http_cache.move_to_end(cache_key)
+        return web.Response(body=body, content_type='application/json', headers=headers)
 
     def get_response_params(self, requested_objects):
         """Get the response parameters based on the requested objects. To be overridden by subclasses."""
@@ -236,6 +750,9 @@ class BaseWebSocketServer:
         app.router.add_get('/websocket', self.websocket_handler)
         app.router.add_get('/printer/objects/query', self.handle_http_request)
         app.router.add_post('/printer/objects/update', self.handle_http_request)
+        app.router.add_get('/metrics', self.metrics.handle_request)
+        if self.profiler is not None:
+            app.router.add_get('/debug/profile', self.profiler.handle_request)
         #app.router.add_route('*', '/printer/objects/query', self.handle_http_request)
         self.add_custom_routes(app.router)
 
@@ -246,6 +763,7 @@ class BaseWebSocketServer:
         await runner.setup()
         site = web.TCPSite(runner, host=self.host, port=self.port)
         await site.start()
+        self.loop_monitor.start()
 
         while self.running:
             if self.debug:
@@ -261,12 +779,19 @@ class BaseWebSocketServer:
         if self.debug:
             print("Cleaning up background tasks...")
         self.running = False
+        if self.recorder is not None:
+            self.recorder.flush()
 
     def start(self):
         if self.debug:
             print("Starting event loop...")
         self.loop = asyncio.get_event_loop()
-        self.loop.run_until_complete(self.start_server())
+        try:
+            self.loop.run_until_complete(self.start_server())
+        finally:
+            # The last block of the traffic log is only written when the recorder is closed
+            if self.recorder is not None:
+                self.recorder.close()
 
     def stop(self):
         if self.debug:
@@ -275,7 +800,11 @@ class BaseWebSocketServer:
         self.loop.stop()
 
     async def process_custom_methods(self, request, ws):
-        """Hook method for processing custom methods in derived classes."""
+        """Hook method for processing custom methods in derived classes.
+
+        Called for every call of a frame before the method registry. Return True
+        if the call was handled, it then gets no entry in the response.
+        """
         return False
 
     def add_custom_routes(self, router):
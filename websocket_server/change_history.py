@@ -0,0 +1,54 @@
+import os
+from collections import deque
+
+
+class ChangeHistory:
+    """Bounded ring of recent change sets, each tagged with its state sequence number.
+
+    ``changes_since`` returns the paths changed after a sequence number, so a
+    reconnecting subscriber only needs the values it missed.  The ring keeps
+    at most ``max_entries`` change sets and ``max_paths`` changed paths in
+    total, dropping the oldest first.  ``horizon`` is the sequence number the
+    ring reaches back to; resuming from before it needs a full snapshot.
+
+    ``epoch`` identifies this history, so that sequence numbers handed out by
+    a previous server process are never mistaken for ours.
+    """
+
+    def __init__(self, max_entries=256, max_paths=8192):
+        self.max_entries = max_entries
+        self.max_paths = max_paths
+        self.entries = deque()
+        self.path_count = 0
+        self.horizon = 0
+        self.epoch = os.urandom(6).hex()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def record(self, seq, paths):
+        """Add the key tuples changed by the update that produced seq."""
+        paths = tuple(paths)
+        self.entries.append((seq, paths))
+        self.path_count += len(paths)
+        while self.entries and (len(self.entries) > self.max_entries or self.path_count > self.max_paths):
+            old_seq, old_paths = self.entries.popleft()
+            self.path_count -= len(old_paths)
+            self.horizon = old_seq
+
+    def invalidate(self, seq):
+        """Forget everything up to seq, after a change whose paths are unknown."""
+        self.entries.clear()
+        self.path_count = 0
+        self.horizon = seq
+
+    def changes_since(self, since, seq, epoch=None):
+        """Return the set of key tuples changed after since, or None if they are not all known."""
+        if (epoch is not None and epoch != self.epoch) or since < self.horizon or since > seq:
+            return None
+        changed = set()
+        for entry_seq, paths in reversed(self.entries):
+            if entry_seq <= since:
+                break
+            changed.update(paths)
+        return changed
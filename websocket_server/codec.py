@@ -0,0 +1,86 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class JsonCodec:
+    """Text JSON codec, using orjson when it is installed and stdlib json otherwise."""
+    name = 'json'
+    binary = False
+
+    def __init__(self, use_orjson=True):
+        self.use_orjson = use_orjson and orjson is not None
+        self.backend = 'orjson' if self.use_orjson else 'json'
+        if self.use_orjson:
+            self.envelope = '{"jsonrpc":"2.0","method":"notify_status_update","params":%s,"id":%s}'
+        else:
+            self.envelope = '{"jsonrpc": "2.0", "method": "notify_status_update", "params": %s, "id": %s}'
+
+    def encode(self, obj):
+        """Encode obj to a JSON string."""
+        if self.use_orjson:
+            try:
+                return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+            except TypeError:
+                pass
+        return json.dumps(obj)
+
+    def decode(self, data):
+        """Decode a JSON text or bytes message."""
+        if self.use_orjson:
+            return orjson.loads(data)
+        return json.loads(data)
+
+    def encode_notification(self, params, sub_id):
+        """Wrap params that were already encoded with this codec in a notify_status_update envelope."""
+        return self.envelope % (params, self.encode(sub_id))
+
+
+class MsgpackCodec:
+    """Binary MessagePack codec, offered as the "msgpack" websocket subprotocol."""
+    name = 'msgpack'
+    binary = True
+    backend = 'msgpack'
+
+    def __init__(self):
+        # A fixmap of four entries, with the constant keys and values packed once
+        self.envelope_head = (b'\x84' + msgpack.packb('jsonrpc') + msgpack.packb('2.0') +
+                              msgpack.packb('method') + msgpack.packb('notify_status_update') +
+                              msgpack.packb('params'))
+        self.envelope_id = msgpack.packb('id')
+
+    def encode(self, obj):
+        """Encode obj to MessagePack bytes."""
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def decode(self, data):
+        """Decode MessagePack bytes."""
+        return msgpack.unpackb(data, raw=False)
+
+    def encode_notification(self, params, sub_id):
+        """Wrap params that were already encoded with this codec in a notify_status_update envelope."""
+        return self.envelope_head + params + self.envelope_id + self.encode(sub_id)
+
+
+json_codec = JsonCodec()
+codecs = {json_codec.name: json_codec}
+if msgpack is not None:
+    codecs[MsgpackCodec.name] = MsgpackCodec()
+
+
+def get_codec(protocol=None):
+    """Return the codec for a negotiated websocket subprotocol, defaulting to JSON."""
+    return codecs.get(protocol, json_codec)
+
+
+def subprotocols():
+    """Return the subprotocol names the server can negotiate, binary codecs first."""
+    return tuple(sorted(codecs, key=lambda name: not codecs[name].binary))
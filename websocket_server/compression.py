@@ -0,0 +1,67 @@
+from aiohttp import web
+
+try:
+    from aiohttp.compression_utils import ZLibCompressor
+except ImportError:
+    ZLibCompressor = None
+
+
+class CompressionSettings:
+    """permessage-deflate settings for one websocket endpoint.
+
+    aiohttp negotiates permessage-deflate on its own, but then compresses
+    every frame at zlib level 1 using whatever window the client asked for.
+    ``configure`` narrows the window and sets the level on a connection that
+    negotiated the extension, and ``send`` leaves messages shorter than
+    ``threshold`` uncompressed, where deflate costs CPU without saving bytes.
+    """
+
+    def __init__(self, enabled=True, threshold=256, window_bits=15, level=1):
+        self.enabled = enabled
+        self.threshold = threshold
+        self.window_bits = max(9, min(15, window_bits))
+        self.level = level
+
+    @classmethod
+    def from_config(cls, config_manager, section, enabled=True):
+        """Read the ws_compress* options of a config section."""
+        return cls(enabled=config_manager.getboolean(section, 'ws_compress', enabled),
+                   threshold=config_manager.getint(section, 'ws_compress_threshold', 256),
+                   window_bits=config_manager.getint(section, 'ws_compress_window_bits', 15),
+                   level=config_manager.getint(section, 'ws_compress_level', 1))
+
+    def create_response(self, **kwargs):
+        """Create a WebSocketResponse that offers compression only when enabled."""
+        return web.WebSocketResponse(compress=self.enabled, **kwargs)
+
+    def configure(self, ws):
+        """Apply the window bits and level to a prepared websocket that negotiated compression."""
+        writer = getattr(ws, '_writer', None)
+        if not ws.compress or writer is None:
+            return False
+        # A smaller window than negotiated is always safe for the sender
+        writer.compress = min(int(writer.compress), self.window_bits)
+        if ZLibCompressor is not None and hasattr(writer, '_get_compressor'):
+            writer._compressobj = ZLibCompressor(level=self.level, wbits=-writer.compress)
+        return True
+
+    def should_compress(self, message):
+        return len(message) >= self.threshold
+
+    async def send(self, ws, message):
+        """Send a text or binary message, compressing it only above the threshold."""
+        writer = getattr(ws, '_writer', None)
+        if writer is None or not writer.compress or self.should_compress(message):
+            await self.send_frame(ws, message)
+            return
+        compress, writer.compress = writer.compress, 0
+        try:
+            await self.send_frame(ws, message)
+        finally:
+            writer.compress = compress
+
+    async def send_frame(self, ws, message):
+        if isinstance(message, bytes):
+            await ws.send_bytes(message)
+        else:
+            await ws.send_str(message)
@@ -0,0 +1,229 @@
+import copy
+import asyncio
+from websocket_server.base_websocket_client import BaseWebSocketClient
+
+
+def merge_objects(target, objects):
+    """Merge a subscribe objects parameter into target, a None or '*' object covering all its fields."""
+    for name, fields in objects.items():
+        current = target.get(name, [])
+        if not isinstance(current, list):
+            continue
+        if isinstance(fields, list):
+            target[name] = current + [field for field in fields if field not in current]
+        else:
+            target[name] = fields
+    return target
+
+
+def filter_objects(updated_objects, objects):
+    """Return the part of updated_objects covered by a subscribe objects parameter."""
+    filtered = {}
+    for name, values in updated_objects.items():
+        if name not in objects:
+            continue
+        fields = objects[name]
+        if not isinstance(fields, list) or not isinstance(values, dict):
+            filtered[name] = values
+            continue
+        values = {field: value for field, value in values.items() if field in fields}
+        if values:
+            filtered[name] = values
+    return filtered
+
+
+class ConnectionHub:
+    """Shares upstream websocket connections between the clients of one process.
+
+    Every upstream URI gets one connection, owned by one BaseWebSocketClient,
+    subscribed to the union of the objects its consumers asked for. Messages
+    are parsed and merged into the one state store once, and each consumer is
+    then handed only the fields of its own subscription.
+
+    The union subscribe request takes its method, id and other params from
+    the first consumer of a URI. It is sent again when a consumer adds
+    objects the connection was not yet subscribed to.
+    """
+
+    def __init__(self, debug=False, **client_options):
+        self.debug = debug
+        self.client = BaseWebSocketClient([], {}, debug, **client_options)
+        self.client.on_state_update = self.fan_out
+        self.roots = {}
+        self.consumers = {}
+        self.task = None
+
+    def attach(self, consumer, root, uri, subscription):
+        """Subscribe a consumer's root to uri, return the hub root its state is kept under."""
+        hub_root = self.roots.get(uri)
+        objects = subscription.get('params', {}).get('objects', {})
+        if hub_root is None:
+            hub_root = self.roots[uri] = self.unique_root(root)
+            self.consumers[hub_root] = []
+            union = copy.deepcopy(subscription)
+            union.setdefault('params', {})['objects'] = merge_objects({}, objects)
+            self.consumers[hub_root].append((consumer, root, objects))
+            self.client.add_connection(hub_root, uri, union)
+            return hub_root
+        self.consumers[hub_root].append((consumer, root, objects))
+        if self.update_subscription(hub_root):
+            return hub_root
+        # Nothing new to subscribe to, hand over what the hub already knows
+        known = self.client.current_state.get(hub_root)
+        if known:
+            asyncio.ensure_future(consumer.deliver(root, filter_objects(known, objects)))
+        return hub_root
+
+    def unique_root(self, root):
+        """Return root, or root#n when another URI already uses it. Roots are path keys, so no dots."""
+        hub_root, n = root, 1
+        while hub_root in self.consumers:
+            n += 1
+            hub_root = f"{root}#{n}"
+        return hub_root
+
+    def detach(self, consumer):
+        """Remove a consumer from every connection, narrowing the subscriptions it widened."""
+        for hub_root, consumers in self.consumers.items():
+            remaining = [entry for entry in consumers if entry[0] is not consumer]
+            if len(remaining) != len(consumers):
+                consumers[:] = remaining
+                if remaining:
+                    self.update_subscription(hub_root)
+
+    def update_subscription(self, hub_root):
+        """Recompute the union subscription of a connection and resend it if it changed."""
+        objects = {}
+        for _, _, consumer_objects in self.consumers[hub_root]:
+            merge_objects(objects, consumer_objects)
+        subscription = self.client.subscriptions[hub_root]
+        params = subscription.setdefault('params', {})
+        if params.get('objects') == objects:
+            return False
+        params['objects'] = objects
+        # Changes since the last seq would leave out the current values of newly added objects
+        self.client.forget_resume_point(hub_root)
+        supervisor = self.client.supervisors.get(hub_root)
+        if supervisor is not None:
+            asyncio.ensure_future(supervisor.resubscribe())
+        return True
+
+    async def fan_out(self, hub_root, updated_objects):
+        """Hand every consumer of a connection the updated fields it subscribed to."""
+        for consumer, root, objects in list(self.consumers.get(hub_root, ())):
+            filtered = filter_objects(updated_objects, objects)
+            if filtered:
+                await consumer.deliver(root, filtered)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.client.start())
+        return self.task
+
+    async def stop(self):
+        if self.task is not None:
+            await self.client.stop()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    def has_consumers(self):
+        return any(self.consumers.values())
+
+
+default_hub = None
+
+
+def get_hub(debug=False, **client_options):
+    """Return the hub of this process, creating it with client_options on first use."""
+    global default_hub
+    if default_hub is None:
+        default_hub = ConnectionHub(debug, **client_options)
+    return default_hub
+
+
+class HubClient:
+    """Stands in for a BaseWebSocketClient, receiving its state through a ConnectionHub.
+
+    State paths start with the client's own root names, as with a
+    BaseWebSocketClient, and are looked up in the hub's shared state.
+    """
+
+    def __init__(self, hub, connections, subscriptions, debug=True):
+        self.hub = hub
+        self.connections = connections
+        self.subscriptions = subscriptions
+        self.debug = debug
+        self.hub_roots = {}
+        self.path_callbacks = {}
+        self.stopped = None
+        self.on_state_update = None
+
+    @property
+    def metrics(self):
+        return self.hub.client.metrics
+
+    @property
+    def current_state(self):
+        """The hub's state of this client's roots, keyed by this client's root names."""
+        state = self.hub.client.current_state
+        return {root: state.get(hub_root, {}) for root, hub_root in self.hub_roots.items()}
+
+    def hub_path(self, path):
+        """Translate a dotted path starting with one of this client's roots to the hub's root."""
+        root, sep, rest = path.partition('.')
+        hub_root = self.hub_roots.get(root, root)
+        return hub_root + sep + rest
+
+    def get_state(self, path, default=None):
+        return self.hub.client.get_state(self.hub_path(path), default)
+
+    def add_path_callback(self, path, callback):
+        """Call callback(path, old, new) with this client's path when a value at or below path changes."""
+        root = path.partition('.')[0]
+
+        def translated(hub_path, old, new):
+            return callback(root + hub_path[len(self.hub_roots.get(root, root)):], old, new)
+        self.path_callbacks[(path, callback)] = translated
+        if root in self.hub_roots:
+            self.hub.client.add_path_callback(self.hub_path(path), translated)
+            asyncio.ensure_future(self.hub.client.replay_path_callback(self.hub_path(path), translated))
+
+    def remove_path_callback(self, path, callback):
+        translated = self.path_callbacks.pop((path, callback), None)
+        if translated is not None and path.partition('.')[0] in self.hub_roots:
+            self.hub.client.remove_path_callback(self.hub_path(path), translated)
+
+    async def deliver(self, root, updated_objects):
+        """Called by the hub with the updated fields of this client's subscription."""
+        if self.on_state_update:
+            await self.on_state_update(root, updated_objects)
+
+    async def start(self):
+        """Attach to the hub and wait until stop() is called."""
+        self.stopped = asyncio.Event()
+        for connection in self.connections:
+            for root, uri in connection.items():
+                self.hub_roots[root] = self.hub.attach(self, root, uri, self.subscriptions[root])
+        for (path, _), translated in self.path_callbacks.items():
+            self.hub.client.add_path_callback(self.hub_path(path), translated)
+        # Values the hub already holds will not change for this client, so hand them over now
+        for (path, _), translated in list(self.path_callbacks.items()):
+            await self.hub.client.replay_path_callback(self.hub_path(path), translated)
+        self.hub.start()
+        await self.stopped.wait()
+
+    async def stop(self):
+        for (path, _), translated in self.path_callbacks.items():
+            if path.partition('.')[0] in self.hub_roots:
+                self.hub.client.remove_path_callback(self.hub_path(path), translated)
+        self.hub.detach(self)
+        self.hub_roots = {}
+        if not self.hub.has_consumers():
+            await self.hub.stop()
+        if self.stopped is not None:
+            self.stopped.set()
+
+    def connection_health(self):
+        """Return the health of the hub connections this client uses, keyed by this client's roots."""
+        health = self.hub.client.connection_health()
+        return {root: health[hub_root] for root, hub_root in self.hub_roots.items() if hub_root in health}
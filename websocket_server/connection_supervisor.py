@@ -0,0 +1,176 @@
+import time
+import random
+import asyncio
+import websockets
+
+
+class Backoff:
+    """Exponential backoff with jitter between reconnect attempts.
+
+    The delay doubles from ``initial`` up to ``maximum`` and each delay is
+    randomly shortened by up to ``jitter`` of itself, so that several clients
+    that lost the same server do not all reconnect at the same moment.
+    """
+
+    def __init__(self, initial=0.5, maximum=30.0, factor=2.0, jitter=0.5):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.attempt = 0
+
+    def next_delay(self):
+        delay = min(self.maximum, self.initial * self.factor ** self.attempt)
+        self.attempt += 1
+        return delay * (1 - self.jitter * random.random())
+
+    def reset(self):
+        self.attempt = 0
+
+
+class ConnectionSupervisor:
+    """Keeps one websocket connection of a BaseWebSocketClient connected and subscribed.
+
+    ``run`` is a loop over the states connecting, subscribing, connected and
+    backoff. Every way a connection can end, a refused connect, a closed
+    socket, a watchdog timeout or a ``reconnect()`` request, falls back into
+    the same loop, so there is only ever one connection attempt and one
+    watchdog per supervisor.
+
+    The watchdog pings the server once no message arrived for
+    ``watchdog_timeout`` seconds and closes the connection if no pong comes
+    back, so quiet but healthy servers are left alone.
+    """
+    STATES = ('idle', 'connecting', 'subscribing', 'connected', 'backoff', 'stopped')
+
+    def __init__(self, client, root, uri, backoff=None, watchdog_timeout=30.0, ping_timeout=10.0, debug=False):
+        self.client = client
+        self.root = root
+        self.uri = uri
+        self.backoff = backoff or Backoff()
+        self.watchdog_timeout = watchdog_timeout
+        self.ping_timeout = ping_timeout
+        self.debug = debug
+        self.state = 'idle'
+        self.websocket = None
+        self.task = None
+        self.connected_since = None
+        self.last_message = None
+        self.last_error = None
+        self.connects = 0
+        self.reconnects = 0
+        self.watchdog_timeouts = 0
+        self.messages = 0
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+        return self.task
+
+    async def stop(self):
+        """Stop reconnecting and close the connection."""
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        self.state = 'stopped'
+
+    async def run(self):
+        try:
+            while self.client.running:
+                self.state = 'connecting'
+                try:
+                    async with websockets.connect(self.uri) as websocket:
+                        await self.serve(websocket)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.last_error = f"{type(e).__name__}: {e}"
+                    if self.debug:
+                        print(f"Connection to {self.root} failed: {self.last_error}")
+                finally:
+                    self.websocket = None
+                    self.connected_since = None
+                if not self.client.running:
+                    break
+                self.state = 'backoff'
+                delay = self.backoff.next_delay()
+                self.reconnects += 1
+                if self.debug:
+                    print(f"Reconnecting to {self.root} in {delay:.1f} seconds")
+                await asyncio.sleep(delay)
+        finally:
+            self.state = 'stopped'
+
+    async def serve(self, websocket):
+        """Subscribe on a new connection and process its messages until it closes."""
+        self.websocket = websocket
+        self.connects += 1
+        self.connected_since = self.last_message = time.monotonic()
+        if self.debug:
+            print(f"Connected to {self.root}: {self.uri}")
+        recorder = self.client.recorder
+        if recorder is not None:
+            recorder.opened(self.root, 'client')
+        self.state = 'subscribing'
+        await self.client.subscribe(websocket, self.root)
+        self.state = 'connected'
+        watchdog = asyncio.ensure_future(self.watchdog(websocket))
+        try:
+            async for message in websocket:
+                self.last_message = time.monotonic()
+                self.messages += 1
+                # Only a connection that delivers messages counts as recovered
+                self.backoff.reset()
+                await self.client.handle_message(message, self.root, self)
+        finally:
+            watchdog.cancel()
+            if recorder is not None:
+                recorder.closed(self.root)
+        if self.debug:
+            print(f"Connection to {self.root} closed")
+
+    async def watchdog(self, websocket):
+        """Close a connection that stopped delivering messages and does not answer a ping."""
+        while True:
+            idle = time.monotonic() - self.last_message
+            if idle < self.watchdog_timeout:
+                await asyncio.sleep(self.watchdog_timeout - idle)
+                continue
+            try:
+                pong = await websocket.ping()
+                await asyncio.wait_for(pong, self.ping_timeout)
+                self.last_message = time.monotonic()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.watchdog_timeouts += 1
+                if self.debug:
+                    print(f"No messages or pong from {self.root} for {self.watchdog_timeout} seconds, reconnecting")
+                await websocket.close()
+                return
+
+    async def reconnect(self):
+        """Drop the current connection, the run loop then reconnects and resubscribes."""
+        if self.websocket is not None:
+            await self.websocket.close()
+
+    async def resubscribe(self):
+        """Send the subscription again on the current connection."""
+        if self.websocket is not None:
+            await self.client.subscribe(self.websocket, self.root)
+
+    def health(self):
+        """Return a dict describing the connection, for status output and metrics."""
+        now = time.monotonic()
+        return {
+            'state': self.state,
+            'uri': self.uri,
+            'connected_seconds': round(now - self.connected_since, 1) if self.connected_since else None,
+            'seconds_since_message': round(now - self.last_message, 1) if self.last_message else None,
+            'connects': self.connects,
+            'reconnects': self.reconnects,
+            'watchdog_timeouts': self.watchdog_timeouts,
+            'messages': self.messages,
+            'last_error': self.last_error,
+        }
@@ -0,0 +1,188 @@
+import asyncio
+import bisect
+import time
+from aiohttp import web
+
+
+def format_labels(labels):
+    """Format a sorted tuple of (name, value) pairs as a Prometheus label set."""
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in labels) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """A monotonically increasing value, optionally split by labels."""
+    kind = 'counter'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(tuple(sorted(labels.items())), 0)
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name, labels, value
+
+
+class Gauge(Counter):
+    """A value that can go up and down, or is read from a callback when rendered.
+
+    The callback returns either a number or a dict of {labels dict as tuple: value}.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, callback=None):
+        super().__init__(name, help_text)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        self.values[tuple(sorted(labels.items()))] = value
+
+    def samples(self):
+        if self.callback is None:
+            yield from super().samples()
+            return
+        value = self.callback()
+        if isinstance(value, dict):
+            for labels, sample in value.items():
+                yield self.name, labels, sample
+        else:
+            yield self.name, (), value
+
+
+class Histogram:
+    """Counts observations in cumulative buckets, like a Prometheus histogram."""
+    kind = 'histogram'
+    default_buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+    def __init__(self, name, help_text, buckets=None):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(sorted(buckets or self.default_buckets))
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = [[0] * len(self.buckets), 0, 0.0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            entry[0][index] += 1
+        entry[1] += 1
+        entry[2] += value
+
+    def time(self, **labels):
+        """Return a context manager that observes the time spent in its block."""
+        return HistogramTimer(self, labels)
+
+    def samples(self):
+        for labels, (counts, count, total) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield self.name + '_bucket', labels + (('le', format_value(float(bound))),), cumulative
+            yield self.name + '_bucket', labels + (('le', '+Inf'),), count
+            yield self.name + '_count', labels, count
+            yield self.name + '_sum', labels, total
+
+
+class HistogramTimer:
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class MetricsRegistry:
+    """A set of metrics rendered in the Prometheus text exposition format."""
+    content_type = 'text/plain; version=0.0.4'
+
+    def __init__(self, prefix=''):
+        self.prefix = prefix
+        self.metrics = {}
+        self.included = []
+
+    def register(self, metric):
+        metric.name = self.prefix + metric.name
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help_text):
+        return self.register(Counter(name, help_text))
+
+    def gauge(self, name, help_text, callback=None):
+        return self.register(Gauge(name, help_text, callback))
+
+    def histogram(self, name, help_text, buckets=None):
+        return self.register(Histogram(name, help_text, buckets))
+
+    def include(self, registry):
+        """Render the metrics of another registry, like that of a server's client, along with these."""
+        self.included.append(registry)
+
+    def render(self):
+        lines = []
+        for metric in self.all_metrics():
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+    def all_metrics(self):
+        yield from self.metrics.values()
+        for registry in self.included:
+            yield from registry.all_metrics()
+
+    async def handle_request(self, request):
+        """aiohttp handler serving the metrics at /metrics."""
+        return web.Response(text=self.render(), headers={'Content-Type': self.content_type})
+
+
+class EventLoopMonitor:
+    """Measures event loop lag by timing how late a periodic sleep wakes up."""
+
+    def __init__(self, histogram, interval=0.5):
+        self.histogram = histogram
+        self.interval = interval
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+        return self
+
+    async def run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.histogram.observe(max(0.0, time.perf_counter() - start - self.interval))
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
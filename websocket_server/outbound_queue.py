@@ -0,0 +1,116 @@
+import asyncio
+import itertools
+from collections import OrderedDict
+
+
+class OutboundQueue:
+    """Bounded send queue for one websocket, drained by its own writer task.
+
+    Messages queued with a key replace any pending message that has the same
+    key, so a subscriber that falls behind only ever receives the latest
+    notification for each subscription.  When the queue is full the oldest
+    message is dropped.  A connection that keeps dropping messages, or that
+    takes longer than ``send_timeout`` to accept a frame, is evicted.
+    """
+
+    def __init__(self, ws, maxsize=64, send_timeout=5.0, max_dropped=256, on_evict=None, on_drop=None,
+                 compression=None, name=None, recorder=None, debug=False):
+        self.ws = ws
+        self.recorder = recorder
+        self.name = name
+        self.on_drop = on_drop
+        self.compression = compression
+        self.maxsize = maxsize
+        self.send_timeout = send_timeout
+        self.max_dropped = max_dropped
+        self.on_evict = on_evict
+        self.debug = debug
+        self.pending = OrderedDict()
+        self.sequence = itertools.count()
+        self.ready = asyncio.Event()
+        self.task = None
+        self.closed = False
+        self.sent = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def pending_bytes(self):
+        """Return the size of the encoded messages waiting to be sent."""
+        return sum(len(message) for message, _ in self.pending.values())
+
+    def start(self):
+        """Start the writer task for this connection."""
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+        return self
+
+    def put(self, message, key=None, on_sent=None):
+        """Queue a message, replacing a pending message with the same key."""
+        if self.closed:
+            return False
+        if key is None:
+            key = (None, next(self.sequence))
+        elif key in self.pending:
+            self.pending[key] = (message, on_sent)
+            return True
+        if len(self.pending) >= self.maxsize:
+            self.pending.popitem(last=False)
+            self.dropped += 1
+            if self.on_drop:
+                self.on_drop(self)
+            if self.dropped > self.max_dropped:
+                self.evict(f"dropped {self.dropped} messages")
+                return False
+        self.pending[key] = (message, on_sent)
+        self.ready.set()
+        return True
+
+    async def run(self):
+        """Send queued messages until the queue is closed."""
+        while not self.closed:
+            if not self.pending:
+                self.ready.clear()
+                await self.ready.wait()
+                continue
+            _, (message, on_sent) = self.pending.popitem(last=False)
+            try:
+                await asyncio.wait_for(self.send(message), self.send_timeout)
+            except asyncio.TimeoutError:
+                self.evict(f"send timed out after {self.send_timeout} seconds")
+                break
+            except Exception as e:
+                if self.debug:
+                    print(f'Error sending to websocket: {e}')
+                self.close()
+                break
+            self.sent += 1
+            if on_sent:
+                on_sent()
+
+    async def send(self, message):
+        if self.recorder is not None:
+            self.recorder.outbound(self.name, message)
+        if self.compression is not None:
+            await self.compression.send(self.ws, message)
+        elif isinstance(message, bytes):
+            await self.ws.send_bytes(message)
+        else:
+            await self.ws.send_str(message)
+
+    def evict(self, reason):
+        """Stop sending and hand the connection to the eviction callback."""
+        if self.debug:
+            print(f'Evicting slow websocket consumer: {reason}')
+        self.close()
+        if self.on_evict:
+            self.on_evict(self)
+
+    def close(self):
+        """Discard pending messages and stop the writer task."""
+        self.closed = True
+        self.pending.clear()
+        self.ready.set()
+        if self.task and self.task is not asyncio.current_task():
+            self.task.cancel()
@@ -0,0 +1,124 @@
+import sys
+import time
+import marshal
+import asyncio
+import threading
+from collections import Counter
+from aiohttp import web
+
+
+def frame_key(code):
+    """Return the (filename, line, function) key pstats uses for a code object."""
+    return code.co_filename, code.co_firstlineno, code.co_name
+
+
+class SamplingProfiler:
+    """Samples the Python stacks of every thread in the process.
+
+    A background thread reads ``sys._current_frames()`` every ``interval``
+    seconds, so the EffectsThread, http.server threads and the event loop
+    are all covered without instrumenting them. Nothing runs between
+    profiles, so an idle profiler costs nothing.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = Counter()
+        self.sample_count = 0
+
+    def run(self, duration):
+        """Sample all other threads for duration seconds and return the stack counts."""
+        own_ident = threading.get_ident()
+        end = time.perf_counter() + duration
+        while time.perf_counter() < end:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame_key(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, f'thread-{ident}'))
+                self.samples[tuple(reversed(stack))] += 1
+            self.sample_count += 1
+            time.sleep(self.interval)
+        return self.samples
+
+    def collapsed(self):
+        """Return the samples as collapsed stacks, one 'thread;frame;frame count' line each."""
+        lines = []
+        for stack, count in sorted(self.samples.items()):
+            frames = [stack[0]] + [f'{name} ({filename}:{line})' for filename, line, name in stack[1:]]
+            lines.append(f"{';'.join(frames)} {count}")
+        return '\n'.join(lines) + '\n'
+
+    def pstats(self):
+        """Return the samples as a marshalled pstats dictionary, loadable with pstats.Stats.
+
+        Sample counts stand in for call counts, and times are sample counts
+        times the interval.
+        """
+        stats = {}
+        for stack, count in self.samples.items():
+            frames = stack[1:]
+            if not frames:
+                continue
+            seconds = count * self.interval
+            seen = set()
+            for depth, key in enumerate(frames):
+                entry = stats.setdefault(key, [0, 0, 0.0, 0.0, {}])
+                if key not in seen:
+                    seen.add(key)
+                    entry[0] += count
+                    entry[1] += count
+                    entry[3] += seconds
+                if depth > 0:
+                    caller = entry[4].setdefault(frames[depth - 1], [0, 0, 0.0, 0.0])
+                    caller[0] += count
+                    caller[1] += count
+                    caller[3] += seconds
+                    if depth == len(frames) - 1:
+                        caller[2] += seconds
+            stats[frames[-1]][2] += seconds
+        return marshal.dumps({key: (cc, nc, tt, ct, {caller: tuple(values) for caller, values in callers.items()})
+                              for key, (cc, nc, tt, ct, callers) in stats.items()})
+
+
+class ProfilerEndpoint:
+    """aiohttp handler that profiles the running process on request.
+
+    GET /debug/profile?seconds=10&interval=0.005&format=collapsed returns
+    collapsed stacks for flame graph tools; format=pstats returns a file for
+    pstats, snakeviz and similar viewers. One profile runs at a time.
+    """
+
+    def __init__(self, max_seconds=60.0, debug=False):
+        self.max_seconds = max_seconds
+        self.debug = debug
+        self.running = False
+
+    async def handle_request(self, request):
+        try:
+            seconds = min(float(request.query.get('seconds', 5)), self.max_seconds)
+            interval = max(float(request.query.get('interval', 0.005)), 0.001)
+        except ValueError:
+            return web.Response(status=400, text="seconds and interval must be numbers")
+        output_format = request.query.get('format', 'collapsed')
+        if output_format not in ('collapsed', 'pstats'):
+            return web.Response(status=400, text="format must be collapsed or pstats")
+        if self.running:
+            return web.Response(status=409, text="A profile is already running")
+        self.running = True
+        try:
+            if self.debug:
+                print(f"Profiling all threads for {seconds} seconds")
+            profiler = SamplingProfiler(interval)
+            await asyncio.get_event_loop().run_in_executor(None, profiler.run, seconds)
+        finally:
+            self.running = False
+        headers = {'X-Profile-Samples': str(profiler.sample_count)}
+        if output_format == 'pstats':
+            headers['Content-Disposition'] = 'attachment; filename="profile.pstats"'
+            return web.Response(body=profiler.pstats(), content_type='application/octet-stream', headers=headers)
+        return web.Response(text=profiler.collapsed(), headers=headers)
@@ -0,0 +1,87 @@
+import asyncio
+
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+
+
+class RpcError(Exception):
+    """An error returned to the caller as a JSON-RPC error object."""
+
+    def __init__(self, code, message, data=None):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+        self.data = data
+
+    def to_dict(self):
+        error = {"code": self.code, "message": self.message}
+        if self.data is not None:
+            error["data"] = self.data
+        return error
+
+
+def error_response(request_id, error):
+    return {"jsonrpc": "2.0", "error": error.to_dict(), "id": request_id}
+
+
+def result_response(request_id, result):
+    return {"jsonrpc": "2.0", "result": result, "id": request_id}
+
+
+class RpcMethod:
+    __slots__ = ('name', 'handler', 'semaphore')
+
+    def __init__(self, name, handler, max_concurrent=None):
+        self.name = name
+        self.handler = handler
+        self.semaphore = asyncio.Semaphore(max_concurrent) if max_concurrent else None
+
+    async def call(self, request, ws, batch):
+        if self.semaphore is None:
+            return await self.handler(request, ws, batch)
+        async with self.semaphore:
+            return await self.handler(request, ws, batch)
+
+
+class MethodRegistry:
+    """Maps JSON-RPC method names to handlers, each with an optional concurrency limit.
+
+    A handler is called as ``handler(request, ws, batch)`` and returns the
+    result of the call, or raises RpcError.
+    """
+
+    def __init__(self):
+        self.methods = {}
+
+    def register(self, name, handler, max_concurrent=None):
+        self.methods[name] = RpcMethod(name, handler, max_concurrent)
+
+    def unregister(self, name):
+        self.methods.pop(name, None)
+
+    def get(self, name):
+        return self.methods.get(name)
+
+    def __contains__(self, name):
+        return name in self.methods
+
+
+class RequestBatch:
+    """State shared by the calls that arrived in one websocket frame.
+
+    Calls that change the state add the changed paths here instead of
+    broadcasting them, so a batch of updates causes a single broadcast.
+    Work that has to follow the response, such as the initial notification
+    of a new subscription, is queued with ``after_response``.
+    """
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.changed_paths = set()
+        self.followups = []
+
+    def after_response(self, coroutine_function, *args, **kwargs):
+        self.followups.append((coroutine_function, args, kwargs))
@@ -0,0 +1,64 @@
+import sys
+import time
+
+
+class Subscription:
+    """One subscribe call of a session: the requested paths and how to notify them."""
+    __slots__ = ('session', 'sub_id', 'paths', 'delta', 'min_interval', 'last_notify', 'deferred', 'last_sent',
+                 'filters')
+
+    def __init__(self, session, sub_id, paths, delta=False, min_interval=0, filters=None):
+        self.session = session
+        self.sub_id = sub_id
+        self.paths = paths
+        self.delta = delta
+        self.min_interval = min_interval
+        self.last_notify = 0
+        self.deferred = None
+        self.last_sent = None
+        self.filters = filters
+
+    def cancel(self):
+        """Cancel a notification deferred by max_rate or a filter's min_interval."""
+        if self.deferred is not None:
+            self.deferred.cancel()
+            self.deferred = None
+
+    def memory_usage(self):
+        """Estimate the bytes held by this subscription, mostly its last-sent delta snapshot."""
+        size = sys.getsizeof(self) + sys.getsizeof(self.paths) + sum(sys.getsizeof(path) for path in self.paths)
+        for values in (self.last_sent, self.filters and self.filters.sent_values):
+            if values:
+                size += sys.getsizeof(values)
+                size += sum(sys.getsizeof(key) + sys.getsizeof(value) for key, value in values.items())
+        return size
+
+
+class Session:
+    """Everything the server holds for one websocket connection.
+
+    The session owns the connection's codec, outbound queue and subscriptions,
+    so closing the connection releases all of it by dropping one object.
+    Subscriptions are keyed by their request id; subscribing again with the
+    same id replaces the earlier subscription.
+    """
+    __slots__ = ('ws', 'name', 'codec', 'queue', 'subscriptions', 'opened')
+
+    def __init__(self, ws, name, codec, queue=None):
+        self.ws = ws
+        self.name = name
+        self.codec = codec
+        self.queue = queue
+        self.subscriptions = {}
+        self.opened = time.monotonic()
+
+    def __len__(self):
+        return len(self.subscriptions)
+
+    def memory_usage(self):
+        """Estimate the bytes held by this session, including messages waiting to be sent."""
+        size = sys.getsizeof(self) + sys.getsizeof(self.subscriptions)
+        size += sum(subscription.memory_usage() for subscription in self.subscriptions.values())
+        if self.queue is not None:
+            size += self.queue.pending_bytes()
+        return size
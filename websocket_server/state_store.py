@@ -0,0 +1,96 @@
+import functools
+
+MISSING = object()
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_path(path, sep='.'):
+    """Split a dotted path into a tuple of keys, caching the result."""
+    return tuple(path.split(sep))
+
+
+def iter_leaves(path, value):
+    """Yield (path, value) for every leaf at or below a key tuple, an empty dict counting as a leaf."""
+    if isinstance(value, dict) and value:
+        for key, child in value.items():
+            yield from iter_leaves(path + (key,), child)
+    else:
+        yield path, value
+
+
+class StateStore:
+    """Nested state dictionary with a global sequence number.
+
+    Updates are merged into the state the same way deep_update did, but only
+    the keys present in the update are visited, so detecting what changed
+    costs O(size of the update) rather than O(size of the state).  Every
+    update that changes something advances ``seq``.
+
+    With a ChangeHistory attached, the changed paths of recent updates are
+    also kept by sequence number, see ``changes_since``.
+    """
+
+    def __init__(self, data=None, history=None):
+        self.data = data if data is not None else {}
+        self.seq = 0
+        self.history = history
+
+    def reset(self, data):
+        """Replace the whole state, e.g. when a subclass assigns current_state."""
+        self.data = data
+        self.seq += 1
+        if self.history is not None:
+            self.history.invalidate(self.seq)
+
+    def touch(self):
+        """Advance the sequence number after the state was modified in place."""
+        self.seq += 1
+        if self.history is not None:
+            self.history.invalidate(self.seq)
+        return self.seq
+
+    def get(self, path, default=None):
+        """Get the value at a dotted path or key tuple, or default if it does not exist."""
+        value = self.data
+        for key in compile_path(path) if isinstance(path, str) else path:
+            if isinstance(value, dict):
+                value = value.get(key, MISSING)
+                if value is MISSING:
+                    return default
+            else:
+                return default
+        return value
+
+    def update(self, updates):
+        """Merge updates into the state and return the changes.
+
+        Changes are returned as a list of (path, old, new) tuples, where path is
+        the key tuple of a changed leaf and old is None for a new key.
+        """
+        changes = []
+        self.merge(self.data, updates, (), changes)
+        if changes:
+            self.seq += 1
+            if self.history is not None:
+                self.history.record(self.seq, [path for path, _, _ in changes])
+        return changes
+
+    def changes_since(self, since, epoch=None):
+        """Return the key tuples changed after seq since, or None if the history cannot tell."""
+        if self.history is None:
+            return None
+        return self.history.changes_since(since, self.seq, epoch)
+
+    def merge(self, target, updates, parent, changes):
+        for key, value in updates.items():
+            path = parent + (key,)
+            old = target.get(key, MISSING)
+            if isinstance(value, dict):
+                if not isinstance(old, dict):
+                    old = target[key] = {}
+                    if not value:
+                        changes.append((path, None, old))
+                self.merge(old, value, path, changes)
+            elif old is MISSING or old != value:
+                target[key] = value
+                changes.append((path, None if old is MISSING else old, value))
@@ -0,0 +1,96 @@
+import numbers
+from websocket_server.state_store import MISSING, compile_path
+
+
+def is_number(value):
+    return isinstance(value, numbers.Real) and not isinstance(value, bool)
+
+
+class PathFilter:
+    """Deadband and minimum interval for the leaves at or below one path.
+
+    A numeric leaf only counts as changed once it moved at least ``deadband``
+    and at least ``relative`` times its last sent value away from that value.
+    A change is held back until ``min_interval`` seconds have passed since the
+    path was last notified.
+    """
+    __slots__ = ('deadband', 'relative', 'min_interval')
+
+    def __init__(self, deadband=0.0, relative=0.0, min_interval=0.0):
+        self.deadband = deadband
+        self.relative = relative
+        self.min_interval = min_interval
+
+    @classmethod
+    def from_params(cls, params):
+        """Create a filter from its subscribe params, raising ValueError if they are invalid."""
+        if not isinstance(params, dict) or set(params) - {'deadband', 'relative', 'min_interval'}:
+            raise ValueError("a filter takes deadband, relative and min_interval")
+        values = {name: params.get(name, 0.0) for name in ('deadband', 'relative', 'min_interval')}
+        for name, value in values.items():
+            if not is_number(value) or value < 0:
+                raise ValueError(f"{name} must be a non-negative number")
+        return cls(**values)
+
+    def exceeds_deadband(self, old, new):
+        if not is_number(old) or not is_number(new):
+            return old != new
+        return abs(new - old) >= max(self.deadband, self.relative * abs(old)) and new != old
+
+
+class SubscriptionFilters:
+    """The path filters of one subscription and the values they were last notified with.
+
+    ``check`` decides, before anything is encoded, whether a set of changed
+    leaf paths is worth a notification.  Changes to paths without a filter
+    always are.
+    """
+    __slots__ = ('filters', 'requested_keys', 'sent_values', 'sent_times')
+
+    def __init__(self, filters, requested_keys):
+        self.filters = filters
+        self.requested_keys = requested_keys
+        self.sent_values = {}
+        self.sent_times = {}
+
+    @classmethod
+    def from_params(cls, params, requested_keys, sep='.'):
+        """Create the filters from the {path: filter params} of a subscribe request."""
+        if not isinstance(params, dict):
+            raise ValueError("filters must be an object of {path: filter}")
+        filters = {compile_path(path, sep): PathFilter.from_params(value) for path, value in params.items()}
+        return cls(filters, requested_keys)
+
+    def find(self, path):
+        """Return the (key, filter) of the nearest filtered path at or above path, or (None, None)."""
+        for depth in range(len(path), 0, -1):
+            path_filter = self.filters.get(path[:depth])
+            if path_filter is not None:
+                return path[:depth], path_filter
+        return None, None
+
+    def is_requested(self, path):
+        return any(path[:len(key)] == key or key[:len(path)] == path for key in self.requested_keys)
+
+    def check(self, changed_paths, get_value, now):
+        """Return (notify, wait) for the changed key tuples.
+
+        notify is True if any requested change passes its filter. Otherwise
+        wait is the number of seconds until a change held back only by its
+        min_interval may be sent, or None if there is no such change.
+        """
+        wait = None
+        for path in changed_paths:
+            if not self.is_requested(path):
+                continue
+            key, path_filter = self.find(path)
+            if path_filter is None:
+                return True, None
+            old = self.sent_values.get(path, MISSING)
+            if old is not MISSING and not path_filter.exceeds_deadband(old, get_value(path)):
+                continue
+            remaining = self.sent_times.get(key, 0) + path_filter.min_interval - now
+            if remaining <= 0:
+                return True, None
+            wait = remaining if wait is None else min(wait, remaining)
+        return False, wait
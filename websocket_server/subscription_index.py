@@ -0,0 +1,99 @@
+WILDCARD = '*'
+
+
+class SubscriptionNode:
+    """A node in the subscription trie, one per state path segment."""
+    __slots__ = ('children', 'subscribers')
+
+    def __init__(self):
+        self.children = {}
+        self.subscribers = set()
+
+
+class SubscriptionIndex:
+    """Prefix trie mapping state paths to the subscribers that requested them.
+
+    Subscribers register a set of dotted paths.  Given the paths touched by an
+    update, ``match`` returns only the subscribers whose paths lie on or below
+    a changed path, so the cost of a broadcast follows the size of the change
+    rather than the number of connected clients.
+
+    A path ending in ``*`` is a wildcard subscription.  It is stored on the
+    node of its prefix, which already matches every change below it, so keys
+    created after subscribing are delivered as well and registering a large
+    subtree costs no more than registering a single path.
+    """
+
+    def __init__(self, sep='.'):
+        self.sep = sep
+        self.root = SubscriptionNode()
+        self.subscriber_paths = {}
+
+    def __len__(self):
+        return len(self.subscriber_paths)
+
+    def split_path(self, path):
+        """Convert a dotted path to a tuple of keys, dropping a trailing wildcard."""
+        key = tuple(path.split(self.sep)) if isinstance(path, str) else tuple(path)
+        return key[:-1] if key and key[-1] == WILDCARD else key
+
+    def add(self, subscriber, paths):
+        """Register a subscriber under each of the given paths."""
+        self.remove(subscriber)
+        keys = [self.split_path(path) for path in paths]
+        for key in keys:
+            node = self.root
+            for segment in key:
+                child = node.children.get(segment)
+                if child is None:
+                    child = node.children[segment] = SubscriptionNode()
+                node = child
+            node.subscribers.add(subscriber)
+        self.subscriber_paths[subscriber] = keys
+
+    def remove(self, subscriber):
+        """Remove a subscriber and prune any branches left empty."""
+        keys = self.subscriber_paths.pop(subscriber, None)
+        if not keys:
+            return
+        for key in keys:
+            trail = [self.root]
+            for segment in key:
+                node = trail[-1].children.get(segment)
+                if node is None:
+                    break
+                trail.append(node)
+            else:
+                trail[-1].subscribers.discard(subscriber)
+                for depth in range(len(key), 0, -1):
+                    node = trail[depth]
+                    if node.subscribers or node.children:
+                        break
+                    del trail[depth - 1].children[key[depth - 1]]
+
+    def match(self, changed_paths):
+        """Return the subscribers affected by any of the changed paths.
+
+        A subscriber matches when one of its paths equals a changed path, is a
+        prefix of it (a parent object changed underneath), or lies below it (a
+        whole subtree was replaced).
+        """
+        matched = set()
+        for path in changed_paths:
+            node = self.root
+            for segment in self.split_path(path):
+                matched.update(node.subscribers)
+                node = node.children.get(segment)
+                if node is None:
+                    break
+            else:
+                self.collect(node, matched)
+        return matched
+
+    def collect(self, node, matched):
+        """Add every subscriber at or below node to matched."""
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            matched.update(node.subscribers)
+            stack.extend(node.children.values())
@@ -0,0 +1,142 @@
+import os
+import json
+import mmap
+import time
+import zlib
+import struct
+import asyncio
+
+# Record kinds
+START, INBOUND, OUTBOUND, OPEN, CLOSE = range(5)
+KIND_NAMES = {START: 'start', INBOUND: 'in', OUTBOUND: 'out', OPEN: 'open', CLOSE: 'close'}
+BINARY = 1
+
+MAGIC = b'SKYR'
+# Block: magic, compressed length. Record: monotonic time, kind, flags, name length, payload length
+BLOCK = struct.Struct('<4sI')
+RECORD = struct.Struct('<dBBHI')
+
+
+class TrafficRecorder:
+    """Appends the websocket messages of a server or client to a compressed log.
+
+    Every message is a length-prefixed record with its monotonic send or
+    receive time, direction and connection name. Records are buffered and
+    written as zlib compressed blocks, each behind a magic and a length, once
+    ``block_size`` bytes are buffered or ``flush_interval`` seconds passed.
+    The file is only ever appended to, and a block cut short by a crash is
+    skipped when reading, so one log can span restarts.
+
+    OPEN records carry the role of the recording side of a connection,
+    'server' or 'client', which tells the replay tool which messages went to
+    the server.
+    """
+
+    def __init__(self, path, compresslevel=1, block_size=65536, flush_interval=1.0, debug=False):
+        self.path = path
+        self.compresslevel = compresslevel
+        self.block_size = block_size
+        self.flush_interval = flush_interval
+        self.debug = debug
+        self.file = open(path, 'ab')
+        self.buffer = bytearray()
+        self.flush_timer = None
+        self.records = 0
+        self.written = 0
+        self.record(START, '', json.dumps({"wall_time": time.time(), "monotonic": time.monotonic(),
+                                           "pid": os.getpid()}))
+        if self.debug:
+            print(f"Recording websocket traffic to {path}")
+
+    def record(self, kind, name, payload=''):
+        """Buffer one record, payload being the str or bytes of a message."""
+        if self.file is None:
+            return
+        if isinstance(payload, str):
+            payload, flags = payload.encode(), 0
+        else:
+            flags = BINARY
+        name = name.encode()
+        self.buffer += RECORD.pack(time.monotonic(), kind, flags, len(name), len(payload))
+        self.buffer += name
+        self.buffer += payload
+        self.records += 1
+        if len(self.buffer) >= self.block_size:
+            self.flush()
+        elif self.flush_timer is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                return
+            self.flush_timer = loop.call_later(self.flush_interval, self.flush)
+
+    def inbound(self, name, message):
+        self.record(INBOUND, name, message)
+
+    def outbound(self, name, message):
+        self.record(OUTBOUND, name, message)
+
+    def opened(self, name, role):
+        self.record(OPEN, name, role)
+
+    def closed(self, name):
+        self.record(CLOSE, name)
+
+    def flush(self):
+        """Compress the buffered records into one block and append it to the file."""
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+        if not self.buffer or self.file is None:
+            return
+        block = zlib.compress(bytes(self.buffer), self.compresslevel)
+        self.buffer.clear()
+        self.file.write(BLOCK.pack(MAGIC, len(block)) + block)
+        self.file.flush()
+        self.written += BLOCK.size + len(block)
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def parse_block(block):
+    """Yield (timestamp, kind, name, payload) from a decompressed block."""
+    position = 0
+    while position + RECORD.size <= len(block):
+        timestamp, kind, flags, name_length, payload_length = RECORD.unpack_from(block, position)
+        position += RECORD.size
+        name = block[position:position + name_length].decode()
+        position += name_length
+        payload = block[position:position + payload_length]
+        position += payload_length
+        yield timestamp, kind, name, payload if flags & BINARY else payload.decode()
+
+
+def read_records(path):
+    """Yield (timestamp, kind, name, payload) from a traffic log, payload being str for text messages.
+
+    Blocks that are damaged or were cut short are skipped up to the next
+    block that was appended after them.
+    """
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            position = 0
+            while position + BLOCK.size <= len(data):
+                magic, length = BLOCK.unpack_from(data, position)
+                start = position + BLOCK.size
+                try:
+                    if magic != MAGIC:
+                        raise ValueError('bad block magic')
+                    block = zlib.decompress(data[start:start + length])
+                except (ValueError, zlib.error):
+                    position = data.find(MAGIC, position + 1)
+                    if position < 0:
+                        return
+                    continue
+                position = start + length
+                yield from parse_block(block)
@@ -0,0 +1,97 @@
+import time
+import asyncio
+
+
+def merge_updates(target, updates):
+    """Merge nested update dicts into target, later values winning."""
+    for key, value in updates.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge_updates(target[key], value)
+        else:
+            target[key] = dict(value) if isinstance(value, dict) else value
+
+
+class UpdateDispatcher:
+    """Runs a state update handler on its own task, coalescing updates per root.
+
+    ``put`` only records which objects changed and returns at once, so the
+    websocket keeps being read while a slow handler runs. Updates that arrive
+    in the meantime are merged into one pending update per root, and the
+    handler is then called once with that merged update. By then the state
+    store already holds the newest values, so a handler never works through
+    a stale backlog.
+
+    ``put_changes`` does the same for (path, old, new) leaf changes passed to
+    ``change_handler``: a path keeps its first old and its latest new value,
+    and is dropped if it ends up where it started.
+    """
+
+    def __init__(self, handler, change_handler=None, handler_time=None, debug=False):
+        self.handler = handler
+        self.change_handler = change_handler
+        self.handler_time = handler_time
+        self.debug = debug
+        self.pending = {}
+        self.pending_changes = {}
+        self.ready = asyncio.Event()
+        self.task = None
+        self.dispatched = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self.pending) + len(self.pending_changes)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+        return self
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    def put(self, root, updated_objects):
+        """Queue updated_objects of root for the handler, merging with a pending update of root."""
+        pending = self.pending.get(root)
+        if pending is None:
+            pending = self.pending[root] = {}
+        else:
+            self.coalesced += 1
+        merge_updates(pending, updated_objects)
+        self.ready.set()
+
+    def put_changes(self, changes):
+        """Queue (path, old, new) changes for the change handler, keeping the first old value of a path."""
+        for path, old, new in changes:
+            pending = self.pending_changes.get(path)
+            if pending is None:
+                self.pending_changes[path] = (old, new)
+            else:
+                self.pending_changes[path] = (pending[0], new)
+                self.coalesced += 1
+        self.ready.set()
+
+    async def run(self):
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            pending, self.pending = self.pending, {}
+            changes, self.pending_changes = self.pending_changes, {}
+            for path, (old, new) in changes.items():
+                if old != new:
+                    await self.call(self.change_handler, path, old, new)
+            for root, updated_objects in pending.items():
+                await self.call(self.handler, root, updated_objects)
+
+    async def call(self, handler, *args):
+        start = time.perf_counter()
+        try:
+            await handler(*args)
+        except Exception as e:
+            if self.debug:
+                print(f"Error in state update handler for {args[0]}: {e}")
+        self.dispatched += 1
+        if self.handler_time is not None:
+            self.handler_time.observe(time.perf_counter() - start)
@@ -1,14 +1,20 @@
-import asyncio
-import json
-import websockets
 from websocket_server.base_websocket_client import BaseWebSocketClient
+from websocket_server.connection_hub import HubClient, get_hub
 
 class WebSocketClientMixin:
-    def __init__(self, connections, subscriptions, debug=True):
-        self.client = BaseWebSocketClient(connections, subscriptions, debug)
+    def __init__(self, connections, subscriptions, debug=True, shared=False, **client_options):
+        # A shared client uses the process's ConnectionHub, one connection per URI for all its services
+        if shared:
+            self.client = HubClient(get_hub(debug, **client_options), connections, subscriptions, debug)
+        else:
+            self.client = BaseWebSocketClient(connections, subscriptions, debug, **client_options)
         self.debug = debug
         self.client.on_state_update = self.handle_client_update  # Set the callback method
 
+        # Serve the client's connection health along with the server's metrics
+        if hasattr(self, 'metrics'):
+            self.metrics.include(self.client.metrics)
+
     async def start_client(self):
         if self.debug:
             print("Starting WebSocket client...")